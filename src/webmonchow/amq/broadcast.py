@@ -1,8 +1,9 @@
 # standard imports
 import argparse
+import contextlib
+import functools
 import glob
 import json
-import math
 import os
 import time
 from typing import List
@@ -10,6 +11,19 @@ from typing import List
 # third party imports
 import stomp
 
+# webmonchow imports
+from webmonchow.amq.sender import BACKOFF, CONNECTION_ERRORS, broadcast_async, broadcast_brokers, disconnect
+from webmonchow.amq.templates import MessageTemplate
+from webmonchow.contents import Programme, load_contents
+from webmonchow.metrics import monitor
+from webmonchow.outage import OVERFLOW_POLICIES, Delivery, OutageBuffer
+from webmonchow.pv.expressions import ExpressionError
+from webmonchow.rate import natural_rate, profile_argument, rate_clock, report_rate
+from webmonchow.recording import replay_messages
+from webmonchow.scheduler import Scheduler
+from webmonchow.sinks import NdjsonFile, NdjsonStompConnection, NullStompConnection, SinkStats, serve_stomp
+from webmonchow.workers import partition_destinations, run_workers
+
 
 def service_content_files() -> List[str]:
     r"""Absolute paths to all content *.json files under directory services/."""
@@ -21,27 +35,66 @@ def service_content_files() -> List[str]:
 
 def read_contents(filenames: List[str]):
     """
-    Reads and combines JSON data from multiple content files.
+    Reads and combines the content of multiple content files, see `webmonchow.contents.load_contents`.
 
     Parameters
     ----------
     filenames : List[str]
-        A list of file paths to JSON files.
+        A list of file paths to JSON or JSON lines content files.
 
     Returns
     -------
     dict
-        A dictionary containing the combined data from all JSON files.
+        A dictionary containing the combined data from all content files. The lists of programmes of a key found
+        in several files are merged.
     """
-    data = {}
-    for filename in filenames:
-        print(f"Loading {filename}")
-        with open(filename) as f:
-            data.update(json.load(f))
-    return data
+    return load_contents(filenames)
 
 
-def message_generator(data):
+def serialize_contents(data):
+    """
+    Serializes the message of every programme to JSON, once, so that it's not serialized again on every send.
+
+    Programmes with generated 'fields' (see `webmonchow.amq.templates`) get a `MessageTemplate` instead,
+    which serializes only the generated fields on every send.
+
+    Parameters
+    ----------
+    data : dict
+        A dictionary where each key is a destination (queue or topic) and each value is a list of programmes.
+        Messages that are already serialized (bytes) are left untouched.
+
+    Returns
+    -------
+    dict
+        A copy of `data` where each programme is a `webmonchow.contents.Programme` record, whose 'message'
+        is either the UTF-8 encoded JSON of the message, or a `MessageTemplate`.
+
+    Raises
+    ------
+    ExpressionError
+        If the generated fields of any programme are invalid. The message lists all the offending programmes.
+    """
+    serialized = {}
+    errors = []
+    for queue_or_topic, programmes in data.items():
+        serialized[queue_or_topic] = []
+        for programme in programmes:
+            message = programme["message"]
+            try:
+                if "fields" in programme:
+                    message = MessageTemplate(message, programme["fields"])
+                elif not isinstance(message, (bytes, MessageTemplate)):
+                    message = json.dumps(message).encode()
+            except ExpressionError as e:
+                errors.append(f"{queue_or_topic}: {e}")
+            serialized[queue_or_topic].append(Programme(programme["frequency"], message))
+    if errors:
+        raise ExpressionError("Failed to compile message fields:\n" + "\n".join(errors))
+    return serialized
+
+
+def message_generator(data, scheduler=None, metrics=None):
     """
     Generates messages at specified intervals based on their assigned frequency.
 
@@ -51,26 +104,28 @@ def message_generator(data):
         A dictionary where each key is a destination (queue or topic) and each value is a list of programmes.
         Each programme is a dictionary with 'frequency' and 'message' keys.
         The units of 'frequency' are seconds, meaning the time interval between two messages.
+        A 'message' that is a `MessageTemplate` is rendered every time it's sent.
+    scheduler : Optional[webmonchow.scheduler.Scheduler]
+        The scheduler deciding when each message is due. If None, a new scheduler on the wall clock is used.
+    metrics : Optional[webmonchow.metrics.Metrics]
+        If given, the time to render each message with generated fields is observed.
 
     Yields
     ------
     tuple
         A tuple containing the destination queue or topic, and message to send.
     """
-    time_step = 1.0  # in seconds. Maximum frequency for any message to be sent
-    count = 0
-    while True:
-        for queue_or_topic, programmes in data.items():
-            for programme in programmes:
-                yield_tuple = queue_or_topic, programme["message"]
-                skip_counts = math.ceil(programme["frequency"] / time_step)
-                if skip_counts == 0:  # only if frequency is 0
-                    if count == 0:
-                        yield yield_tuple
-                elif count % skip_counts == 0:
-                    yield yield_tuple
-        time.sleep(time_step)
-        count += 1
+    scheduler = Scheduler(metrics=metrics) if scheduler is None else scheduler
+    for queue_or_topic, programmes in data.items():
+        for programme in programmes:
+            scheduler.add((queue_or_topic, programme["message"]), programme["frequency"])
+    for x, (queue_or_topic, message) in scheduler:
+        if isinstance(message, MessageTemplate):
+            start = time.perf_counter()
+            message = message.render(x)
+            if metrics is not None:
+                metrics.generate.observe(time.perf_counter() - start)
+        yield queue_or_topic, message
 
 
 def connect_to_broker(broker, user, password, attempts=None, interval=5.0):
@@ -118,7 +173,7 @@ def connect_to_broker(broker, user, password, attempts=None, interval=5.0):
     raise stomp.exception.ConnectFailedException(f"Failed to connect to broker after {attempts} attempts.")
 
 
-def broadcast(connection, message_gen):
+def broadcast(connection, message_gen, metrics=None, verbose=False, connect=None, buffer=None, backoff=BACKOFF):
     """
     Sends messages to specified AMQ queues or topics using an established connection.
 
@@ -129,33 +184,268 @@ def broadcast(connection, message_gen):
     message_gen : generator
         A python generator that yields tuples containing the destination queue or topic and the message to be sent.
         The generator yields messages at specified intervals based on their assigned frequency.
+        Messages already serialized (bytes, see `serialize_contents`) are sent as they are,
+        other messages are serialized to JSON.
+    metrics : Optional[webmonchow.metrics.Metrics]
+        If given, the number of messages and the time to send each of them are observed, and the messages
+        dropped or sent late during outages are counted.
+    verbose : bool
+        Print every message.
+    connect : Optional[Callable[[], stomp.Connection]]
+        Opens a new connection to the broker, e.g. a partial of `connect_to_broker` with one attempt.
+        If given, the messages due while the connection is lost are held in `buffer` until it reconnects,
+        see `webmonchow.outage.Delivery`. If None, losing the connection raises.
+    buffer : Optional[webmonchow.outage.OutageBuffer]
+        Holds the messages while disconnected. Defaults to an `OutageBuffer` with the default size and policy.
+    backoff : tuple
+        Initial and maximum time between two attempts to reconnect, in seconds.
     """
-    for queue_or_topic, message in message_gen:
-        print(f"Sending {message} to {queue_or_topic}")
-        connection.send(queue_or_topic, json.dumps(message))
 
+    def send(connection, item):
+        queue_or_topic, body = item
+        start = time.perf_counter()
+        connection.send(queue_or_topic, body)
+        if metrics is not None:
+            metrics.send.observe(time.perf_counter() - start)
+            metrics.messages.inc()
 
-def get_options(argv):
+    delivery = Delivery(
+        connection, send, CONNECTION_ERRORS, connect, disconnect, buffer, backoff, metrics, name="broker"
+    )
+    try:
+        for queue_or_topic, message in message_gen:
+            if verbose:
+                print(f"Sending {message} to {queue_or_topic}")
+            delivery.send((queue_or_topic, message if isinstance(message, bytes) else json.dumps(message)))
+    finally:
+        delivery.close()
+
+
+def _parser():
+    r"""Parser of the command line options."""
     parser = argparse.ArgumentParser()
     parser.add_argument("--user", "-u", dest="user", default=os.getenv("ICAT_USER", "icat"))
     parser.add_argument("--password", "-p", dest="password", default=os.getenv("ICAT_PASS", "icat"))
-    parser.add_argument("--broker", "-b", dest="broker", default=os.getenv("BROKER", "localhost:61613"))
+    parser.add_argument(
+        "--broker",
+        "-b",
+        dest="broker",
+        default=os.getenv("BROKER", "localhost:61613"),
+        help="Address of the broker, host:port, or of several brokers separated by commas",
+    )
+    parser.add_argument(
+        "--broker-mode",
+        choices=["fanout", "spread"],
+        default="fanout",
+        help="With several brokers, send every message to every broker, or spread the destinations across brokers",
+    )
+    parser.add_argument(
+        "--max-backoff",
+        type=float,
+        default=BACKOFF[1],
+        help="Maximum time (seconds) between two attempts to reconnect to a broker. "
+        "The time doubles after every failed attempt, starting at one second",
+    )
     parser.add_argument(
         "--content-files",
         "-m",
         help="List of content files to broadcast, separated by comma.",
-        dest="content_files" "",
+        dest="content_files",
         default=",".join(service_content_files()),
     )
+    parser.add_argument(
+        "--rate",
+        type=profile_argument,
+        default=None,
+        help="Target rate of messages, e.g. 5000/s, step:1000/s@60,5000/s, ramp:100/s..5000/s@300, "
+        "or burst:1000/s,10000/s@5/60. The frequencies of the content files are scaled to match it",
+    )
+    parser.add_argument(
+        "--report-interval",
+        type=float,
+        default=10.0,
+        help="Time (seconds) between two summaries of the metrics, and of the achieved rate when a target rate "
+        "is set. If 0, no summary is printed",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve the metrics in the Prometheus text format on this port of the local host",
+    )
+    parser.add_argument("--verbose", "-v", action="store_true", help="Print every message")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes broadcasting the messages, partitioned by destination, each with its own connection",
+    )
+    parser.add_argument(
+        "--replay",
+        default=None,
+        help="Recording of AMQ messages (see webmonchow_record) to replay instead of the content files",
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="Speed of the replay, e.g. 10 to replay ten times faster than recorded, or inf for as fast as possible",
+    )
+    parser.add_argument(
+        "--async",
+        dest="async_send",
+        action="store_true",
+        help="Send the messages from a separate thread, so a slow broker doesn't hold up the schedule",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=1000,
+        help="Maximum number of messages waiting to be sent with --async, or to each of several brokers. "
+        "The schedule waits while the queue is full",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=None,
+        help="Request a receipt for every message sent with --async, or to several brokers, allowing at most "
+        "this many messages without a receipt from each broker",
+    )
+    parser.add_argument(
+        "--sink",
+        choices=["broker", "null", "ndjson", "stomp"],
+        default="broker",
+        help="Where messages are sent: the broker, nowhere (null), to file --sink-file (ndjson), or to a STOMP "
+        "server started on the local host (stomp). Sinks other than the broker print what they received",
+    )
+    parser.add_argument(
+        "--sink-file",
+        default="messages.ndjson",
+        help="File of the messages sent to sink ndjson, one JSON record per line",
+    )
+    parser.add_argument(
+        "--buffer-size",
+        type=int,
+        default=10000,
+        help="Maximum number of messages held while the connection to the broker is lost, sent once reconnected",
+    )
+    parser.add_argument(
+        "--overflow",
+        choices=OVERFLOW_POLICIES,
+        default="drop-oldest",
+        help="When the buffer of held messages is full, drop the oldest message, drop the new one, "
+        "or block the schedule until reconnected",
+    )
+    parser.add_argument(
+        "--spill-file",
+        default=None,
+        help="File where held messages are written beyond the first thousand, instead of memory",
+    )
+    return parser
+
+
+def get_options(argv):
+    parser = _parser()
     options = parser.parse_args(argv)
+    options.brokers = [broker.strip() for broker in options.broker.split(",")]
+    if options.window is not None and not options.async_send and len(options.brokers) == 1:
+        parser.error("--window requires --async")
+    if options.sink != "broker" and len(options.brokers) > 1:
+        parser.error("--sink can't be combined with several brokers")
+    if options.sink == "ndjson" and options.workers > 1:
+        parser.error("--sink ndjson can't be combined with --workers")
+    if options.spill_file is not None and options.workers > 1:
+        parser.error("--spill-file can't be combined with --workers")
     return options
 
 
+@contextlib.contextmanager
+def _connect(options):
+    r"""Connection to the broker, or to the sink requested by option --sink, printing what the sink received."""
+    if options.sink == "broker":
+        yield connect_to_broker(options.broker, options.user, options.password)
+        return
+    stats = SinkStats()
+    closing = []
+    if options.sink == "null":
+        connection = NullStompConnection(stats)
+    elif options.sink == "ndjson":
+        file = NdjsonFile(options.sink_file)
+        closing.append(file.close)
+        connection = NdjsonStompConnection(file, stats)
+    else:
+        server = serve_stomp(stats=stats)
+        closing.append(server.shutdown)
+        connection = connect_to_broker(server.address, options.user, options.password)
+        closing.insert(0, connection.disconnect)
+    try:
+        yield connection
+    finally:
+        for close in closing:
+            close()
+        print(f"Sink {options.sink}: {stats.summary()}")
+
+
+def _broadcast(options, message_gen, metrics=None):
+    r"""Connect to the brokers or the sink, and send messages from this thread, or from sender threads."""
+    backoff = (min(BACKOFF[0], options.max_backoff), options.max_backoff)
+    if len(options.brokers) > 1:
+        connects = [
+            functools.partial(connect_to_broker, broker, options.user, options.password, attempts=1, interval=0.0)
+            for broker in options.brokers
+        ]
+        broadcast_brokers(
+            connects,
+            message_gen,
+            options.broker_mode,
+            options.queue_size,
+            options.window,
+            metrics,
+            options.verbose,
+            backoff,
+        )
+        return
+    with _connect(options) as connection:
+        if options.async_send:
+            broadcast_async(connection, message_gen, options.queue_size, options.window, metrics, options.verbose)
+            return
+        connect = None
+        if options.sink == "broker":
+            connect = functools.partial(
+                connect_to_broker, options.broker, options.user, options.password, attempts=1, interval=0.0
+            )
+        buffer = OutageBuffer(options.buffer_size, options.overflow, options.spill_file)
+        broadcast(connection, message_gen, metrics, options.verbose, connect, buffer, backoff)
+
+
+def _worker(options, rate, data, origin, metrics):
+    r"""Broadcast a part of the AMQ content in a worker process, see `webmonchow.workers.run_workers`."""
+    data = serialize_contents(data)
+    scheduler = Scheduler(rate_clock(options.rate, rate, origin), metrics)
+    _broadcast(options, message_generator(data, scheduler, metrics), metrics)
+
+
 def main(argv=None):
     options = get_options(argv)
+    metrics = monitor(options.report_interval, options.metrics_port)
+    if options.replay is not None:
+        _broadcast(options, replay_messages(options.replay, options.speed), metrics)
+        return
     data = read_contents([f.strip() for f in options.content_files.split(",")])
-    connection = connect_to_broker(options.broker, options.user, options.password)
-    broadcast(connection, message_generator(data))
+    rate = None
+    if options.rate is not None:
+        rate = natural_rate(programme["frequency"] for programmes in data.values() for programme in programmes)
+        if rate <= 0:
+            _parser().error("--rate requires periodic messages, with a frequency above 0, in the content files")
+    if options.workers > 1:
+        worker = functools.partial(_worker, options, rate)
+        run_workers(worker, partition_destinations(data, options.workers), metrics)
+        return
+    data = serialize_contents(data)
+    message_gen = message_generator(data, Scheduler(rate_clock(options.rate, rate), metrics), metrics)
+    if options.rate is not None and options.report_interval > 0:
+        message_gen = report_rate(message_gen, options.rate, options.report_interval)
+    _broadcast(options, message_gen, metrics)
 
 
 if __name__ == "__main__":
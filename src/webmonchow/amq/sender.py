@@ -0,0 +1,310 @@
+r"""
+Send AMQ messages from a thread, so a slow broker doesn't hold up the schedule of the messages.
+
+The generator puts messages into a bounded queue and a `Sender` thread sends them. When receipts are requested,
+the broker acknowledges every message, and at most `window` messages are in flight without a receipt.
+A full window stops the sender, a full queue then stops the generator, and the scheduler falls behind,
+which shows in its lag, instead of the broker being flooded.
+
+`broadcast_brokers` sends to several brokers, one sender each, either every message to every broker
+or each destination to one of them. A sender that loses its broker reconnects with exponential backoff,
+dropping the messages that don't fit in its queue meanwhile, so it doesn't stall the other brokers.
+"""
+
+# standard imports
+import itertools
+import json
+import queue
+import threading
+import time
+import zlib
+
+# third party imports
+import stomp
+
+# webmonchow imports
+from webmonchow.outage import BACKOFF
+
+# errors after which a sender discards its connection and opens a new one
+CONNECTION_ERRORS = (stomp.exception.StompException, OSError)
+
+
+class _StoppedError(Exception):
+    r"""Raised in a sender stopped while disconnected."""
+
+
+class _ReceiptListener(stomp.ConnectionListener):
+    r"""Observe the time until the receipt of each message, and free its place in the window of the sender."""
+
+    def __init__(self, sender):
+        self.sender = sender
+
+    def on_receipt(self, frame):
+        self.sender._acknowledge(frame.headers.get("receipt-id"))
+
+
+class Sender(threading.Thread):
+    """
+    Thread sending AMQ messages through a connection to the broker.
+
+    Messages are taken from a bounded queue, so a producer putting messages into a full queue blocks until
+    the sender catches up. If the sender can reconnect, it does so with exponential backoff when the connection
+    is lost, and messages put while it's disconnected are dropped if the queue is full.
+
+    Parameters
+    ----------
+    connection : Optional[stomp.Connection]
+        An active connection to the AMQ message broker. If None, the sender opens one with `connect`.
+    queue_size : int
+        Maximum number of messages waiting to be sent.
+    window : Optional[int]
+        If given, every message is sent with a receipt header, and the sender waits when `window` messages
+        are waiting for their receipt from the broker.
+    name : str
+        Name of the thread, also the prefix of the receipts.
+    metrics : Optional[webmonchow.metrics.Metrics]
+        If given, the messages sent and dropped, the time to send them, the time until their receipt, and the depth
+        of the queue are observed.
+    connect : Optional[Callable[[], stomp.Connection]]
+        Opens a new connection to the broker, e.g. a partial of `webmonchow.amq.broadcast.connect_to_broker`
+        with one attempt. If None, the sender stops when the connection is lost.
+    backoff : tuple
+        Initial and maximum time between two attempts to reconnect, in seconds. The time doubles after
+        every failed attempt.
+    """
+
+    def __init__(
+        self, connection, queue_size=1000, window=None, name="sender", metrics=None, connect=None, backoff=BACKOFF
+    ):
+        super().__init__(name=name, daemon=True)
+        self.connection = None
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.window = window
+        self.metrics = metrics
+        self.connect = connect
+        self.backoff = backoff
+        self.error = None
+        self.dropped = 0  # messages dropped while disconnected
+        self._connected = threading.Event()
+        self._stopping = threading.Event()
+        self._in_flight = {}  # time each message waiting for its receipt was sent, by receipt
+        self._receipts = threading.Condition()
+        if connection is not None:
+            self._use(connection)
+
+    @property
+    def in_flight(self):
+        """Number of messages waiting for their receipt."""
+        with self._receipts:
+            return len(self._in_flight)
+
+    def _use(self, connection):
+        r"""Send through a new connection. Messages in flight on the previous connection will get no receipt."""
+        if self.window is not None:
+            connection.set_listener(self.name, _ReceiptListener(self))
+            with self._receipts:
+                self._in_flight.clear()
+                self._receipts.notify_all()
+        self.connection = connection
+        self._connected.set()
+
+    def _reconnect(self):
+        r"""Open a new connection, waiting longer after every failed attempt. Raises _StoppedError if stopped."""
+        delay, max_delay = self.backoff
+        while True:
+            try:
+                connection = self.connect()
+                break
+            except CONNECTION_ERRORS as e:
+                print(f"{self.name} failed to connect, next attempt in {delay:g} s: {e}")
+            if self._stopping.wait(delay):
+                raise _StoppedError
+            delay = min(2.0 * delay, max_delay)
+        self._use(connection)
+
+    def _send(self, number, queue_or_topic, body):
+        r"""Send a message through the current connection, waiting for a place in the window of receipts."""
+        headers = {}
+        if self.window is not None:
+            receipt = f"{self.name}-{number}"
+            with self._receipts:
+                while not self._receipts.wait_for(lambda: len(self._in_flight) < self.window, timeout=1.0):
+                    if not self.connection.is_connected():
+                        raise stomp.exception.NotConnectedException(f"{self.name} lost its connection")
+                self._in_flight[receipt] = time.perf_counter()
+            headers["receipt"] = receipt
+        start = time.perf_counter()
+        self.connection.send(queue_or_topic, body, **headers)
+        if self.metrics is not None:
+            self.metrics.send.observe(time.perf_counter() - start)
+            self.metrics.messages.inc()
+
+    def run(self):
+        try:
+            for number in itertools.count():
+                item = self.queue.get()
+                if item is None:  # no more messages
+                    break
+                queue_or_topic, message = item
+                body = message if isinstance(message, bytes) else json.dumps(message)
+                while True:
+                    try:
+                        if self.connection is None:
+                            self._reconnect()
+                        self._send(number, queue_or_topic, body)
+                        break
+                    except CONNECTION_ERRORS as e:
+                        if self.connect is None:
+                            raise
+                        print(f"{self.name} lost its connection to the broker: {e}")
+                        self._connected.clear()
+                        disconnect(self.connection)
+                        self.connection = None
+        except _StoppedError:
+            pass  # stopped while disconnected, the queued messages are lost
+        except Exception as e:  # noqa: BLE001 reported to the producer by `put` and `stop`
+            self.error = e
+        finally:
+            self._connected.clear()
+
+    def _acknowledge(self, receipt):
+        r"""Called by the listener of the connection when the broker sends a receipt."""
+        with self._receipts:
+            sent = self._in_flight.pop(receipt, None)
+            self._receipts.notify_all()
+        if sent is not None and self.metrics is not None:
+            self.metrics.ack.observe(time.perf_counter() - sent)
+
+    def put(self, queue_or_topic, message):
+        """
+        Queue a message, blocking while the queue is full, or dropping the message if the sender is disconnected.
+        Raises RuntimeError if the sender died.
+        """
+        if self.metrics is not None:
+            self.metrics.queue_depth.observe(self.queue.qsize())
+        while True:
+            if not self.is_alive():
+                raise RuntimeError(f"{self.name} stopped") from self.error
+            try:
+                if self.connect is not None and not self._connected.is_set():
+                    self.queue.put_nowait((queue_or_topic, message))
+                else:
+                    self.queue.put((queue_or_topic, message), timeout=1.0)
+                return
+            except queue.Full:
+                if self.connect is not None and not self._connected.is_set():
+                    self.dropped += 1
+                    if self.metrics is not None:
+                        self.metrics.dropped.inc()
+                    return
+
+    def stop(self, timeout=10.0):
+        """
+        Let the sender send the queued messages, then wait for it to finish, and for the receipts of the messages
+        in flight for up to `timeout` seconds. A sender still disconnected gives up on the queued messages.
+        """
+        self._stopping.set()
+        while self.is_alive():
+            try:
+                self.queue.put(None, timeout=1.0)
+                break
+            except queue.Full:
+                continue  # the sender may have given up while disconnected
+        self.join()
+        with self._receipts:
+            if not self._receipts.wait_for(lambda: not self._in_flight, timeout):
+                print(f"{self.name}: no receipt for {len(self._in_flight)} messages after {timeout} s")
+        if self.dropped:
+            print(f"{self.name} dropped {self.dropped} messages while disconnected")
+        if self.error is not None:
+            raise RuntimeError(f"{self.name} stopped") from self.error
+
+
+def disconnect(connection):
+    """Disconnect from the broker, ignoring the errors of a connection already lost."""
+    if connection is not None:
+        try:
+            connection.disconnect()
+        except CONNECTION_ERRORS:
+            pass
+
+
+def broadcast_async(connection, message_gen, queue_size=1000, window=None, metrics=None, verbose=False):
+    """
+    Sends messages like `webmonchow.amq.broadcast.broadcast`, from a `Sender` thread.
+
+    Parameters
+    ----------
+    connection : stomp.Connection
+        An active connection to the AMQ message broker.
+    message_gen : generator
+        A python generator that yields tuples containing the destination queue or topic and the message to be sent,
+        such as `webmonchow.amq.broadcast.message_generator`.
+    queue_size : int
+        Maximum number of messages waiting to be sent. The generator is held back while the queue is full.
+    window : Optional[int]
+        If given, the maximum number of messages waiting for their receipt from the broker.
+    metrics : Optional[webmonchow.metrics.Metrics]
+        If given, the sender observes the messages sent, the time to send them, the time until their receipt,
+        and the depth of its queue.
+    verbose : bool
+        Print every message.
+    """
+    sender = Sender(connection, queue_size, window, metrics=metrics)
+    sender.start()
+    try:
+        for queue_or_topic, message in message_gen:
+            if verbose:
+                print(f"Sending {message} to {queue_or_topic}")
+            sender.put(queue_or_topic, message)
+    finally:
+        sender.stop()
+
+
+def broadcast_brokers(
+    connects, message_gen, mode="fanout", queue_size=1000, window=None, metrics=None, verbose=False, backoff=BACKOFF
+):
+    """
+    Sends messages to several brokers, from one `Sender` thread per broker, each with its own connection.
+
+    Parameters
+    ----------
+    connects : list
+        For each broker, a callable opening a new connection to it, e.g. a partial of
+        `webmonchow.amq.broadcast.connect_to_broker` with one attempt. Senders connect, and reconnect, on their own.
+    message_gen : generator
+        A python generator that yields tuples containing the destination queue or topic and the message to be sent,
+        such as `webmonchow.amq.broadcast.message_generator`.
+    mode : str
+        "fanout" to send every message to every broker, or "spread" to send the messages of each destination
+        to one broker, the destinations being spread across brokers.
+    queue_size : int
+        Maximum number of messages waiting to be sent to each broker.
+    window : Optional[int]
+        If given, the maximum number of messages waiting for their receipt from each broker.
+    metrics : Optional[webmonchow.metrics.Metrics]
+        If given, the senders observe the messages sent, the time to send them, the time until their receipt,
+        and the depth of their queue.
+    verbose : bool
+        Print every message.
+    backoff : tuple
+        Initial and maximum time between two attempts to reconnect to a broker, in seconds.
+    """
+    senders = [
+        Sender(None, queue_size, window, f"broker-{index}", metrics, connect, backoff)
+        for index, connect in enumerate(connects)
+    ]
+    for sender in senders:
+        sender.start()
+    try:
+        for queue_or_topic, message in message_gen:
+            if verbose:
+                print(f"Sending {message} to {queue_or_topic}")
+            if mode == "fanout":
+                for sender in senders:
+                    sender.put(queue_or_topic, message)
+            else:
+                senders[zlib.crc32(queue_or_topic.encode()) % len(senders)].put(queue_or_topic, message)
+    finally:
+        for sender in senders:
+            sender.stop()
@@ -0,0 +1,114 @@
+r"""
+AMQ messages with generated fields.
+
+A programme may declare 'fields', mapping the path of a field in the message to an expression in the
+syntax of PV functions (see `webmonchow.pv.expressions`), with the variables
+
+- `{x}`: time of the message, in seconds since the start of the broadcast,
+- `{n}`: number of messages sent from the programme before this one,
+- `{t}`: current time, in seconds since the epoch.
+
+For instance, the programme below sends DATA_READY messages for runs 321, 322, 323,...
+
+.. code-block:: json
+
+    {"frequency": 1,
+     "message": {"instrument": "HYSA", "run_number": "321", "facility": "SNS"},
+     "fields": {"run_number": "str(321+{n})"}}
+
+The message is serialized once, with a unique marker in place of each generated field. Rendering a message
+only serializes the values of the generated fields and joins them with the fixed parts of the message.
+"""
+
+# standard imports
+import copy
+import json
+import time
+
+# webmonchow imports
+from webmonchow.pv.expressions import ExpressionError, compile_function
+
+#: Variables of the expressions of generated fields, in the order they are passed
+VARIABLES = ("x", "n", "t")
+
+
+def _marker(index):
+    return f"\x00webmonchow-field-{index}\x00"
+
+
+def _replace(message, path, value):
+    r"""Replace the value at a dotted path (e.g. "monitors.1") inside nested dictionaries and lists."""
+    keys = path.split(".")
+    container = message
+    for key in keys[:-1]:
+        container = container[int(key) if isinstance(container, list) else key]
+    if isinstance(container, list):
+        container[int(keys[-1])] = value  # raises IndexError if the field doesn't exist
+    elif keys[-1] in container:
+        container[keys[-1]] = value
+    else:
+        raise KeyError(keys[-1])
+
+
+class MessageTemplate:
+    """
+    AMQ message where some fields are generated every time the message is sent.
+
+    Parameters
+    ----------
+    message : dict
+        The message, with any value for the generated fields.
+    fields : dict
+        Maps the dotted path of each generated field (e.g. "run_number", "monitors.1") to an expression of
+        variables `{x}`, `{n}`, and `{t}`.
+
+    Raises
+    ------
+    ExpressionError
+        If an expression can't be compiled, or a path doesn't exist in the message.
+    """
+
+    def __init__(self, message, fields):
+        message = copy.deepcopy(message)
+        functions = {}
+        for index, (path, expression) in enumerate(fields.items()):
+            try:
+                _replace(message, path, _marker(index))
+            except (IndexError, KeyError, TypeError, ValueError) as e:
+                raise ExpressionError(f"field '{path}' not found in message: {e!r}") from e
+            functions[_marker(index)] = compile_function(expression, variables=VARIABLES)
+        # split the serialized message around the markers, keeping the functions in order of appearance
+        body = json.dumps(message)
+        located = sorted((body.index(json.dumps(marker)), marker) for marker in functions)
+        self._segments = []
+        self._functions = []
+        start = 0
+        for position, marker in located:
+            self._segments.append(body[start:position].encode())
+            self._functions.append(functions[marker])
+            start = position + len(json.dumps(marker))
+        self._segments.append(body[start:].encode())
+        self.count = 0
+
+    def render(self, x):
+        """
+        Serialize the next message.
+
+        Parameters
+        ----------
+        x : float
+            Time of the message, in seconds since the start of the broadcast.
+
+        Returns
+        -------
+        bytes
+            The UTF-8 encoded JSON of the message.
+        """
+        n = self.count
+        t = time.time()
+        self.count += 1
+        parts = [self._segments[0]]
+        for function, segment in zip(self._functions, self._segments[1:]):
+            parts.append(json.dumps(function(x, n, t)).encode())
+            parts.append(segment)
+        return b"".join(parts)
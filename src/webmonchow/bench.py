@@ -0,0 +1,359 @@
+r"""
+Benchmarks of the generators, serializers and senders of webmonchow.
+
+The benchmarks run on synthetic content of growing size, made by replicating the service content files,
+on a clock that never sleeps, and against the null sinks of `webmonchow.sinks` instead of a broker and a database,
+so they measure the ceiling of webmonchow itself. Results are written as JSON, and the results of
+a previous version can be compared with option `--compare`.
+"""
+
+# standard imports
+import argparse
+import contextlib
+import functools
+import itertools
+import json
+import math
+import platform
+import sys
+import time
+
+# webmonchow imports
+from webmonchow import __version__
+from webmonchow.amq import broadcast as amq
+from webmonchow.amq.templates import MessageTemplate
+from webmonchow.pv import broadcast as pv
+from webmonchow.pv.expressions import compile_function
+from webmonchow.scheduler import Scheduler, SimulatedClock
+from webmonchow.sinks import NullDatabaseConnection, NullStompConnection
+
+
+@functools.cache
+def _services(module):
+    r"""Content of the service files of `webmonchow.amq.broadcast` or `webmonchow.pv.broadcast`."""
+    with contextlib.redirect_stdout(sys.stderr):  # keep standard output for the results
+        return module.read_contents(module.service_content_files())
+
+
+def pv_contents(size):
+    """
+    Synthetic PV content with `size` PVs, replicating the PVs of the service content files.
+
+    Each copy of a PV gets its own instrument, and a constant offset so the functions of the copies differ.
+    """
+    services = _services(pv)
+    originals = [(sql_function, entry) for sql_function, pvs in services.items() for entry in pvs]
+    data = {}
+    for index, (sql_function, entry) in zip(range(size), itertools.cycle(originals)):
+        copy = index // len(originals)
+        function = entry["function"] if sql_function != "pvUpdate" else f"{copy}+{entry['function']}"
+        data.setdefault(sql_function, []).append(
+            {**entry, "instrument": f"{entry['instrument']}{copy}", "function": function}
+        )
+    return data
+
+
+def amq_contents(size):
+    """Synthetic AMQ content with `size` programmes, replicating the programmes of the service content files."""
+    services = _services(amq)
+    originals = [(destination, programme) for destination, programmes in services.items() for programme in programmes]
+    data = {}
+    for index, (destination, programme) in zip(range(size), itertools.cycle(originals)):
+        data.setdefault(f"{destination}.{index // len(originals)}", []).append(programme)
+    return data
+
+
+def measure(name, parameters, setup, run, repeat=3):
+    """
+    Time a benchmark, keeping the best of `repeat` runs.
+
+    Parameters
+    ----------
+    name : str
+        Name of the benchmark.
+    parameters : dict
+        Parameters of the benchmark, e.g. the size of the content, recorded with the result.
+    setup : Callable[[], object]
+        Prepares a run, e.g. loads the content. Not timed.
+    run : Callable[[object], int]
+        Runs the benchmark on the result of `setup`, returning the number of items processed.
+    repeat : int
+        Number of runs.
+
+    Returns
+    -------
+    dict
+        The name and parameters of the benchmark, the number of items processed, the time of the best run
+        in seconds, and the rate of items per second.
+    """
+    best = math.inf
+    items = 0
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        items = run(state)
+        best = min(best, time.perf_counter() - start)
+    return {"name": name, "parameters": parameters, "items": items, "seconds": best, "rate": items / best}
+
+
+def _compile(data):
+    r"""Compile PV content, returning the number of PVs."""
+    return sum(len(pvs) for pvs in pv.compile_contents(data).values())
+
+
+def _consume(gen, count, size=None):
+    r"""Consume `count` items of a generator, returning the number of messages."""
+    if size is None:
+        return sum(1 for _ in itertools.islice(gen, count))
+    return sum(size(item) for item in itertools.islice(gen, count))
+
+
+def generator_benchmarks(sizes, emissions, repeat=3):
+    """Benchmarks of loading content and of the generators of messages and PV updates, for each size of content."""
+    results = []
+    for size in sizes:
+        parameters = {"size": size}
+        results.append(measure("pv_compile", parameters, lambda size=size: pv_contents(size), _compile, repeat))
+        pv_data = pv.compile_contents(pv_contents(size))
+        results.append(
+            measure(
+                "pv_generator",
+                parameters,
+                lambda: pv.pv_generator(pv_data, Scheduler(SimulatedClock(sleep=False))),
+                lambda gen: _consume(gen, emissions),
+                repeat,
+            )
+        )
+        results.append(
+            measure(
+                "pv_batch_generator",
+                parameters,
+                lambda: pv.pv_batch_generator(pv_data, scheduler=Scheduler(SimulatedClock(sleep=False))),
+                lambda gen: _consume(gen, max(emissions // size, 1), size=len),
+                repeat,
+            )
+        )
+        try:
+            from webmonchow.pv import vectorized
+        except ImportError:  # NumPy is an optional dependency
+            pass
+        else:
+            raw_data = pv_contents(size)
+            results.append(
+                measure(
+                    "vectorized_pv_batch_generator",
+                    parameters,
+                    lambda raw_data=raw_data: vectorized.vectorized_pv_batch_generator(
+                        raw_data, seed=0, scheduler=Scheduler(SimulatedClock(sleep=False))
+                    ),
+                    lambda gen: _consume(gen, max(emissions // size, 1), size=len),
+                    repeat,
+                )
+            )
+        amq_data = amq.serialize_contents(amq_contents(size))
+        results.append(
+            measure(
+                "message_generator",
+                parameters,
+                lambda: amq.message_generator(amq_data, Scheduler(SimulatedClock(sleep=False))),
+                lambda gen: _consume(gen, emissions),
+                repeat,
+            )
+        )
+    return results
+
+
+def expression_benchmarks(emissions, repeat=3):
+    """Benchmarks of evaluating each distinct function of the service content files."""
+    templates = sorted({entry["function"] for pvs in _services(pv).values() for entry in pvs})
+    return [
+        measure(
+            "expression",
+            {"function": template},
+            functools.partial(compile_function, template),
+            functools.partial(_evaluate, count=emissions),
+            repeat,
+        )
+        for template in templates
+    ]
+
+
+def _evaluate(function, count):
+    for x in range(count):
+        function(float(x))
+    return count
+
+
+def serialization_benchmarks(emissions, repeat=3):
+    """Benchmarks of serializing AMQ messages to JSON, pre-serialized, and with generated fields."""
+    message = {"instrument": "HYSA", "ipts": "IPTS-12345", "run_number": "321", "facility": "SNS", "data_file": "a"}
+    return [
+        measure(
+            "amq_serialization",
+            {"method": "json.dumps"},
+            lambda: lambda _: json.dumps(message),
+            functools.partial(_evaluate, count=emissions),
+            repeat,
+        ),
+        measure(
+            "amq_serialization",
+            {"method": "template"},
+            lambda: MessageTemplate(message, {"run_number": "str(321+{n})"}).render,
+            functools.partial(_evaluate, count=emissions),
+            repeat,
+        ),
+    ]
+
+
+def sink_benchmarks(sizes, emissions, repeat=3):
+    """End-to-end benchmarks, from the content to the null STOMP and PostgreSQL sinks, for each size of content."""
+
+    def broadcast_amq(state):
+        connection, message_gen = state
+        amq.broadcast(connection, itertools.islice(message_gen, emissions))
+        return connection.stats.count
+
+    def broadcast_pv(state):
+        conn, pv_gen = state
+        pv.broadcast(conn, itertools.islice(pv_gen, emissions))
+        return conn.cursor().statements
+
+    def broadcast_pv_batches(state):
+        conn, batch_gen = state
+        pv.broadcast_batches(conn, itertools.islice(batch_gen, max(emissions // size, 1)))
+        return conn.cursor().statements
+
+    results = []
+    for size in sizes:
+        parameters = {"size": size}
+        amq_data = amq.serialize_contents(amq_contents(size))
+        pv_data = pv.compile_contents(pv_contents(size))
+        results.append(
+            measure(
+                "amq_broadcast",
+                parameters,
+                lambda: (
+                    NullStompConnection(),
+                    amq.message_generator(amq_data, Scheduler(SimulatedClock(sleep=False))),
+                ),
+                broadcast_amq,
+                repeat,
+            )
+        )
+        results.append(
+            measure(
+                "pv_broadcast",
+                parameters,
+                lambda: (NullDatabaseConnection(), pv.pv_generator(pv_data, Scheduler(SimulatedClock(sleep=False)))),
+                broadcast_pv,
+                repeat,
+            )
+        )
+        results.append(
+            measure(
+                "pv_broadcast_batches",
+                parameters,
+                lambda: (
+                    NullDatabaseConnection(),
+                    pv.pv_batch_generator(pv_data, scheduler=Scheduler(SimulatedClock(sleep=False))),
+                ),
+                broadcast_pv_batches,
+                repeat,
+            )
+        )
+    return results
+
+
+def run_benchmarks(sizes=(10, 100, 1000, 10000), emissions=100000, repeat=3):
+    """
+    Run all the benchmarks.
+
+    Parameters
+    ----------
+    sizes : Sequence[int]
+        Numbers of PVs and AMQ programmes in the synthetic content.
+    emissions : int
+        Number of messages or PV updates generated by each benchmark.
+    repeat : int
+        Number of runs of each benchmark, the best one being kept.
+
+    Returns
+    -------
+    dict
+        The versions of webmonchow and Python, the platform, and the list of results of `measure`.
+    """
+    results = [
+        *generator_benchmarks(sizes, emissions, repeat),
+        *expression_benchmarks(emissions, repeat),
+        *serialization_benchmarks(emissions, repeat),
+        *sink_benchmarks(sizes, emissions, repeat),
+    ]
+    return {
+        "webmonchow": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "emissions": emissions,
+        "results": results,
+    }
+
+
+def compare(report, baseline):
+    """
+    Compare the rates of two reports of `run_benchmarks`.
+
+    Returns
+    -------
+    list
+        Lines with the name and parameters of each benchmark found in both reports, its rates, and the change
+        in percent. A negative change is a regression.
+    """
+    previous = {(result["name"], json.dumps(result["parameters"])): result["rate"] for result in baseline["results"]}
+    lines = []
+    for result in report["results"]:
+        key = (result["name"], json.dumps(result["parameters"]))
+        if key in previous:
+            change = 100.0 * (result["rate"] / previous[key] - 1.0)
+            lines.append(f"{result['name']} {key[1]}: {result['rate']:.0f}/s vs {previous[key]:.0f}/s ({change:+.1f}%)")
+    return lines
+
+
+def get_options(argv):
+    parser = argparse.ArgumentParser(description="Measure the throughput of the generators, serializers and senders")
+    parser.add_argument(
+        "--sizes",
+        default="10,100,1000,10000",
+        help="Numbers of PVs and AMQ programmes in the synthetic content, separated by commas",
+    )
+    parser.add_argument(
+        "--emissions",
+        type=int,
+        default=100000,
+        help="Number of messages or PV updates generated by each benchmark",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs of each benchmark, the best one is kept")
+    parser.add_argument("--output", "-o", default=None, help="JSON file for the results. Defaults to standard output")
+    parser.add_argument("--compare", default=None, help="JSON file of previous results to compare with")
+    options = parser.parse_args(argv)
+    return options
+
+
+def main(argv=None):
+    options = get_options(argv)
+    sizes = [int(size) for size in options.sizes.split(",")]
+    report = run_benchmarks(sizes, options.emissions, options.repeat)
+    if options.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if options.compare is not None:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        for line in compare(report, baseline):
+            print(line, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+r"""
+Loading of the content files of the broadcasters, one entry at a time.
+
+A content file maps each AMQ destination, or each SQL function of PV updates, to a list of entries
+(programmes or PVs). Content files are either JSON files, or JSON lines files (extension .ndjson or .jsonl),
+where every line is an object mapping keys to one entry, or to a list of entries:
+
+.. code-block:: json
+
+   {"pvUpdate": {"frequency": 10, "instrument": "HYSA", "name": "sinPV", "function": "100*math.sin({x}/3600)"}}
+
+JSON files larger than `STREAM_SIZE` are parsed incrementally, so the whole text and the whole document
+are never in memory at once. Smaller files are parsed at once with `json.load`, several times faster.
+
+The entries of a key appearing in several files, or several times in a file, are merged into one list.
+The keys and the short string values of the entries, like instrument names and functions repeated across
+entries, are shared instead of being stored once per entry.
+
+When the content is compiled for broadcasting, every entry becomes a `PV` or a `Programme`,
+a record storing its fields in slots, several times smaller than a dictionary.
+"""
+
+# standard imports
+import collections.abc
+import json
+import os
+import re
+import sys
+import time
+
+#: Extensions of JSON lines content files
+NDJSON_EXTENSIONS = (".ndjson", ".jsonl")
+
+#: Size in bytes above which JSON content files are parsed incrementally, one entry at a time
+STREAM_SIZE = 64 * 2**20
+
+# strings up to this length are interned
+_INTERN_LENGTH = 100
+
+_NOT_WHITESPACE = re.compile(r"[^ \t\n\r]")
+
+
+class ContentError(ValueError):
+    """Raised when a content file is not valid."""
+
+
+class Record(collections.abc.Mapping):
+    """
+    Content entry with fixed fields, stored in slots.
+
+    The fields are attributes, and records can also be read like the dictionaries of the content files,
+    e.g. `pv["name"]`, `{**pv}`, or `pv == {"frequency": 1, ...}`.
+    """
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __repr__(self):
+        fields = ", ".join(f"{key}={getattr(self, key)!r}" for key in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class PV(Record):
+    """
+    PV updated by an SQL function.
+
+    Parameters
+    ----------
+    frequency : float
+        Time between two updates, in seconds.
+    instrument : str
+        Name of the instrument.
+    name : str
+        Name of the PV.
+    function : Union[str, Callable[[float], object]]
+        Template of the function of the PV (see `webmonchow.pv.expressions`) or its compiled callable.
+    """
+
+    __slots__ = ("frequency", "instrument", "name", "function")
+
+    def __init__(self, frequency, instrument, name, function):
+        self.frequency = frequency
+        self.instrument = instrument
+        self.name = name
+        self.function = function
+
+
+class Programme(Record):
+    """
+    Message sent to an AMQ destination.
+
+    Parameters
+    ----------
+    frequency : float
+        Time between two messages, in seconds. If 0, the message is sent once.
+    message : Union[dict, bytes, webmonchow.amq.templates.MessageTemplate]
+        The message, its serialized JSON, or a template rendering it.
+    """
+
+    __slots__ = ("frequency", "message")
+
+    def __init__(self, frequency, message):
+        self.frequency = frequency
+        self.message = message
+
+
+class _JsonStream:
+    r"""Incremental parser of the values of a JSON text, reading the file in chunks."""
+
+    def __init__(self, f, chunk_size=1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self.f.read(self.chunk_size)
+        self.eof = not chunk
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+
+    def peek(self):
+        """Next character that is not whitespace, or "" at the end of the file."""
+        while True:
+            match = _NOT_WHITESPACE.search(self.buffer, self.pos)
+            if match is not None:
+                self.pos = match.start()
+                return self.buffer[self.pos]
+            self.pos = len(self.buffer)
+            if self.eof:
+                return ""
+            self._fill()
+
+    def expect(self, characters):
+        """Consume the next character that is not whitespace, which must be one of `characters`."""
+        character = self.peek()
+        if character == "" or character not in characters:
+            raise ContentError(f"expected one of {characters!r} but found {character or 'the end of the file'!r}")
+        self.pos += 1
+        return character
+
+    def value(self):
+        """Decode the next value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                if end < len(self.buffer) or self.eof:  # a number at the end of the buffer may go on
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError as e:
+                if self.eof:
+                    raise ContentError(str(e)) from e
+            self._fill()
+
+
+def _intern(entry, intern=sys.intern):
+    r"""Share the keys and the short string values of an entry with the other entries."""
+    if type(entry) is not dict:
+        return entry
+    return {
+        intern(key): intern(value) if type(value) is str and len(value) <= _INTERN_LENGTH else value
+        for key, value in entry.items()
+    }
+
+
+def iter_json(f, chunk_size=1 << 16):
+    """
+    Entries of a JSON content file, read one at a time.
+
+    Parameters
+    ----------
+    f : TextIO
+        The content file, open for reading.
+    chunk_size : int
+        Number of characters read from the file at once.
+
+    Yields
+    ------
+    tuple
+        The key (destination or SQL function) and each of its entries. A key whose value is not a list
+        yields the value as its only entry.
+
+    Raises
+    ------
+    ContentError
+        If the file is not a JSON object.
+    """
+    stream = _JsonStream(f, chunk_size)
+    stream.expect("{")
+    if stream.peek() == "}":
+        return
+    while True:
+        key = stream.value()
+        if not isinstance(key, str):
+            raise ContentError(f"expected a key but found {key!r}")
+        stream.expect(":")
+        if stream.peek() == "[":
+            stream.pos += 1
+            if stream.peek() == "]":
+                stream.pos += 1
+            else:
+                while True:
+                    yield key, stream.value()
+                    if stream.expect(",]") == "]":
+                        break
+        else:
+            yield key, stream.value()
+        if stream.expect(",}") == "}":
+            return
+
+
+def _intern_pairs(pairs, intern=sys.intern):
+    r"""Object of a JSON document sharing its short string values, like `_intern`. The decoder shares the keys."""
+    return {
+        key: intern(value) if type(value) is str and len(value) <= _INTERN_LENGTH else value for key, value in pairs
+    }
+
+
+def _load_json(f):
+    r"""Lists of entries of a JSON content file parsed at once, by key, merging the lists of a repeated key."""
+    top = []  # pairs of the object decoded last, the document itself once it's decoded
+
+    def object_pairs(pairs):
+        nonlocal top
+        top = pairs
+        return _intern_pairs(pairs)
+
+    try:
+        document = json.load(f, object_pairs_hook=object_pairs)
+    except json.JSONDecodeError as e:
+        raise ContentError(str(e)) from e
+    if not isinstance(document, dict):
+        raise ContentError("expected an object")
+    lists = {}
+    for key, entries in top:
+        lists.setdefault(key, []).extend(entries if isinstance(entries, list) else [entries])
+    return lists
+
+
+def iter_ndjson(f):
+    """
+    Entries of a JSON lines content file, read one line at a time.
+
+    Yields
+    ------
+    tuple
+        The key (destination or SQL function) and each of its entries.
+
+    Raises
+    ------
+    ContentError
+        If a line is not a JSON object.
+    """
+    for number, line in enumerate(f, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ContentError(f"line {number}: {e}") from e
+        if not isinstance(record, dict):
+            raise ContentError(f"line {number}: expected an object")
+        for key, entries in record.items():
+            for entry in entries if isinstance(entries, list) else [entries]:
+                yield key, entry
+
+
+def _peak_memory():
+    r"""Peak resident memory of the process, in bytes, or None where module `resource` doesn't exist (Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # kilobytes on Linux
+
+
+def _merge(data, f, filename, stream_size):
+    r"""Append the entries of an open content file to the lists of `data`, returning the number of entries."""
+    count = 0
+    ndjson = os.path.splitext(filename)[1] in NDJSON_EXTENSIONS
+    if not ndjson and os.path.getsize(filename) <= stream_size:
+        for key, entries in _load_json(f).items():
+            if entries:  # keys without entries are left out
+                data.setdefault(sys.intern(key), []).extend(entries)
+                count += len(entries)
+        return count
+    for key, entry in iter_ndjson(f) if ndjson else iter_json(f):
+        data.setdefault(sys.intern(key), []).append(_intern(entry))
+        count += 1
+    return count
+
+
+def load_contents(filenames, stream_size=STREAM_SIZE):
+    """
+    Reads and combines the entries of content files, merging the lists of entries of the same key.
+
+    Parameters
+    ----------
+    filenames : List[str]
+        Paths to JSON or JSON lines (.ndjson, .jsonl) content files.
+    stream_size : int
+        Size in bytes above which JSON files are parsed one entry at a time, see `iter_json`,
+        instead of at once with `json.load`.
+
+    Returns
+    -------
+    dict
+        A dictionary where each key is a destination or an SQL function, and each value the list of its entries
+        in all the files, in the order of the files. Keys without entries are left out.
+
+    Raises
+    ------
+    ContentError
+        If a file is not valid. The message includes the path of the file.
+    """
+    start = time.perf_counter()
+    data = {}
+    count = 0
+    for filename in filenames:
+        print(f"Loading {filename}")
+        with open(filename) as f:
+            try:
+                count += _merge(data, f, filename, stream_size)
+            except ContentError as e:
+                raise ContentError(f"{filename}: {e}") from e
+    elapsed = time.perf_counter() - start
+    peak = _peak_memory()
+    memory = "" if peak is None else f", peak memory {peak / 2**20:.0f} MB"
+    print(f"Loaded {count} entries of {len(data)} keys from {len(filenames)} files in {elapsed:.2f} s{memory}")
+    return data
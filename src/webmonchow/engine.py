@@ -0,0 +1,284 @@
+r"""
+Broadcast the AMQ feed and the PV feed from a single process, driven by one scheduler on one clock.
+
+The blocking STOMP and psycopg2 calls run in one executor thread per feed, so messages of a feed are sent in
+order, and a slow database never delays the AMQ messages (nor the other way around).
+"""
+
+# standard imports
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import os
+import time
+
+# webmonchow imports
+from webmonchow.amq import broadcast as amq
+from webmonchow.amq.templates import MessageTemplate
+from webmonchow.metrics import monitor
+from webmonchow.pv import broadcast as pv
+from webmonchow.pv.writers import send_updates
+from webmonchow.scenario import instrument_names, load_scenario, schedule_scenario
+from webmonchow.scheduler import Scheduler
+
+
+def schedule_contents(scheduler, amq_data, pv_data):
+    """
+    Add the AMQ programmes and the PVs to one scheduler.
+
+    Parameters
+    ----------
+    scheduler : webmonchow.scheduler.Scheduler
+        The scheduler to add the programmes and PVs to.
+    amq_data : dict
+        AMQ content, in the format accepted by `webmonchow.amq.broadcast.message_generator`.
+    pv_data : dict
+        PV content, in the format accepted by `webmonchow.pv.broadcast.pv_generator`.
+    """
+    for queue_or_topic, programmes in amq_data.items():
+        for programme in programmes:
+            scheduler.add(("amq", queue_or_topic, programme["message"]), programme["frequency"])
+    for sql_function, pvs in pv.compile_contents(pv_data).items():
+        for entry in pvs:
+            scheduler.add(("pv", sql_function, entry), entry.frequency)
+
+
+def _split(batch):
+    r"""Split a batch of the scheduler into AMQ messages and PV updates."""
+    messages = []
+    updates = []
+    for x, (feed, target, content) in batch:
+        if feed == "amq":
+            messages.append((target, content.render(x) if isinstance(content, MessageTemplate) else content))
+        else:
+            updates.append((target, content.instrument, content.name, content.function(x)))
+    return messages, updates
+
+
+async def broadcast(
+    amq_connection,
+    pv_connection,
+    amq_data,
+    pv_data,
+    max_delay=0.0,
+    queue_size=100,
+    scheduler=None,
+    metrics=None,
+    verbose=False,
+    scenario=None,
+):
+    """
+    Sends AMQ messages and PV updates as they come due, until no programme or PV remains scheduled.
+
+    Parameters
+    ----------
+    amq_connection : stomp.Connection
+        An active connection to the AMQ message broker.
+    pv_connection : psycopg2.extensions.connection
+        A connection object to the PostgreSQL database.
+    amq_data : dict
+        AMQ content, in the format accepted by `webmonchow.amq.broadcast.message_generator`.
+    pv_data : dict
+        PV content, in the format accepted by `webmonchow.pv.broadcast.pv_generator`.
+    max_delay : float
+        Maximum time a message or update is held back to be sent with later ones, in seconds.
+    queue_size : int
+        Maximum number of batches waiting to be sent, for each feed. The scheduler waits while a queue is full.
+    scheduler : Optional[webmonchow.scheduler.Scheduler]
+        The scheduler deciding when messages and updates are due. If None, a new scheduler on the wall clock is used.
+    metrics : Optional[webmonchow.metrics.Metrics]
+        If given, the messages and updates sent, the time to generate, send and commit them, and the depth of
+        the queues are observed.
+    verbose : bool
+        Print every AMQ message.
+    scenario : Optional[dict]
+        If given, the run lifecycles of the scenario (see `webmonchow.scenario`) are sent as well,
+        on the same schedule.
+    """
+    scheduler = Scheduler(metrics=metrics) if scheduler is None else scheduler
+    schedule_contents(scheduler, amq_data, pv_data)
+    if scenario is not None:
+        messages, updates = schedule_scenario(scheduler, scenario)
+        print(
+            f"Scenario of {len(instrument_names(scenario))} instruments, a run every {scenario['run_period']} s: "
+            f"{messages} messages and {updates} PV updates per run period"
+        )
+    pv_cursor = pv_connection.cursor()
+    amq_queue = asyncio.Queue(maxsize=queue_size)
+    pv_queue = asyncio.Queue(maxsize=queue_size)
+    with (
+        concurrent.futures.ThreadPoolExecutor(1, "amq") as amq_executor,
+        concurrent.futures.ThreadPoolExecutor(1, "pv") as pv_executor,
+    ):
+        amq_sender = asyncio.create_task(
+            _sender(
+                amq_queue,
+                amq_executor,
+                functools.partial(amq.broadcast, amq_connection, metrics=metrics, verbose=verbose),
+            )
+        )
+        pv_sender = asyncio.create_task(
+            _sender(pv_queue, pv_executor, lambda item: send_updates(pv_connection, pv_cursor, *item, metrics))
+        )
+        try:
+            async for batch in scheduler.abatches(max_delay):
+                start = time.perf_counter()
+                messages, updates = _split(batch)
+                if metrics is not None:
+                    metrics.generate.observe(time.perf_counter() - start)
+                if messages:
+                    await _put(amq_queue, messages, amq_sender, metrics)
+                if updates:
+                    await _put(pv_queue, (updates, int(time.time())), pv_sender, metrics)
+            await _put(amq_queue, None, amq_sender, None)
+            await _put(pv_queue, None, pv_sender, None)
+            await asyncio.gather(amq_sender, pv_sender)
+        finally:
+            amq_sender.cancel()
+            pv_sender.cancel()
+
+
+async def _put(queue, item, sender, metrics):
+    r"""Queue an item for a sender, waiting while the queue is full. Raises the error of the sender if it stopped."""
+    if metrics is not None:
+        metrics.queue_depth.observe(queue.qsize())
+    put = asyncio.ensure_future(queue.put(item))
+    await asyncio.wait([put, sender], return_when=asyncio.FIRST_COMPLETED)
+    if not put.done():
+        put.cancel()
+        sender.result()
+
+
+async def _sender(queue, executor, send):
+    r"""Send the items of one feed, one at a time in the executor of the feed, until getting None."""
+    loop = asyncio.get_running_loop()
+    while (item := await queue.get()) is not None:
+        await loop.run_in_executor(executor, send, item)
+
+
+def get_options(argv):
+    parser = argparse.ArgumentParser(description="Broadcast AMQ messages and PV updates from a single process")
+    parser.add_argument("--amq-user", dest="amq_user", default=os.getenv("ICAT_USER", "icat"))
+    parser.add_argument("--amq-password", dest="amq_password", default=os.getenv("ICAT_PASS", "icat"))
+    parser.add_argument("--broker", "-b", dest="broker", default=os.getenv("BROKER", "localhost:61613"))
+    parser.add_argument(
+        "--content-files",
+        dest="content_files",
+        default=",".join(amq.service_content_files()),
+        help="List of AMQ content files to broadcast, separated by commas",
+    )
+    parser.add_argument("--db-user", dest="db_user", default=os.getenv("DATABASE_USER", "postgres"))
+    parser.add_argument("--db-password", dest="db_password", default=os.getenv("DATABASE_PASS", "postgres"))
+    parser.add_argument("--host", dest="host", default=os.getenv("DATABASE_HOST", "localhost"))
+    parser.add_argument("--port", dest="port", default=os.getenv("DATABASE_PORT", "5432"))
+    parser.add_argument("--database-name", dest="database", default=os.getenv("DATABASE_NAME", "workflow"))
+    parser.add_argument(
+        "--pv-files",
+        dest="pv_files",
+        default=",".join(pv.service_content_files()),
+        help="List of PV content files to broadcast, separated by commas",
+    )
+    parser.add_argument(
+        "--max-delay",
+        type=float,
+        default=0.0,
+        help="Maximum time (seconds) a message or PV update is held back to be sent with later ones",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=100,
+        help="Maximum number of batches waiting to be sent, for each feed",
+    )
+    parser.add_argument(
+        "--report-interval",
+        type=float,
+        default=10.0,
+        help="Time (seconds) between two summaries of the metrics. If 0, no summary is printed",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve the metrics in the Prometheus text format on this port of the local host",
+    )
+    parser.add_argument(
+        "--scenario",
+        default=None,
+        help="Scenario file of run lifecycles to send as well, or the name of a scenario shipped with webmonchow, "
+        "e.g. 'runs'",
+    )
+    parser.add_argument(
+        "--instruments",
+        type=int,
+        default=None,
+        help="Number of simulated instruments of the scenario, instead of the number in the scenario file",
+    )
+    parser.add_argument(
+        "--run-period",
+        type=float,
+        default=None,
+        help="Time (seconds) between two runs of an instrument, instead of the run period of the scenario file",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed for the random numbers of the PV functions, each PV drawing from its own stream",
+    )
+    parser.add_argument(
+        "--no-prepare",
+        dest="prepare",
+        action="store_false",
+        help="Call the SQL functions in every statement, instead of preparing a statement for each of them "
+        "when connecting",
+    )
+    parser.add_argument("--verbose", "-v", action="store_true", help="Print every AMQ message")
+    options = parser.parse_args(argv)
+    if options.scenario is None and (options.instruments is not None or options.run_period is not None):
+        parser.error("--instruments and --run-period require --scenario")
+    return options
+
+
+def _scenario(options):
+    r"""The scenario of the options, with the number of instruments, the run period and the seed of the command line."""
+    if options.scenario is None:
+        return None
+    scenario = load_scenario(options.scenario)
+    if options.instruments is not None:
+        scenario["instruments"] = options.instruments
+    if options.run_period is not None:
+        scenario["run_period"] = options.run_period
+    if options.seed is not None:
+        scenario["seed"] = options.seed
+    return scenario
+
+
+def main(argv=None):
+    options = get_options(argv)
+    amq_data = amq.serialize_contents(amq.read_contents([f.strip() for f in options.content_files.split(",")]))
+    pv_data = pv.compile_contents(pv.read_contents([f.strip() for f in options.pv_files.split(",")]), options.seed)
+    scenario = _scenario(options)
+    amq_connection = amq.connect_to_broker(options.broker, options.amq_user, options.amq_password)
+    pv_connection = pv.connect_to_database(
+        options.database, options.db_user, options.db_password, options.host, options.port, prepare=options.prepare
+    )
+    metrics = monitor(options.report_interval, options.metrics_port)
+    asyncio.run(
+        broadcast(
+            amq_connection,
+            pv_connection,
+            amq_data,
+            pv_data,
+            options.max_delay,
+            options.queue_size,
+            metrics=metrics,
+            verbose=options.verbose,
+            scenario=scenario,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
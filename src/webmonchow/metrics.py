@@ -0,0 +1,352 @@
+r"""
+Throughput and latency instrumentation of the broadcasters.
+
+A `Metrics` object gathers counters and histograms of the time spent generating messages, sending them,
+waiting for their receipt, committing them, how late the scheduler fired, and how many batches waited in the queues.
+`Reporter` prints a summary line of the latest interval periodically, and `serve_metrics` exposes
+the cumulative values in the Prometheus text format over HTTP.
+"""
+
+# standard imports
+import bisect
+import http.server
+import threading
+
+#: Upper bounds of the buckets of histograms of durations, in seconds, from 1µs to 10s
+TIME_BUCKETS = tuple(m * 10.0**e for e in range(-6, 1) for m in (1, 2.5, 5)) + (10.0,)
+
+#: Upper bounds of the buckets of histograms of queue depths
+DEPTH_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Counter:
+    """
+    Monotonically increasing count.
+
+    Parameters
+    ----------
+    name : str
+        Name of the metric, without the "webmonchow_" prefix.
+    documentation : str
+        Description of the metric.
+    """
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+        self._reported = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """Increase the count by `amount`."""
+        with self._lock:
+            self.value += amount
+
+    def window(self):
+        """Increase of the count since the previous call."""
+        with self._lock:
+            value, self._reported = self.value - self._reported, self.value
+        return value
+
+    def exposition(self):
+        """Lines of the Prometheus text format for the counter."""
+        name = f"webmonchow_{self.name}"
+        return [f"# HELP {name} {self.documentation}", f"# TYPE {name} counter", f"{name} {self.value}"]
+
+
+class Histogram:
+    """
+    Distribution of observed values, counted in buckets of fixed upper bounds.
+
+    Besides the cumulative counts exposed to Prometheus, the histogram keeps the counts since the
+    previous call to `window`, for periodic summaries.
+
+    Parameters
+    ----------
+    name : str
+        Name of the metric, without the "webmonchow_" prefix.
+    documentation : str
+        Description of the metric.
+    buckets : Sequence[float]
+        Increasing upper bounds of the buckets. Values above the last bound are counted in an extra bucket.
+    unit : str
+        "seconds" for durations, formatted in µs, ms or s in summaries, or "" for counts.
+    """
+
+    def __init__(self, name, documentation, buckets=TIME_BUCKETS, unit="seconds"):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.unit = unit
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self._window = [0] * (len(self.buckets) + 1)
+        self._window_sum = 0.0
+        self._window_max = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def count(self):
+        """Number of observations."""
+        return sum(self.counts)
+
+    def observe(self, value):
+        """Count one observation of `value`."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self._window[index] += 1
+            self.sum += value
+            self._window_sum += value
+            if value > self._window_max:
+                self._window_max = value
+
+    def drain(self):
+        """
+        Counts per bucket, sum, and maximum of the observations since the previous call to `drain` or `window`.
+        """
+        with self._lock:
+            drained = self._window, self._window_sum, self._window_max
+            self._window = [0] * len(self.counts)
+            self._window_sum = 0.0
+            self._window_max = 0.0
+        return drained
+
+    def merge(self, counts, total, maximum):
+        """Add the observations drained from a histogram with the same buckets, e.g. in another process."""
+        with self._lock:
+            for index, count in enumerate(counts):
+                self.counts[index] += count
+                self._window[index] += count
+            self.sum += total
+            self._window_sum += total
+            self._window_max = max(self._window_max, maximum)
+
+    def window(self):
+        """
+        Statistics of the observations since the previous call.
+
+        Returns
+        -------
+        Optional[tuple]
+            Median, 99th percentile and maximum, or None if there was no observation.
+            Percentiles are the upper bound of the bucket they fall in, never more than the maximum.
+        """
+        counts, _, maximum = self.drain()
+        total = sum(counts)
+        if total == 0:
+            return None
+        quantiles = []
+        for q in (0.5, 0.99):
+            rank = q * total
+            cumulative = 0
+            for bound, count in zip(self.buckets + (maximum,), counts):
+                cumulative += count
+                if cumulative >= rank:
+                    quantiles.append(min(bound, maximum))
+                    break
+        return quantiles[0], quantiles[1], maximum
+
+    def exposition(self):
+        """Lines of the Prometheus text format for the histogram."""
+        name = f"webmonchow_{self.name}"
+        lines = [f"# HELP {name} {self.documentation}", f"# TYPE {name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound:g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.sum:g}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+    def format(self, value):
+        """Format a value in the unit of the histogram."""
+        if self.unit != "seconds":
+            return f"{value:g}"
+        if value < 1e-3:
+            return f"{value * 1e6:.0f}µs"
+        if value < 1.0:
+            return f"{value * 1e3:.1f}ms"
+        return f"{value:.2f}s"
+
+
+class Metrics:
+    """
+    The metrics of a broadcaster.
+
+    Attributes
+    ----------
+    messages : Counter
+        Messages and PV updates sent.
+    dropped : Counter
+        Messages and PV updates dropped during outages of the broker or the database, see `webmonchow.outage`.
+    late : Counter
+        Messages and PV updates held during outages, then sent late.
+    generate : Histogram
+        Time to generate a message, a PV update, or a batch of them.
+    send : Histogram
+        Time to send a message to the broker, or to execute the statement of PV updates.
+    ack : Histogram
+        Time between sending a message with a receipt header and receiving its receipt from the broker.
+    commit : Histogram
+        Time to commit PV updates.
+    lag : Histogram
+        Time between the deadline of a message or PV update and the moment it fires, in seconds of the scheduler clock.
+    queue_depth : Histogram
+        Number of batches waiting in the queue of a writer or a feed, observed when a batch is queued.
+    """
+
+    def __init__(self):
+        self.messages = Counter("messages_total", "Messages and PV updates sent")
+        self.dropped = Counter("dropped_total", "Messages and PV updates dropped during outages")
+        self.late = Counter("late_total", "Messages and PV updates held during outages, then sent late")
+        self.generate = Histogram("generate_seconds", "Time to generate a message, a PV update, or a batch")
+        self.send = Histogram("send_seconds", "Time to send a message, or to execute the statement of PV updates")
+        self.ack = Histogram("ack_seconds", "Time between sending a message and receiving its receipt")
+        self.commit = Histogram("commit_seconds", "Time to commit PV updates")
+        self.table = Histogram("table_seconds", "Time to write and commit PV updates straight into the PV tables")
+        self.lag = Histogram("scheduler_lag_seconds", "Time between the deadline of a message and its firing")
+        self.queue_depth = Histogram("queue_depth", "Batches waiting to be sent", buckets=DEPTH_BUCKETS, unit="")
+
+    def histograms(self):
+        """The histograms, in the order of the summary."""
+        return [self.generate, self.send, self.ack, self.commit, self.table, self.lag, self.queue_depth]
+
+    def summary(self, interval):
+        """
+        One line summarizing the metrics since the previous summary.
+
+        Parameters
+        ----------
+        interval : float
+            Time since the previous summary, in seconds, to compute the rate of messages.
+        """
+        count = self.messages.window()
+        parts = [f"{count} sent ({count / interval:.1f}/s)"]
+        dropped, late = self.dropped.window(), self.late.window()
+        if dropped or late:
+            parts[0] += f", {dropped} dropped, {late} late"
+        for histogram in self.histograms():
+            statistics = histogram.window()
+            if statistics is not None:
+                median, p99, maximum = (histogram.format(value) for value in statistics)
+                parts.append(f"{histogram.name} p50 {median} p99 {p99} max {maximum}")
+        return " | ".join(parts)
+
+    def drain(self):
+        """
+        The messages sent and the observations since the previous call, to be merged into the metrics of another
+        process with `merge`. The summaries of these metrics no longer include them.
+        """
+        return {
+            "messages": self.messages.window(),
+            "dropped": self.dropped.window(),
+            "late": self.late.window(),
+            "histograms": [h.drain() for h in self.histograms()],
+        }
+
+    def merge(self, drained):
+        """Add the messages and observations drained from metrics in another process."""
+        self.messages.inc(drained["messages"])
+        self.dropped.inc(drained["dropped"])
+        self.late.inc(drained["late"])
+        for histogram, (counts, total, maximum) in zip(self.histograms(), drained["histograms"]):
+            histogram.merge(counts, total, maximum)
+
+    def exposition(self):
+        """The metrics in the Prometheus text format."""
+        lines = self.messages.exposition() + self.dropped.exposition() + self.late.exposition()
+        for histogram in self.histograms():
+            lines.extend(histogram.exposition())
+        return "\n".join(lines) + "\n"
+
+
+class Reporter(threading.Thread):
+    """
+    Thread printing a summary of the metrics every `interval` seconds, until stopped.
+
+    Parameters
+    ----------
+    metrics : Metrics
+        The metrics to summarize.
+    interval : float
+        Time between two summaries, in seconds.
+    """
+
+    def __init__(self, metrics, interval=10.0):
+        super().__init__(name="metrics-reporter", daemon=True)
+        self.metrics = metrics
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            print(self.metrics.summary(self.interval))
+
+    def stop(self):
+        """Stop printing summaries."""
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+
+
+def serve_metrics(metrics, port, host="127.0.0.1"):
+    """
+    Serve the metrics in the Prometheus text format over HTTP, from a daemon thread.
+
+    Parameters
+    ----------
+    metrics : Metrics
+        The metrics to serve.
+    port : int
+        The port to listen on. If 0, a free port is picked, see `server.server_address`.
+    host : str
+        The address to listen on. Defaults to the local host only.
+
+    Returns
+    -------
+    http.server.ThreadingHTTPServer
+        The server, to be stopped with `shutdown()`.
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):  # noqa: N802 name defined by BaseHTTPRequestHandler
+            body = metrics.exposition().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # noqa: A002 signature of BaseHTTPRequestHandler
+            pass  # don't print every scrape
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+
+def monitor(interval=10.0, port=None):
+    """
+    Create the metrics of a broadcaster, printing their summary and serving them as requested on the command line.
+
+    Parameters
+    ----------
+    interval : float
+        Time between two summaries, in seconds. If 0, no summary is printed.
+    port : Optional[int]
+        If given, the port where the metrics are served in the Prometheus text format.
+
+    Returns
+    -------
+    Metrics
+        The new metrics.
+    """
+    metrics = Metrics()
+    if interval > 0:
+        Reporter(metrics, interval).start()
+    if port is not None:
+        serve_metrics(metrics, port)
+    return metrics
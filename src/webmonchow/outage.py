@@ -0,0 +1,254 @@
+r"""
+Keep broadcasting through outages of the broker or the database.
+
+A `Delivery` sends messages or PV updates through a connection. When the connection is lost, it keeps taking
+the messages that come due, holding them in an `OutageBuffer`, and attempts to reconnect with exponential backoff
+between two messages. Once reconnected, it sends the held messages first, in order, then the new ones.
+
+The buffer is bounded, in memory or spilling to a file. When it's full, its policy decides what happens:
+
+- "drop-oldest": the oldest message held is dropped to make room for the new one.
+- "drop-newest": the new message is dropped.
+- "block": the broadcaster waits until it reconnects, holding up the schedule, whose lag then grows.
+
+Dropped messages, and messages sent late because they were held during an outage, are counted in the metrics,
+so the throughput delivered to WebMon during chaos tests is known exactly.
+"""
+
+# standard imports
+import collections
+import os
+import pickle
+import time
+
+#: Initial and maximum time between two attempts to reconnect, in seconds
+BACKOFF = (1.0, 60.0)
+
+#: What to do with a new message when the buffer of an outage is full
+OVERFLOW_POLICIES = ("drop-oldest", "drop-newest", "block")
+
+
+class OutageBuffer:
+    """
+    Bounded first-in first-out buffer of the messages held while disconnected.
+
+    Parameters
+    ----------
+    size : int
+        Maximum number of messages held. With 0, nothing is held: messages are dropped, or the broadcaster
+        blocks, as soon as the connection is lost.
+    policy : str
+        What to do with a new message when the buffer is full, one of `OVERFLOW_POLICIES`.
+    spill : Optional[str]
+        If given, the file where the messages beyond the first `memory_size` are written, so that
+        a large buffer doesn't hold its messages in memory. The file is removed when the buffer is closed.
+    memory_size : int
+        Maximum number of messages held in memory when spilling to a file.
+    """
+
+    def __init__(self, size=10000, policy="drop-oldest", spill=None, memory_size=1000):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"unknown overflow policy {policy!r}, expected one of {', '.join(OVERFLOW_POLICIES)}")
+        self.size = size
+        self.policy = policy
+        self.spill = spill
+        self.memory_size = size if spill is None else memory_size
+        self._memory = collections.deque()
+        self._file = None if spill is None else open(spill, "w+b")
+        self._spilled = 0  # messages in the file
+        self._read = 0  # offset of the oldest message in the file
+
+    def __len__(self):
+        return len(self._memory) + self._spilled
+
+    def full(self):
+        """Whether the buffer holds `size` messages."""
+        return len(self) >= self.size
+
+    def append(self, item):
+        """Hold a message, after all the others. The buffer must not be full."""
+        # messages in memory are always older than the spilled ones
+        if self._spilled == 0 and len(self._memory) < self.memory_size:
+            self._memory.append(item)
+            return
+        self._file.seek(0, os.SEEK_END)
+        pickle.dump(item, self._file)
+        self._spilled += 1
+
+    def peek(self):
+        """The oldest message held. The buffer must not be empty."""
+        if self._memory:
+            return self._memory[0]
+        self._file.seek(self._read)
+        return pickle.load(self._file)
+
+    def popleft(self):
+        """Remove and return the oldest message held. The buffer must not be empty."""
+        if self._memory:
+            return self._memory.popleft()
+        self._file.seek(self._read)
+        item = pickle.load(self._file)
+        self._spilled -= 1
+        self._read = self._file.tell()
+        if self._spilled == 0:
+            self._file.seek(0)
+            self._file.truncate()
+            self._read = 0
+        return item
+
+    def close(self):
+        """Forget the messages held, and remove the spill file."""
+        self._memory.clear()
+        self._spilled = 0
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self.spill)
+
+
+class Delivery:
+    """
+    Sends messages through a connection, reconnecting and holding the messages in a buffer while disconnected.
+
+    Parameters
+    ----------
+    connection : object
+        The current connection, or None to connect before sending the first message.
+    send : Callable[[object, object], None]
+        Sends a message through a connection, raising one of `errors` if the connection is lost.
+    errors : tuple
+        Exceptions raised by `send` and `connect` when the connection is lost or can't be opened.
+    connect : Optional[Callable[[], object]]
+        Opens a new connection, making one attempt. If None, the errors of a lost connection are raised,
+        as without a `Delivery`.
+    close : Optional[Callable[[object], None]]
+        Closes a lost connection, without raising.
+    buffer : Optional[OutageBuffer]
+        Holds the messages while disconnected. Defaults to an `OutageBuffer` with the default size and policy.
+    backoff : tuple
+        Initial and maximum time between two attempts to reconnect, in seconds. The time doubles after
+        every failed attempt.
+    metrics : Optional[webmonchow.metrics.Metrics]
+        If given, the messages dropped, and the messages sent late after an outage, are counted.
+    size : Optional[Callable[[object], int]]
+        Number of messages or PV updates in a message, e.g. `len` for batches. Defaults to one.
+    name : str
+        Name of the connection, in the messages printed.
+    """
+
+    def __init__(
+        self,
+        connection,
+        send,
+        errors,
+        connect=None,
+        close=None,
+        buffer=None,
+        backoff=BACKOFF,
+        metrics=None,
+        size=None,
+        name="connection",
+    ):
+        self.connection = connection
+        self._send_through = send
+        self.errors = errors
+        self.connect = connect
+        self._close = close
+        self.buffer = OutageBuffer() if buffer is None else buffer
+        self.backoff = backoff
+        self.metrics = metrics
+        self.size = size
+        self.name = name
+        self.dropped = 0  # messages dropped while disconnected
+        self.late = 0  # messages held during an outage, then sent
+        self._delay = backoff[0]
+        self._next_attempt = 0.0  # time of the next attempt to reconnect, on the monotonic clock
+
+    def send(self, item):
+        """
+        Send a message, after the messages held. If disconnected, attempt to reconnect when the backoff allows,
+        else hold the message, see `OutageBuffer`.
+        """
+        if self.connection is None and time.monotonic() >= self._next_attempt:
+            self._reconnect()
+        if self.connection is not None and self._flush() and self._try(item):
+            return
+        self._hold(item)
+
+    def close(self):
+        """Send the messages held if connected, and print the messages dropped and sent late."""
+        if self.connection is not None:
+            self._flush()
+        while self.buffer:  # still disconnected, the messages held are lost
+            self._drop(self._count(self.buffer.popleft()))
+        self.buffer.close()
+        if self.dropped or self.late:
+            print(f"{self.name}: {self.dropped} dropped and {self.late} sent late during outages")
+
+    def _try(self, item):
+        r"""Send a message through the current connection. Returns False if the connection was lost."""
+        try:
+            self._send_through(self.connection, item)
+            return True
+        except self.errors as e:
+            if self.connect is None:
+                raise
+            print(f"{self.name} lost its connection: {e}")
+            if self._close is not None:
+                self._close(self.connection)
+            self.connection = None
+            self._delay = self.backoff[0]
+            self._next_attempt = time.monotonic()
+            return False
+
+    def _reconnect(self):
+        r"""Make one attempt to reconnect, waiting longer before the next one if it fails."""
+        try:
+            self.connection = self.connect()
+            print(f"{self.name} reconnected, sending {len(self.buffer)} held messages")
+        except self.errors as e:
+            print(f"{self.name} failed to reconnect, next attempt in {self._delay:g} s: {e}")
+            self._next_attempt = time.monotonic() + self._delay
+            self._delay = min(2.0 * self._delay, self.backoff[1])
+
+    def _flush(self):
+        r"""Send the messages held, in order. Returns False if the connection was lost meanwhile."""
+        while self.buffer:
+            if not self._try(self.buffer.peek()):
+                return False
+            self._count_late(self.buffer.popleft())
+        return True
+
+    def _hold(self, item):
+        r"""Hold a message while disconnected, applying the policy of the buffer when it's full."""
+        while self.buffer.full():
+            if self.buffer.policy == "drop-newest":
+                self._drop(self._count(item))
+                return
+            if self.buffer.policy == "drop-oldest" and self.buffer:
+                self._drop(self._count(self.buffer.popleft()))
+                continue
+            if self.buffer.policy == "drop-oldest":  # nothing held to drop
+                self._drop(self._count(item))
+                return
+            # block until reconnected
+            time.sleep(max(self._next_attempt - time.monotonic(), 0.0))
+            self._reconnect()
+            if self.connection is not None and self._flush() and self._try(item):
+                self._count_late(item)
+                return
+        self.buffer.append(item)
+
+    def _drop(self, count):
+        self.dropped += count
+        if self.metrics is not None:
+            self.metrics.dropped.inc(count)
+
+    def _count(self, item):
+        return 1 if self.size is None else self.size(item)
+
+    def _count_late(self, item):
+        count = self._count(item)
+        self.late += count
+        if self.metrics is not None:
+            self.metrics.late.inc(count)
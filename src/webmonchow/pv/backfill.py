@@ -0,0 +1,275 @@
+r"""
+Backfill the PV tables of WebMon with the history of the PVs of content files.
+
+The values of the PVs are generated over a time range, without sleeping, with the timestamp each update
+would have had. The first update of each PV goes through its SQL function, as in `webmonchow.pv.broadcast`,
+so the database registers the instrument and the name of the PV. The other updates are streamed into
+the tables of the PV history with `COPY FROM STDIN`, never holding the history in memory.
+If the tables can't be copied into, the updates are sent through the SQL functions, in batches.
+"""
+
+# standard imports
+import argparse
+import datetime
+import functools
+import itertools
+import os
+import time
+
+# third party imports
+import psycopg2
+
+# webmonchow imports
+from webmonchow.pv.broadcast import (
+    compile_contents,
+    connect_to_database,
+    pv_generator,
+    read_contents,
+    service_content_files,
+)
+from webmonchow.pv.writers import COLUMNS, TABLES, RowStream, pv_ids, update_statements
+from webmonchow.scheduler import Scheduler, SimulatedClock
+
+
+def history(data, start, end, offset=0.0):
+    """
+    Generates the updates of PVs between two times, as fast as they are consumed.
+
+    Parameters
+    ----------
+    data : dict
+        A dictionary where each key is the name of an SQL function and each value is a list of PVs,
+        in the format accepted by `webmonchow.pv.broadcast.pv_generator`.
+    start : float
+        Time of the first updates, in seconds since the epoch.
+    end : float
+        Time after which PVs are no longer updated, in seconds since the epoch.
+    offset : float
+        Value of `x` passed to the functions of the PVs at time `start`.
+
+    Yields
+    ------
+    tuple
+        The SQL function name, instrument, name, value, and timestamp (integer seconds since the epoch) of each
+        update, in order of time. The first update of every PV comes first.
+    """
+    clock = SimulatedClock(offset=offset, sleep=False)
+    scheduler = Scheduler(clock, end=offset + end - start)
+    for update in pv_generator(data, scheduler):
+        yield (*update, int(start + clock.now() - offset))
+
+
+def send_history(conn, cursor, updates, batch_size=1000):
+    """
+    Sends timestamped PV updates through their SQL functions, in batches of one round trip and one commit.
+    The prepared statements of the connection are executed, if any, see `webmonchow.pv.writers.prepare_statements`.
+
+    Parameters
+    ----------
+    conn : psycopg2.extensions.connection
+        A connection object to the PostgreSQL database.
+    cursor : psycopg2.extensions.cursor
+        A cursor of the connection.
+    updates : Iterable[tuple]
+        Tuples containing the SQL function name, instrument, PV name, value, and timestamp, such as `history`.
+    batch_size : int
+        Number of updates sent in one round trip.
+
+    Returns
+    -------
+    int
+        The number of updates sent.
+    """
+    count = 0
+    updates = iter(updates)
+    while True:
+        statements = update_statements(conn, cursor, itertools.islice(updates, batch_size))
+        if not statements:
+            return count
+        cursor.execute(b";".join(statements))
+        conn.commit()
+        count += len(statements)
+
+
+def copy_history(conn, cursor, table, updates, pvs):
+    """
+    Copies PV updates into a table of the PV history, streaming them from a generator.
+
+    Parameters
+    ----------
+    conn : psycopg2.extensions.connection
+        A connection object to the PostgreSQL database.
+    cursor : psycopg2.extensions.cursor
+        A cursor of the connection.
+    table : str
+        The table of the PV history, a value of `webmonchow.pv.writers.TABLES`.
+    updates : Iterable[tuple]
+        Updates of the PVs, from `history`.
+    pvs : list
+        The PVs of the updates, already registered in the database by an update through their SQL function.
+
+    Returns
+    -------
+    int
+        The number of updates copied.
+
+    Raises
+    ------
+    psycopg2.Error
+        If the table can't be copied into. The transaction is rolled back.
+    """
+    try:
+        ids = pv_ids(cursor, [(pv["instrument"], pv["name"]) for pv in pvs])
+        rows = RowStream((*ids[(inst, name)], value, 0, timestamp) for _, inst, name, value, timestamp in updates)
+        cursor.copy_expert(f"COPY {table} {COLUMNS} FROM STDIN", rows)
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+    return rows.count
+
+
+def backfill(conn, data, start, end, offset=0.0, method="copy", batch_size=1000, seed=None):
+    """
+    Backfills the history of PVs between two times.
+
+    Parameters
+    ----------
+    conn : psycopg2.extensions.connection
+        A connection object to the PostgreSQL database.
+    data : dict
+        PV content, in the format accepted by `webmonchow.pv.broadcast.pv_generator`.
+    start : float
+        Time of the first updates, in seconds since the epoch.
+    end : float
+        Time of the last updates, in seconds since the epoch.
+    offset : float
+        Value of `x` passed to the functions of the PVs at time `start`.
+    method : str
+        "copy" to copy the updates into the history tables, falling back to the SQL functions if that fails,
+        or "function" to send all the updates through the SQL functions.
+    batch_size : int
+        Number of updates sent through the SQL functions in one round trip.
+    seed : Optional[int]
+        If given, the seed of the random numbers of the PV functions, see `webmonchow.pv.broadcast.compile_contents`.
+
+    Returns
+    -------
+    int
+        The number of updates sent.
+    """
+    compile_contents(data)  # report invalid functions before sending anything
+    cursor = conn.cursor()
+    total = 0
+    for sql_function, pvs in data.items():
+        begin = time.monotonic()
+        # compiled anew for every pass over the history, so seeded functions repeat the same values
+        updates = history(compile_contents({sql_function: pvs}, seed), start, end, offset)
+        how = f"sent through {sql_function}"
+        if method == "copy" and sql_function in TABLES:
+            # the first update of each PV registers its instrument and name, which the copied rows refer to
+            count = send_history(conn, cursor, itertools.islice(updates, len(pvs)), batch_size)
+            try:
+                count += copy_history(conn, cursor, TABLES[sql_function], updates, pvs)
+                how = f"copied into {TABLES[sql_function]}"
+            except psycopg2.Error as e:
+                print(f"Failed to copy into {TABLES[sql_function]}, sending updates through {sql_function}: {e}")
+                updates = history(compile_contents({sql_function: pvs}, seed), start, end, offset)
+                updates = itertools.islice(updates, len(pvs), None)
+                count += send_history(conn, cursor, updates, batch_size)
+        else:
+            count = send_history(conn, cursor, updates, batch_size)
+        elapsed = time.monotonic() - begin
+        print(f"{count} updates of {len(pvs)} PVs {how} in {elapsed:.1f} s ({count / max(elapsed, 1e-9):.0f}/s)")
+        total += count
+    return total
+
+
+def _timestamp(text):
+    r"""Seconds since the epoch of an ISO 8601 date and time, in local time unless it has a time zone."""
+    try:
+        return datetime.datetime.fromisoformat(text).timestamp()
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e)) from e
+
+
+def get_options(argv):
+    parser = argparse.ArgumentParser(description="Backfill the history of the PVs of content files")
+    parser.add_argument("--user", dest="user", default=os.getenv("DATABASE_USER", "postgres"))
+    parser.add_argument("--password", dest="password", default=os.getenv("DATABASE_PASS", "postgres"))
+    parser.add_argument("--host", dest="host", default=os.getenv("DATABASE_HOST", "localhost"))
+    parser.add_argument("--port", dest="port", default=os.getenv("DATABASE_PORT", "5432"))
+    parser.add_argument("--database-name", dest="database", default=os.getenv("DATABASE_NAME", "workflow"))
+    parser.add_argument(
+        "--pv-files",
+        dest="pv_files",
+        default=",".join(service_content_files()),
+        help="List of content files to backfill, separated by commas",
+    )
+    parser.add_argument(
+        "--start",
+        type=_timestamp,
+        default=None,
+        help="Date and time of the first updates, e.g. 2024-01-31T08:00. Defaults to one day before the end",
+    )
+    parser.add_argument(
+        "--end",
+        type=_timestamp,
+        default=None,
+        help="Date and time of the last updates, e.g. 2024-02-01T08:00. Defaults to now",
+    )
+    parser.add_argument(
+        "--time-offset",
+        dest="time_offset",
+        type=float,
+        default=0.0,
+        help="Value of {x} at the start, in seconds",
+    )
+    parser.add_argument(
+        "--method",
+        choices=["copy", "function"],
+        default="copy",
+        help="Copy the updates into the PV tables, or send them through the SQL functions",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="Number of updates sent through the SQL functions in one round trip",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed for the random numbers of the PV functions, each PV drawing from its own stream",
+    )
+    parser.add_argument(
+        "--no-prepare",
+        dest="prepare",
+        action="store_false",
+        help="Call the SQL functions in every statement, instead of preparing a statement for each of them "
+        "when connecting",
+    )
+    options = parser.parse_args(argv)
+    return options
+
+
+def main(argv=None):
+    options = get_options(argv)
+    end = time.time() if options.end is None else options.end
+    start = end - 86400.0 if options.start is None else options.start
+    data = read_contents([f.strip() for f in options.pv_files.split(",")])
+    connect = functools.partial(
+        connect_to_database,
+        options.database,
+        options.user,
+        options.password,
+        options.host,
+        options.port,
+        prepare=options.prepare,
+    )
+    backfill(connect(), data, start, end, options.time_offset, options.method, options.batch_size, options.seed)
+
+
+if __name__ == "__main__":
+    main()
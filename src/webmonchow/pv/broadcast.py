@@ -1,16 +1,38 @@
 # standard imports
 import argparse
+import collections
+import contextlib
+import functools
 import glob
-import json
-import math  # noqa: F401
 import os
-import random  # noqa: F401
 import time
 from typing import List
 
 # third party imports
 import psycopg2
 
+# webmonchow imports
+from webmonchow.contents import PV, load_contents
+from webmonchow.metrics import monitor
+from webmonchow.outage import BACKOFF, OVERFLOW_POLICIES, Delivery, OutageBuffer
+from webmonchow.pv.expressions import ExpressionError, compile_function, seeded_names
+from webmonchow.pv.writers import (
+    CONNECTION_ERRORS,
+    WRITE_PATHS,
+    broadcast_sharded,
+    check_functions,
+    close_connection,
+    prepare_statements,
+    send_updates,
+    update_sender,
+    update_template,
+)
+from webmonchow.rate import WarpedClock, natural_rate, profile_argument, report_rate
+from webmonchow.recording import replay_updates
+from webmonchow.scheduler import Scheduler, SimulatedClock
+from webmonchow.sinks import NdjsonFile, NullDatabaseConnection, RecorderConnection, SinkStats
+from webmonchow.workers import partition_pvs, run_workers
+
 
 def service_content_files():
     r"""Absolute paths to all content *.yml files under directory services/."""
@@ -22,27 +44,68 @@ def service_content_files():
 
 def read_contents(filenames: List[str]):
     """
-    Reads and combines JSON data from multiple content files.
+    Reads and combines the content of multiple content files, see `webmonchow.contents.load_contents`.
 
     Parameters
     ----------
     filenames : List[str]
-        A list of file paths to JSON files.
+        A list of file paths to JSON or JSON lines content files.
 
     Returns
     -------
     dict
-        A dictionary containing the combined data from all JSON files.
+        A dictionary containing the combined data from all content files. The lists of PVs of a key found
+        in several files are merged.
     """
-    data = {}
-    for filename in filenames:
-        print(f"Loading {filename}")
-        with open(filename) as f:
-            data.update(json.load(f))
-    return data
+    return load_contents(filenames)
 
 
-def pv_generator(data):
+def compile_contents(data, seed=None):
+    """
+    Compiles the function of every PV into a callable of `x`.
+
+    Parameters
+    ----------
+    data : dict
+        A dictionary where each key is the name of an SQL function and each value is a list of PVs for that function.
+        Functions that are already callables are left untouched.
+    seed : Optional[int]
+        If given, the functions of each PV draw random numbers from their own stream, seeded from `seed` and
+        the instrument and name of the PV (see `webmonchow.pv.expressions.pv_seed`), instead of module `random`.
+
+    Returns
+    -------
+    dict
+        A copy of `data` where each PV is a `webmonchow.contents.PV` record, with its 'function' compiled
+        into a callable of `x`.
+
+    Raises
+    ------
+    ExpressionError
+        If any of the functions can't be compiled. The message lists all the offending PVs.
+    webmonchow.pv.writers.SQLFunctionError
+        If any key of `data` is not one of `webmonchow.pv.writers.SQL_FUNCTIONS`.
+    """
+    check_functions(data)
+    compiled = {}
+    errors = []
+    for sql_function, pvs in data.items():
+        compiled[sql_function] = []
+        for pv in pvs:
+            function = pv["function"]
+            if isinstance(function, str):
+                try:
+                    names = None if seed is None else seeded_names(seed, pv["instrument"], pv["name"])
+                    function = compile_function(function, names)
+                except ExpressionError as e:
+                    errors.append(f"{sql_function} {pv.get('instrument')} {pv.get('name')}: {e}")
+            compiled[sql_function].append(PV(pv["frequency"], pv["instrument"], pv["name"], function))
+    if errors:
+        raise ExpressionError("Failed to compile PV functions:\n" + "\n".join(errors))
+    return compiled
+
+
+def pv_generator(data, scheduler=None, metrics=None):
     """
     Generates process variable (PV) data at specified intervals based on their assigned frequency.
 
@@ -52,35 +115,86 @@ def pv_generator(data):
         A dictionary where each key is the name of an SQL function and each value is a list of PVs for that function.
         Each PV is a dictionary with 'frequency', 'instrument', 'name', and 'function' keys.
         The units of 'frequency' are seconds, meaning the time interval between PV updates.
-        The SQL functions are "pvUpdate" (updates a numeric PV) and "pvUpdateString" (updates a string PV).
+        The 'function' is either a template string (see `webmonchow.pv.expressions`) or an already compiled callable.
+        The SQL functions are "pvUpdate" (updates a numeric PV) and "pvStringUpdate" (updates a string PV).
+    scheduler : Optional[webmonchow.scheduler.Scheduler]
+        The scheduler deciding when each PV is due. If None, a new scheduler on the wall clock is used.
+    metrics : Optional[webmonchow.metrics.Metrics]
+        If given, the time to evaluate each function is observed.
 
     Yields
     ------
     tuple
         A tuple containing the SQL function name, instrument, name, and evaluated function value of the PV.
+        The function is evaluated with `x` being the time of the update, in seconds since the start.
     """
-    time_step = 1.0  # in seconds. Maximum frequency for any message to be sent
-    count = 0
-    while True:
-        for sql_function, pvs in data.items():
-            for pv in pvs:
-                yield_tuple = (
-                    sql_function,
-                    pv["instrument"],
-                    pv["name"],
-                    eval(pv["function"].format(x=count * time_step)),
-                )
-                skip_counts = math.ceil(pv["frequency"] / time_step)
-                if skip_counts == 0:  # only if frequency is 0
-                    if count == 0:
-                        yield yield_tuple
-                elif count % skip_counts == 0:
-                    yield yield_tuple
-        time.sleep(time_step)
-        count += 1
-
-
-def broadcast(conn, pv_gen):
+    scheduler = Scheduler(metrics=metrics) if scheduler is None else scheduler
+    for sql_function, pvs in compile_contents(data).items():
+        for pv in pvs:
+            scheduler.add((sql_function, pv), pv.frequency)
+    for x, (sql_function, pv) in scheduler:
+        start = time.perf_counter()
+        value = pv.function(x)
+        if metrics is not None:
+            metrics.generate.observe(time.perf_counter() - start)
+        yield sql_function, pv.instrument, pv.name, value
+
+
+def pv_batch_generator(data, max_delay=0.0, scheduler=None, metrics=None):
+    """
+    Generates process variable (PV) data like `pv_generator`, gathering the updates due at about the same time.
+
+    Parameters
+    ----------
+    data : dict
+        A dictionary where each key is the name of an SQL function and each value is a list of PVs for that function,
+        in the format accepted by `pv_generator`.
+    max_delay : float
+        Maximum time an update is held back waiting for the rest of its batch, in seconds.
+        If 0, each batch contains the updates due at the same time.
+    scheduler : Optional[webmonchow.scheduler.Scheduler]
+        The scheduler deciding when each PV is due. If None, a new scheduler on the wall clock is used.
+    metrics : Optional[webmonchow.metrics.Metrics]
+        If given, the time to evaluate the functions of each batch is observed.
+
+    Yields
+    ------
+    list
+        A list of tuples, each containing the SQL function name, instrument, name, and value of a PV.
+    """
+    scheduler = Scheduler(metrics=metrics) if scheduler is None else scheduler
+    for sql_function, pvs in compile_contents(data).items():
+        for pv in pvs:
+            scheduler.add((sql_function, pv), pv.frequency)
+    for batch in scheduler.batches(max_delay):
+        start = time.perf_counter()
+        updates = [(sql_function, pv.instrument, pv.name, pv.function(x)) for x, (sql_function, pv) in batch]
+        if metrics is not None:
+            metrics.generate.observe(time.perf_counter() - start)
+        yield updates
+
+
+def _delivery(conn, send, connect=None, buffer=None, backoff=BACKOFF, metrics=None, size=None):
+    r"""Delivery through a connection to the database and its cursor, see `webmonchow.outage.Delivery`."""
+
+    def with_cursor(conn):
+        return conn, conn.cursor()
+
+    return Delivery(
+        with_cursor(conn),
+        lambda connection, item: send(*connection, item),
+        CONNECTION_ERRORS,
+        None if connect is None else lambda: with_cursor(connect()),
+        lambda connection: close_connection(connection[0]),
+        buffer,
+        backoff,
+        metrics,
+        size,
+        name="database",
+    )
+
+
+def broadcast(conn, pv_gen, metrics=None, verbose=False, timer=None, connect=None, buffer=None, backoff=BACKOFF):
     """
     Sends process variable (PV) updates to the specified SQL functions in the database using an established connection.
 
@@ -91,15 +205,108 @@ def broadcast(conn, pv_gen):
     pv_gen : generator
         A python generator that yields tuples containing the SQL function name, instrument, PV name, and PV value.
         The generator yields at specified intervals based on the frequency assigned to each PV.
+    metrics : Optional[webmonchow.metrics.Metrics]
+        If given, the number of updates and the time to execute and commit each of them are observed, and
+        the updates dropped or sent late during outages are counted.
+    verbose : bool
+        Print every update.
+    timer : Optional[Callable[[], float]]
+        Gives the timestamp of each update, in seconds since the epoch. Defaults to `time.time`.
+    connect : Optional[Callable[[], psycopg2.extensions.connection]]
+        Opens a new connection to the database, e.g. a partial of `connect_to_database` with one attempt.
+        If given, the updates due while the connection is lost are held in `buffer` until it reconnects,
+        keeping their timestamp, see `webmonchow.outage.Delivery`. If None, losing the connection raises.
+    buffer : Optional[webmonchow.outage.OutageBuffer]
+        Holds the updates while disconnected. Defaults to an `OutageBuffer` with the default size and policy.
+    backoff : tuple
+        Initial and maximum time between two attempts to reconnect, in seconds.
     """
-    cursor = conn.cursor()
-    for function, inst, name, value in pv_gen:
-        print(f"Sending {inst} {name} {value} to {function}")
-        cursor.execute(f"SELECT * FROM {function}(%s, %s, %s, %s, %s)", [inst, name, value, 0, int(time.time())])
+    timer = time.time if timer is None else timer
+
+    def send(conn, cursor, update):
+        function, inst, name, value, timestamp = update
+        start = time.perf_counter()
+        cursor.execute(update_template(conn, function), [inst, name, value, 0, timestamp])
+        executed = time.perf_counter()
         conn.commit()
+        if metrics is not None:
+            metrics.send.observe(executed - start)
+            metrics.commit.observe(time.perf_counter() - executed)
+            metrics.messages.inc()
+
+    delivery = _delivery(conn, send, connect, buffer, backoff, metrics)
+    try:
+        for function, inst, name, value in pv_gen:
+            if verbose:
+                print(f"Sending {inst} {name} {value} to {function}")
+            delivery.send((function, inst, name, value, int(timer())))
+    finally:
+        delivery.close()
+
+
+def broadcast_batches(
+    conn,
+    batch_gen,
+    max_batch_size=1000,
+    metrics=None,
+    verbose=False,
+    timer=None,
+    send=None,
+    connect=None,
+    buffer=None,
+    backoff=BACKOFF,
+):
+    """
+    Sends batches of process variable (PV) updates to the database, one round trip and one commit per batch.
+
+    Parameters
+    ----------
+    conn : psycopg2.extensions.connection
+        A connection object to the PostgreSQL database.
+    batch_gen : generator
+        A python generator that yields lists of tuples containing the SQL function name, instrument, PV name,
+        and PV value, such as `pv_batch_generator`.
+    max_batch_size : int
+        Maximum number of updates sent in one round trip. Larger batches are split.
+    metrics : Optional[webmonchow.metrics.Metrics]
+        If given, the number of updates and the time to execute and commit each round trip are observed, and
+        the updates dropped or sent late during outages are counted.
+    verbose : bool
+        Print the size of every round trip.
+    timer : Optional[Callable[[], float]]
+        Gives the timestamp of each batch, in seconds since the epoch. Defaults to `time.time`.
+    send : Optional[Callable]
+        Sends a round trip of updates, with the signature of `webmonchow.pv.writers.send_updates`,
+        e.g. from `webmonchow.pv.writers.update_sender`. Defaults to `send_updates`.
+    connect : Optional[Callable[[], psycopg2.extensions.connection]]
+        Opens a new connection to the database, see `broadcast`. The round trips due while the connection is lost
+        are held in `buffer`, whose size is a number of round trips.
+    buffer : Optional[webmonchow.outage.OutageBuffer]
+        Holds the round trips while disconnected. Defaults to an `OutageBuffer` with the default size and policy.
+    backoff : tuple
+        Initial and maximum time between two attempts to reconnect, in seconds.
+    """
+    timer = time.time if timer is None else timer
+    send = send_updates if send is None else send
+
+    def send_round_trip(conn, cursor, item):
+        timestamp, updates = item
+        send(conn, cursor, updates, timestamp, metrics)
 
+    delivery = _delivery(conn, send_round_trip, connect, buffer, backoff, metrics, size=lambda item: len(item[1]))
+    try:
+        for batch in batch_gen:
+            timestamp = int(timer())
+            for start in range(0, len(batch), max_batch_size):
+                updates = batch[start : start + max_batch_size]
+                if verbose:
+                    print(f"Sending {len(updates)} PV updates")
+                delivery.send((timestamp, updates))
+    finally:
+        delivery.close()
 
-def connect_to_database(database, user, password, host, port, attempts=None, interval=5.0):
+
+def connect_to_database(database, user, password, host, port, attempts=None, interval=5.0, prepare=False):
     """
     Establishes a connection to a PostgreSQL database.
 
@@ -119,6 +326,8 @@ def connect_to_database(database, user, password, host, port, attempts=None, int
         The number of attempts to connect to the broker. If None, the connection will be attempted indefinitely.
     interval : float
         The time interval between connection attempts.
+    prepare : bool
+        Prepare a statement for each SQL function of the PV updates, see `webmonchow.pv.writers.prepare_statements`.
 
     Returns
     -------
@@ -135,6 +344,8 @@ def connect_to_database(database, user, password, host, port, attempts=None, int
         try:
             conn = psycopg2.connect(database=database, user=user, password=password, host=host, port=port)
             print(f"Connected to {database}")
+            if prepare:
+                prepare_statements(conn)
             return conn
         except psycopg2.OperationalError as e:
             attempt_number += 1
@@ -143,7 +354,8 @@ def connect_to_database(database, user, password, host, port, attempts=None, int
     raise psycopg2.OperationalError(f"Failed to connect to database after {attempts} attempts.")
 
 
-def get_options(argv):
+def _parser():
+    r"""Parser of the command line options."""
     parser = argparse.ArgumentParser()
     parser.add_argument("--user", dest="user", default=os.getenv("DATABASE_USER", "postgres"))
     parser.add_argument("--password", dest="password", default=os.getenv("DATABASE_PASS", "postgres"))
@@ -156,15 +368,290 @@ def get_options(argv):
         default=",".join(service_content_files()),
         help="List of content files to broadcast, separated by commas",
     )
+    parser.add_argument(
+        "--vectorized",
+        action="store_true",
+        help="Evaluate PVs sharing the same function structure in groups, with NumPy",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed for the random numbers of the PV functions, each PV drawing from its own stream",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Send the PV updates due at the same time in one round trip, with one commit",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=1000,
+        help="Maximum number of PV updates in one round trip, in batch mode",
+    )
+    parser.add_argument(
+        "--max-delay",
+        type=float,
+        default=0.0,
+        help="Maximum time (seconds) a PV update is held back to be sent with later updates, in batch mode",
+    )
+    parser.add_argument(
+        "--writers",
+        type=int,
+        default=1,
+        help="Number of database connections, each in its own thread. PVs are sharded across them by instrument",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=100,
+        help="Maximum number of batches waiting to be sent by each writer, when there is more than one writer",
+    )
+    parser.add_argument(
+        "--rate",
+        type=profile_argument,
+        default=None,
+        help="Target rate of PV updates, e.g. 5000/s, step:1000/s@60,5000/s, ramp:100/s..5000/s@300, "
+        "or burst:1000/s,10000/s@5/60. The frequencies of the content files are scaled to match it",
+    )
+    parser.add_argument(
+        "--report-interval",
+        type=float,
+        default=10.0,
+        help="Time (seconds) between two summaries of the metrics, and of the achieved rate when a target rate "
+        "is set. If 0, no summary is printed",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve the metrics in the Prometheus text format on this port of the local host",
+    )
+    parser.add_argument("--verbose", "-v", action="store_true", help="Print every PV update, or every batch")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes broadcasting the PVs, partitioned by instrument, each with its own connections",
+    )
+    parser.add_argument(
+        "--replay",
+        default=None,
+        help="Recording of PV updates (see webmonchow_record) to replay instead of the content files",
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="Simulated seconds per second: the functions of the PVs see time run this many times faster. "
+        "With --replay, speed of the replay, or inf for as fast as possible",
+    )
+    parser.add_argument(
+        "--time-offset",
+        dest="time_offset",
+        type=float,
+        default=0.0,
+        help="Simulated time (seconds) at the start, the value of {x} for the first updates",
+    )
+    parser.add_argument(
+        "--backfill",
+        type=float,
+        default=None,
+        help="Generate this many seconds of history, ending now, as fast as the database takes it, then stop",
+    )
+    parser.add_argument(
+        "--sink",
+        choices=["database", "null", "recorder", "ndjson"],
+        default="database",
+        help="Where PV updates are sent: the database, nowhere (null), to a fake database recording the calls "
+        "to each SQL function (recorder), or to file --sink-file (ndjson). Sinks other than the database print "
+        "what they received",
+    )
+    parser.add_argument(
+        "--sink-file",
+        default="pvs.ndjson",
+        help="File of the PV updates sent to sink ndjson, one JSON record per line",
+    )
+    parser.add_argument(
+        "--write-path",
+        choices=WRITE_PATHS,
+        default="function",
+        help="Send PV updates through the SQL functions, write them straight into the PV tables (table), "
+        "or both, one after the other, to compare the time of both paths (send_seconds and table_seconds)",
+    )
+    parser.add_argument(
+        "--table-method",
+        choices=["copy", "insert"],
+        default="copy",
+        help="Write the rows into the PV tables with COPY, or with one multi-row INSERT per table",
+    )
+    parser.add_argument(
+        "--no-prepare",
+        dest="prepare",
+        action="store_false",
+        help="Call the SQL functions in every statement, instead of preparing a statement for each of them "
+        "when connecting",
+    )
+    parser.add_argument(
+        "--buffer-size",
+        type=int,
+        default=10000,
+        help="Maximum number of PV updates, or of batches with --batch, held while the connection to the database "
+        "is lost, sent once reconnected",
+    )
+    parser.add_argument(
+        "--overflow",
+        choices=OVERFLOW_POLICIES,
+        default="drop-oldest",
+        help="When the buffer of held updates is full, drop the oldest update, drop the new one, "
+        "or block the schedule until reconnected",
+    )
+    parser.add_argument(
+        "--spill-file",
+        default=None,
+        help="File where held updates are written beyond the first thousand, instead of memory",
+    )
+    return parser
+
+
+def get_options(argv):
+    parser = _parser()
     options = parser.parse_args(argv)
+    if options.rate is not None and (options.speed != 1.0 or options.time_offset != 0.0 or options.backfill):
+        parser.error("--rate can't be combined with --speed, --time-offset, or --backfill")
+    if options.sink == "ndjson" and options.workers > 1:
+        parser.error("--sink ndjson can't be combined with --workers")
+    if options.spill_file is not None and options.workers > 1:
+        parser.error("--spill-file can't be combined with --workers")
     return options
 
 
+def _schedule(options, rate=None, origin=None, metrics=None):
+    r"""Scheduler of the PV updates and their timer, as requested by the command line options."""
+    if options.backfill is not None:
+        clock = SimulatedClock(offset=options.time_offset, sleep=False)
+        end = options.time_offset + options.backfill
+        epoch = time.time() - options.backfill  # the history ends now
+
+        def timer():
+            return epoch + clock.now() - clock.start
+
+        return Scheduler(clock, metrics, end), timer
+    if options.rate is not None:
+        return Scheduler(WarpedClock(options.rate, rate, origin), metrics), None
+    return Scheduler(SimulatedClock(options.speed, options.time_offset, origin=origin), metrics), None
+
+
+def _content_generator(options, data, scheduler, metrics=None):
+    r"""Generator of PV updates, or of batches of PV updates, for PV content and the command line options."""
+    if options.vectorized:
+        # NumPy is an optional dependency, only imported when requested
+        from webmonchow.pv import vectorized
+
+        compile_contents(data)  # report invalid functions before connecting
+        if options.batch:
+            return vectorized.vectorized_pv_batch_generator(data, options.seed, options.max_delay, scheduler, metrics)
+        return vectorized.vectorized_pv_generator(data, options.seed, scheduler, metrics)
+    data = compile_contents(data, options.seed)
+    if options.batch:
+        return pv_batch_generator(data, options.max_delay, scheduler, metrics)
+    return pv_generator(data, scheduler, metrics)
+
+
+@contextlib.contextmanager
+def _connector(options):
+    r"""Opens connections to the database, or to the sink requested by option --sink, printing what it received."""
+    if options.sink == "database":
+        yield functools.partial(
+            connect_to_database,
+            options.database,
+            options.user,
+            options.password,
+            options.host,
+            options.port,
+            prepare=options.prepare,
+        )
+        return
+    stats = SinkStats()
+    connections = []
+    file = NdjsonFile(options.sink_file) if options.sink == "ndjson" else None
+
+    def connect():
+        connections.append(NullDatabaseConnection(stats) if options.sink == "null" else RecorderConnection(file, stats))
+        return connections[-1]
+
+    try:
+        yield connect
+    finally:
+        if file is not None:
+            file.close()
+        print(f"Sink {options.sink}: {stats.summary()}")
+        calls = collections.Counter()
+        for connection in connections:
+            calls.update(getattr(connection, "calls", {}))
+        for function, count in sorted(calls.items()):
+            print(f"  {function}: {count} calls")
+
+
+def _broadcast(options, pv_gen, metrics=None, timer=None):
+    r"""Send PV updates, or batches of PV updates, as requested by the command line options."""
+    send = update_sender(options.write_path, options.table_method)
+    with _connector(options) as connect:
+        if options.writers > 1:
+            batch_gen = pv_gen if options.batch else ([update] for update in pv_gen)
+            broadcast_sharded(
+                connect, batch_gen, options.writers, options.queue_size, options.max_batch_size, metrics, timer, send
+            )
+            return
+        # during an outage, one attempt to reconnect between two sends
+        reconnect = functools.partial(connect, attempts=1, interval=0.0) if options.sink == "database" else None
+        buffer = OutageBuffer(options.buffer_size, options.overflow, options.spill_file)
+        if options.batch or options.write_path != "function":
+            batch_gen = pv_gen if options.batch else ([update] for update in pv_gen)
+            broadcast_batches(
+                connect(),
+                batch_gen,
+                options.max_batch_size,
+                metrics,
+                options.verbose,
+                timer,
+                send,
+                reconnect,
+                buffer,
+            )
+        else:
+            broadcast(connect(), pv_gen, metrics, options.verbose, timer, reconnect, buffer)
+
+
+def _worker(options, rate, data, origin, metrics):
+    r"""Broadcast a part of the PV content in a worker process, see `webmonchow.workers.run_workers`."""
+    scheduler, timer = _schedule(options, rate, origin, metrics)
+    _broadcast(options, _content_generator(options, data, scheduler, metrics), metrics, timer)
+
+
 def main(argv=None):
     options = get_options(argv)
+    metrics = monitor(options.report_interval, options.metrics_port)
+    if options.replay is not None:
+        pv_gen = replay_updates(options.replay, options.speed)
+        if options.batch:  # the updates of a recording are replayed one at a time
+            pv_gen = ([update] for update in pv_gen)
+        _broadcast(options, pv_gen, metrics)
+        return
     data = read_contents([f.strip() for f in options.pv_files.split(",")])
-    connection = connect_to_database(options.database, options.user, options.password, options.host, options.port)
-    broadcast(connection, pv_generator(data))
+    rate = natural_rate(pv["frequency"] for pvs in data.values() for pv in pvs) if options.rate is not None else None
+    if rate is not None and rate <= 0:
+        _parser().error("--rate requires periodic PV updates, with a frequency above 0, in the content files")
+    if options.workers > 1:
+        worker = functools.partial(_worker, options, rate)
+        run_workers(worker, partition_pvs(data, options.workers), metrics)
+        return
+    scheduler, timer = _schedule(options, rate, metrics=metrics)
+    pv_gen = _content_generator(options, data, scheduler, metrics)
+    if options.rate is not None and options.report_interval > 0:
+        pv_gen = report_rate(pv_gen, options.rate, options.report_interval, size=len if options.batch else None)
+    _broadcast(options, pv_gen, metrics, timer)
 
 
 if __name__ == "__main__":
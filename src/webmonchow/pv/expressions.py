@@ -0,0 +1,182 @@
+# standard imports
+import ast
+import builtins
+import hashlib
+import math
+import random
+
+#: Modules PV functions may refer to, by name
+ALLOWED_MODULES = {"math": math, "random": random}
+
+#: Builtin functions PV functions may call
+ALLOWED_BUILTINS = ("abs", "bool", "float", "int", "len", "max", "min", "pow", "round", "str", "sum")
+
+# arguments of `compile` for PV functions
+_CODE = ("<pv function>", "eval")
+
+
+def pv_seed(seed, instrument, name):
+    """
+    Seed of the random numbers of one PV, derived from a global seed and the identity of the PV.
+
+    The seed doesn't depend on the other PVs, so the values of a PV are the same however the content
+    is ordered or split across workers.
+
+    Parameters
+    ----------
+    seed : int
+        The global seed.
+    instrument : str
+        Name of the instrument of the PV.
+    name : str
+        Name of the PV.
+
+    Returns
+    -------
+    int
+        A 64-bit seed.
+    """
+    digest = hashlib.blake2b(f"{seed}\0{instrument}\0{name}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def seeded_names(seed, instrument, name):
+    """Names for `compile_function`, where `random` is a `random.Random` seeded for one PV, see `pv_seed`."""
+    return {**ALLOWED_MODULES, "random": random.Random(pv_seed(seed, instrument, name))}
+
+
+class ExpressionError(ValueError):
+    """Raised when a PV function can't be compiled"""
+
+
+def _placeholder(variable):
+    r"""Stand-in for "{variable}" while a template is parsed. Not a valid name in user content, which can't use "_"."""
+    return f"_webmonchow_{variable}_"
+
+
+class _SubstituteVariables(ast.NodeTransformer):
+    r"""Replace the placeholders of the variables with references to the variables, also inside string literals."""
+
+    def __init__(self, variables):
+        self.variables = {_placeholder(variable): variable for variable in variables}
+
+    def visit_Name(self, node):
+        if node.id in self.variables:
+            return ast.copy_location(ast.Name(id=self.variables[node.id], ctx=ast.Load()), node)
+        return node
+
+    def visit_Constant(self, node):
+        if not isinstance(node.value, str):
+            return node
+        used = [variable for placeholder, variable in self.variables.items() if placeholder in node.value]
+        if not used:
+            return node
+        # '...{x}...' becomes '...{x}...'.format(x=x), which is what str.format did to the whole template
+        template = node.value.replace("{", "{{").replace("}", "}}")
+        for variable in used:
+            template = template.replace(_placeholder(variable), f"{{{variable}}}")
+        call = ast.Call(
+            func=ast.Attribute(value=ast.Constant(value=template), attr="format", ctx=ast.Load()),
+            args=[],
+            keywords=[ast.keyword(arg=variable, value=ast.Name(id=variable, ctx=ast.Load())) for variable in used],
+        )
+        return ast.copy_location(call, node)
+
+
+def _parse(template, names, variables):
+    r"""Parse and validate a template. Returns the formatted source, its tree, and whether variables are in strings."""
+    placeholders = [_placeholder(variable) for variable in variables]
+    try:
+        source = template.format(**dict(zip(variables, placeholders)))
+    except (AttributeError, IndexError, KeyError, ValueError) as e:
+        raise ExpressionError(f"invalid template {template!r}: {e!r}") from e
+    try:
+        tree = ast.parse(source.strip(), mode="eval")
+    except SyntaxError as e:
+        raise ExpressionError(f"invalid expression {template!r}: {e.msg}") from e
+    allowed_names = {*placeholders, *names, *ALLOWED_BUILTINS}
+    in_string = False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if node.id not in allowed_names:
+                raise ExpressionError(f"invalid expression {template!r}: name '{node.id}' is not allowed")
+            if not isinstance(node.ctx, ast.Load):
+                raise ExpressionError(f"invalid expression {template!r}: assignment to '{node.id}' is not allowed")
+        elif isinstance(node, ast.Attribute) and node.attr.startswith("_"):
+            raise ExpressionError(f"invalid expression {template!r}: attribute '{node.attr}' is not allowed")
+        elif isinstance(node, ast.Lambda):
+            raise ExpressionError(f"invalid expression {template!r}: lambda expressions are not allowed")
+        elif isinstance(node, ast.Constant) and isinstance(node.value, str):
+            in_string = in_string or any(placeholder in node.value for placeholder in placeholders)
+    return source, tree, in_string
+
+
+def parse_function(template, names=None, variables=("x",)):
+    """
+    Parse a PV function template into a validated expression of `x`.
+
+    Parameters
+    ----------
+    template : str
+        Python expression where every occurrence of `{x}` stands for the time of the update,
+        e.g. "100*math.sin({x}/3600)". As with `str.format`, literal braces are written as `{{` and `}}`.
+    names : Optional[dict]
+        Names the expression may refer to besides `x` and the allowed builtins. Defaults to `ALLOWED_MODULES`.
+    variables : Sequence[str]
+        Names of the variables that may appear between braces in the template.
+
+    Returns
+    -------
+    ast.Expression
+        The parsed expression, with `{x}` replaced by the name `x`.
+        Nodes introduced by the substitution have no location, see `ast.fix_missing_locations`.
+
+    Raises
+    ------
+    ExpressionError
+        If the template is not a valid expression, or refers to a name that is not allowed.
+    """
+    names = ALLOWED_MODULES if names is None else names
+    _, tree, _ = _parse(template, names, variables)
+    return _SubstituteVariables(variables).visit(tree)
+
+
+def compile_function(template, names=None, variables=("x",)):
+    """
+    Compile a PV function template into a callable of `x`.
+
+    The template is parsed and compiled once, so calling the result is as cheap as calling a regular Python function.
+
+    Parameters
+    ----------
+    template : str
+        Python expression where every occurrence of `{x}` stands for the time of the update.
+    names : Optional[dict]
+        Names the expression may refer to besides `x` and the allowed builtins. Defaults to `ALLOWED_MODULES`.
+    variables : Sequence[str]
+        Names of the variables that may appear between braces in the template.
+        They become the positional arguments of the callable, in the same order.
+
+    Returns
+    -------
+    Callable[[float], Any]
+        A function evaluating the expression for a given value of `x`.
+
+    Raises
+    ------
+    ExpressionError
+        If the template is not a valid expression, or refers to a name that is not allowed.
+    """
+    names = ALLOWED_MODULES if names is None else names
+    source, tree, in_string = _parse(template, names, variables)
+    if in_string:  # substitute the variables inside string literals, then compile the tree
+        arguments = ast.arguments(
+            posonlyargs=[], args=[ast.arg(arg=v) for v in variables], kwonlyargs=[], kw_defaults=[], defaults=[]
+        )
+        body = _SubstituteVariables(variables).visit(tree).body
+        function = compile(ast.fix_missing_locations(ast.Expression(body=ast.Lambda(arguments, body))), *_CODE)
+    else:  # the placeholders are valid argument names, so the validated source compiles as is
+        arguments = ", ".join(_placeholder(variable) for variable in variables)
+        function = compile(f"lambda {arguments}: (\n{source.strip()}\n)", *_CODE)
+    scope = {"__builtins__": {name: getattr(builtins, name) for name in ALLOWED_BUILTINS}, **names}
+    return eval(function, scope)
@@ -0,0 +1,475 @@
+r"""
+Vectorized evaluation of PV functions with NumPy.
+
+PVs whose function templates differ only in their numeric constants, e.g. "300+10*math.sin({x}/300)" and
+"490+10*math.sin({x}/300)", share the same structure. PVs sharing structure, SQL function, and frequency
+are gathered in a group, the constants of the group are stacked into arrays, and the group is evaluated
+with a single NumPy expression every time it is due.
+
+Functions that can't be vectorized (e.g. those returning strings) are evaluated one PV at a time,
+as in `webmonchow.pv.broadcast.pv_generator`.
+
+With a seed, every PV of a group draws its random numbers from its own stream, a counter-based generator
+keyed by the seed of the PV (see `webmonchow.pv.expressions.pv_seed`), so the values of a PV don't depend
+on the other PVs of its group.
+
+NumPy is an optional dependency, installed with `pip install webmonchow[vectorized]`.
+"""
+
+# standard imports
+import ast
+import math
+import random
+import re
+import time
+
+# third party imports
+import numpy as np
+
+# webmonchow imports
+from webmonchow.pv.expressions import ALLOWED_MODULES, compile_function, parse_function, pv_seed, seeded_names
+from webmonchow.scheduler import Scheduler
+
+# functions of module math of one argument, and their NumPy ufunc. math.log also takes a base
+_MATH_UFUNCS = {
+    "acos": "arccos",
+    "asin": "arcsin",
+    "atan": "arctan",
+    "ceil": "ceil",
+    "cos": "cos",
+    "cosh": "cosh",
+    "exp": "exp",
+    "fabs": "abs",
+    "floor": "floor",
+    "log": "log",
+    "log10": "log10",
+    "sin": "sin",
+    "sinh": "sinh",
+    "sqrt": "sqrt",
+    "tan": "tan",
+    "tanh": "tanh",
+}
+_MATH_CONSTANTS = ("e", "inf", "pi", "tau")
+# functions of module random and the number of their arguments
+_RANDOM_FUNCTIONS = {"random": 0, "uniform": 2, "gauss": 2, "choice": 1}
+_RNG = ast.Name(id="_rng", ctx=ast.Load())
+# numeric literals in a template, used to recognize templates differing only in their constants without parsing them
+_NUMBER = re.compile(r"(?<![\w.])(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?(?![\w.])")
+# constants of the SplitMix64 generator
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+_MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX2 = np.uint64(0x94D049BB133111EB)
+_OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.USub, ast.UAdd)
+
+
+class NotVectorizableError(ValueError):
+    """Raised when a PV function can't be evaluated as a NumPy expression"""
+
+
+def _is_number(node):
+    return isinstance(node, ast.Constant) and type(node.value) in (int, float)
+
+
+def _name(node):
+    r"""Dotted name of a call target, e.g. 'math.sin', or None."""
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+        return f"{node.value.id}.{node.attr}"
+    return None
+
+
+class _Parametrize(ast.NodeTransformer):
+    r"""Replace numeric constants with parameters `_p0`, `_p1`, ... and collect their values."""
+
+    def __init__(self):
+        self.values = []
+
+    def visit_Constant(self, node):
+        if not _is_number(node):
+            raise NotVectorizableError(f"constant {node.value!r} is not a number")
+        name = f"_p{len(self.values)}"
+        self.values.append(node.value)
+        return ast.copy_location(ast.Name(id=name, ctx=ast.Load()), node)
+
+
+class _Vectorize(ast.NodeTransformer):
+    r"""Rewrite a parametrized expression into NumPy calls, raising `NotVectorizableError` on anything else."""
+
+    def generic_visit(self, node):
+        if not isinstance(node, (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Load) + _OPERATORS):
+            raise NotVectorizableError(f"{type(node).__name__} is not supported")
+        return super().generic_visit(node)
+
+    def visit_Name(self, node):
+        if node.id == "x" or node.id.startswith("_p"):
+            return node
+        raise NotVectorizableError(f"name '{node.id}' is not supported")
+
+    def visit_Attribute(self, node):
+        name = _name(node)
+        if name is not None and name.startswith("math.") and node.attr in _MATH_CONSTANTS:
+            return ast.copy_location(ast.Constant(value=getattr(math, node.attr)), node)
+        raise NotVectorizableError(f"attribute '{node.attr}' is not supported")
+
+    def visit_Call(self, node):
+        name = _name(node.func)
+        if node.keywords:
+            raise NotVectorizableError(f"keyword arguments of '{name}' are not supported")
+        if name is not None and name.startswith("math.") and node.func.attr in _MATH_UFUNCS:
+            return self._math(node, name)
+        if name == "abs":
+            if len(node.args) != 1:
+                raise NotVectorizableError("unexpected arguments for 'abs'")
+            return self._call(node, "_np.abs", node.args)
+        if name is not None and name.startswith("random.") and node.func.attr in _RANDOM_FUNCTIONS:
+            if len(node.args) != _RANDOM_FUNCTIONS[node.func.attr]:
+                raise NotVectorizableError(f"unexpected arguments for '{name}'")
+            if node.func.attr == "choice":
+                options = node.args[0]
+                if not isinstance(options, (ast.List, ast.Tuple)) or not options.elts:
+                    raise NotVectorizableError("random.choice is only supported over a literal list")
+                return self._call(node, "_choice", [_RNG, ast.List(elts=options.elts, ctx=ast.Load())])
+            return self._call(node, f"_{node.func.attr}", [_RNG] + node.args)
+        raise NotVectorizableError(f"call to '{name}' is not supported")
+
+    def _math(self, node, name):
+        r"""Call to the ufunc of a function of module math, with the arguments of the function only."""
+        if node.func.attr == "log" and len(node.args) == 2:  # logarithm in a base
+            numerator, denominator = (self._call(node, "_np.log", [arg]) for arg in node.args)
+            return ast.copy_location(ast.BinOp(left=numerator, op=ast.Div(), right=denominator), node)
+        if len(node.args) != 1:  # further arguments of a ufunc are its outputs
+            raise NotVectorizableError(f"unexpected arguments for '{name}'")
+        return self._call(node, f"_np.{_MATH_UFUNCS[node.func.attr]}", node.args)
+
+    def _call(self, node, function, args):
+        args = [
+            arg if arg is _RNG else self._visit_list(arg) if isinstance(arg, ast.List) else self.visit(arg)
+            for arg in args
+        ]
+        call = ast.Call(func=_parse_name(function), args=args, keywords=[])
+        return ast.copy_location(call, node)
+
+    def _visit_list(self, node):
+        return ast.List(elts=[self.visit(element) for element in node.elts], ctx=ast.Load())
+
+
+def _parse_name(dotted):
+    return ast.parse(dotted, mode="eval").body
+
+
+def structure(template):
+    """
+    Split a PV function template into its structure and its numeric constants.
+
+    Parameters
+    ----------
+    template : str
+        The PV function template, e.g. "300+10*math.sin({x}/300)".
+
+    Returns
+    -------
+    tuple
+        The structure, as an `ast.Expression` of NumPy calls where numeric constants are parameters `_p0`, `_p1`,...
+        The structure dumped as a string, equal for templates differing only in their numeric constants.
+        The list of numeric constants, in order of appearance.
+
+    Raises
+    ------
+    NotVectorizableError
+        If the template can't be evaluated as a NumPy expression.
+    ExpressionError
+        If the template is not a valid PV function.
+    """
+    parametrize = _Parametrize()
+    tree = _Vectorize().visit(parametrize.visit(parse_function(template)))
+    return tree, ast.dump(tree), parametrize.values
+
+
+def _choose(indices, options):
+    r"""Option `indices[i]` of every PV `i`, like `np.choose` without its limit of 64 options."""
+    size = len(indices)
+    return np.stack([np.broadcast_to(option, size) for option in options])[indices, np.arange(size)]
+
+
+class PVGroup:
+    """
+    PVs sharing the same SQL function, frequency, and function structure, evaluated together.
+
+    Parameters
+    ----------
+    sql_function : str
+        The SQL function updating the PVs of the group.
+    frequency : float
+        Time interval between updates of the PVs, in seconds.
+    tree : ast.Expression
+        The function structure shared by all PVs of the group, as returned by `structure`.
+    seed : Optional[int]
+        Seed of the random numbers of the PVs when they are evaluated one at a time, see `evaluate`.
+    """
+
+    def __init__(self, sql_function, frequency, tree, seed=None):
+        self.sql_function = sql_function
+        self.frequency = frequency
+        self.tree = tree
+        self.seed = seed
+        self.instruments = []
+        self.names = []
+        self.templates = []
+        self._constants = []
+        self._function = None
+        self._scalars = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def append(self, instrument, name, constants, template=None):
+        """Add a PV to the group, with the numeric constants of its function, and the template of its function."""
+        self.instruments.append(instrument)
+        self.names.append(name)
+        self.templates.append(template)
+        self._constants.append(constants)
+        self._function = None
+        self._scalars = None
+
+    def _compile(self):
+        size = len(self)
+        columns = np.array(self._constants, dtype=float).reshape(size, len(self._constants[0])).T
+        arguments = ast.arguments(
+            posonlyargs=[], args=[ast.arg(arg="x"), ast.arg(arg="_rng")], kwonlyargs=[], kw_defaults=[], defaults=[]
+        )
+        function = ast.fix_missing_locations(ast.Expression(body=ast.Lambda(args=arguments, body=self.tree.body)))
+        scope = {
+            "__builtins__": {},
+            "_np": np,
+            "_random": lambda rng: rng.random(size),
+            "_uniform": lambda rng, a, b: rng.uniform(a, b, size),
+            "_gauss": lambda rng, mu, sigma: rng.normal(mu, sigma, size),
+            "_choice": lambda rng, options: _choose(rng.integers(0, len(options), size), options),
+            **{f"_p{i}": column for i, column in enumerate(columns)},
+        }
+        self._function = eval(compile(function, "<pv group>", "eval"), scope)
+
+    def evaluate(self, x, rng):
+        """
+        Evaluate the function of every PV in the group.
+
+        If NumPy divides by zero, overflows, or computes an invalid value, e.g. the square root of a negative
+        number, the PVs are evaluated one at a time with their function compiled from its template, so the values
+        and the errors are those of `webmonchow.pv.broadcast.pv_generator`. Their random numbers then come
+        from module `random`, or with a seed from a `random.Random` per PV, see `seeded_names`.
+
+        Parameters
+        ----------
+        x : float
+            Time of the update, in seconds since the start.
+        rng : Union[numpy.random.Generator, PVStreams]
+            Source of the random numbers.
+
+        Returns
+        -------
+        list
+            The values of the PVs, as Python numbers, in the order the PVs were appended.
+
+        Raises
+        ------
+        ArithmeticError, ValueError
+            If the function of a PV raises, as without vectorizing.
+        """
+        if self._function is None:
+            self._compile()
+        try:
+            with np.errstate(divide="raise", over="raise", invalid="raise"):
+                return np.broadcast_to(self._function(x, rng), len(self)).tolist()
+        except FloatingPointError:
+            pass
+        # where NumPy gives inf or nan, Python may raise: evaluate the PVs one at a time, as without vectorizing
+        if self._scalars is None:
+            self._scalars = [
+                compile_function(template, None if self.seed is None else seeded_names(self.seed, instrument, name))
+                for instrument, name, template in zip(self.instruments, self.names, self.templates)
+            ]
+        return [function(x) for function in self._scalars]
+
+
+class PVStreams:
+    """
+    Independent streams of random numbers, one per PV of a group, with the methods of `numpy.random.Generator`
+    used by `PVGroup`.
+
+    Each stream is a SplitMix64 generator: the n-th number of a PV only depends on its key and on n.
+
+    Parameters
+    ----------
+    keys : Sequence[int]
+        The 64-bit key of each stream, e.g. from `webmonchow.pv.expressions.pv_seed`.
+    """
+
+    def __init__(self, keys):
+        self._state = np.array(keys, dtype=np.uint64)
+
+    def _next(self):
+        r"""Next 64-bit number of every stream."""
+        self._state += _GOLDEN
+        z = self._state.copy()
+        z ^= z >> np.uint64(30)
+        z *= _MIX1
+        z ^= z >> np.uint64(27)
+        z *= _MIX2
+        return z ^ (z >> np.uint64(31))
+
+    def random(self, size):  # noqa: ARG002 signature of numpy.random.Generator, one number per stream
+        """Uniform numbers in [0, 1), one per stream."""
+        return (self._next() >> np.uint64(11)) * 2.0**-53
+
+    def uniform(self, low, high, size):
+        return low + (high - low) * self.random(size)
+
+    def normal(self, loc, scale, size):
+        # Box-Muller transform, drawing two numbers from every stream
+        radius = np.sqrt(-2.0 * np.log(1.0 - self.random(size)))
+        return loc + scale * radius * np.cos(2.0 * np.pi * self.random(size))
+
+    def integers(self, low, high, size):
+        return low + (self.random(size) * (high - low)).astype(np.int64)
+
+
+def group_contents(data, seed=None):
+    """
+    Gather the PVs that can be evaluated together.
+
+    Parameters
+    ----------
+    data : dict
+        A dictionary where each key is the name of an SQL function and each value is a list of PVs for that function,
+        in the format read by `webmonchow.pv.broadcast.read_contents`.
+    seed : Optional[int]
+        Seed of the random numbers of the groups when their PVs are evaluated one at a time, see `PVGroup`.
+
+    Returns
+    -------
+    tuple
+        The list of `PVGroup` objects, and a dictionary with the same format as `data` containing the PVs
+        whose function can't be vectorized.
+    """
+    groups = {}
+    scalars = {}
+    shapes = {}  # template with its numeric literals blanked out -> structure, or None if not vectorizable
+    for sql_function, pvs in data.items():
+        for pv in pvs:
+            template = pv["function"]
+            shape = _NUMBER.sub("#", template)
+            literals = [float(literal) for literal in _NUMBER.findall(template)]
+            if shape not in shapes:
+                try:
+                    tree, key, constants = structure(template)
+                except NotVectorizableError:
+                    shapes[shape] = None
+                else:  # templates of this shape can skip parsing if their literals are the constants of the tree
+                    shapes[shape] = (tree, key) if literals == constants else False
+            if shapes[shape] is None:
+                scalars.setdefault(sql_function, []).append(pv)
+                continue
+            if shapes[shape]:
+                tree, key = shapes[shape]
+                constants = literals
+            else:
+                tree, key, constants = structure(template)
+            group_key = (sql_function, pv["frequency"], key)
+            if group_key not in groups:
+                groups[group_key] = PVGroup(sql_function, pv["frequency"], tree, seed)
+            groups[group_key].append(pv["instrument"], pv["name"], constants, template)
+    return list(groups.values()), scalars
+
+
+def _schedule(data, seed, scheduler):
+    r"""Add the groups, with their source of random numbers, and the PVs that can't be vectorized to the scheduler."""
+    rng = np.random.default_rng()
+    names = {**ALLOWED_MODULES, "random": random.Random()}
+    groups, scalars = group_contents(data, seed)
+    for group in groups:
+        if seed is not None:
+            rng = PVStreams([pv_seed(seed, *pv) for pv in zip(group.instruments, group.names)])
+        scheduler.add((group, rng), group.frequency)
+    for sql_function, pvs in scalars.items():
+        for pv in pvs:
+            if seed is not None:
+                names = seeded_names(seed, pv["instrument"], pv["name"])
+            scheduler.add((sql_function, pv, compile_function(pv["function"], names)), pv["frequency"])
+
+
+def _evaluate(x, entry):
+    r"""Updates for a group or for a single PV."""
+    if len(entry) == 2:
+        group, rng = entry
+        return zip([group.sql_function] * len(group), group.instruments, group.names, group.evaluate(x, rng))
+    sql_function, pv, function = entry
+    return [(sql_function, pv["instrument"], pv["name"], function(x))]
+
+
+def vectorized_pv_generator(data, seed=None, scheduler=None, metrics=None):
+    """
+    Generates process variable (PV) data like `webmonchow.pv.broadcast.pv_generator`, evaluating PVs in groups.
+
+    Parameters
+    ----------
+    data : dict
+        A dictionary where each key is the name of an SQL function and each value is a list of PVs for that function.
+        Each PV is a dictionary with 'frequency', 'instrument', 'name', and 'function' keys.
+        The 'function' must be a template string.
+    seed : Optional[int]
+        Seed for the random numbers. Every PV draws from its own stream, so runs with the same seed generate
+        the same values for a PV, whatever the other PVs of the content.
+    scheduler : Optional[webmonchow.scheduler.Scheduler]
+        The scheduler deciding when each group is due. If None, a new scheduler on the wall clock is used.
+    metrics : Optional[webmonchow.metrics.Metrics]
+        If given, the time to evaluate each group, PV, or batch is observed.
+
+    Yields
+    ------
+    tuple
+        A tuple containing the SQL function name, instrument, name, and evaluated function value of the PV.
+    """
+    scheduler = Scheduler(metrics=metrics) if scheduler is None else scheduler
+    _schedule(data, seed, scheduler)
+    for x, entry in scheduler:
+        start = time.perf_counter()
+        updates = _evaluate(x, entry)
+        if metrics is not None:
+            metrics.generate.observe(time.perf_counter() - start)
+        yield from updates
+
+
+def vectorized_pv_batch_generator(data, seed=None, max_delay=0.0, scheduler=None, metrics=None):
+    """
+    Generates batches of process variable (PV) data like `webmonchow.pv.broadcast.pv_batch_generator`,
+    evaluating PVs in groups.
+
+    Parameters
+    ----------
+    data : dict
+        A dictionary where each key is the name of an SQL function and each value is a list of PVs for that function,
+        in the format accepted by `vectorized_pv_generator`.
+    seed : Optional[int]
+        Seed for the random numbers. Every PV draws from its own stream, so runs with the same seed generate
+        the same values for a PV, whatever the other PVs of the content.
+    max_delay : float
+        Maximum time an update is held back waiting for the rest of its batch, in seconds.
+    scheduler : Optional[webmonchow.scheduler.Scheduler]
+        The scheduler deciding when each group is due. If None, a new scheduler on the wall clock is used.
+    metrics : Optional[webmonchow.metrics.Metrics]
+        If given, the time to evaluate each group, PV, or batch is observed.
+
+    Yields
+    ------
+    list
+        A list of tuples, each containing the SQL function name, instrument, name, and value of a PV.
+    """
+    scheduler = Scheduler(metrics=metrics) if scheduler is None else scheduler
+    _schedule(data, seed, scheduler)
+    for batch in scheduler.batches(max_delay):
+        start = time.perf_counter()
+        updates = [update for x, entry in batch for update in _evaluate(x, entry)]
+        if metrics is not None:
+            metrics.generate.observe(time.perf_counter() - start)
+        yield updates
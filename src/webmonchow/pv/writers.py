@@ -0,0 +1,473 @@
+# standard imports
+import queue
+import threading
+import time
+import weakref
+import zlib
+
+# third party imports
+import psycopg2
+
+# errors after which a writer discards its connection and opens a new one
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+#: SQL functions PV updates may be sent to. Their names are written into statements, so no other name is accepted
+SQL_FUNCTIONS = ("pvUpdate", "pvStringUpdate")
+
+# statements calling each SQL function, and executing its prepared statement
+_SELECT = {function: f"SELECT * FROM {function}(%s, %s, %s, %s, %s)" for function in SQL_FUNCTIONS}
+_EXECUTE = {function: f"EXECUTE webmonchow_{function}(%s, %s, %s, %s, %s)" for function in SQL_FUNCTIONS}
+
+# SQL functions with a prepared statement, by connection
+_PREPARED = weakref.WeakKeyDictionary()
+
+#: Table of the history of the PVs updated by each SQL function
+TABLES = {"pvUpdate": "pvmon_pv", "pvStringUpdate": "pvmon_pvstring"}
+
+#: Columns of the history tables written without the SQL functions
+COLUMNS = "(instrument_id, name_id, value, status, update_time)"
+
+#: Ways of writing PV updates: through the SQL functions, straight into the tables, or both one after the other
+WRITE_PATHS = ("function", "table", "both")
+
+# characters escaped in the text format of COPY
+_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+class SQLFunctionError(ValueError):
+    """Raised for a PV update to an SQL function that is not one of `SQL_FUNCTIONS`."""
+
+
+def check_functions(functions):
+    """Raises `SQLFunctionError` if any of the names is not one of `SQL_FUNCTIONS`."""
+    unknown = sorted(set(functions) - set(SQL_FUNCTIONS))
+    if unknown:
+        raise SQLFunctionError(f"unknown SQL functions {', '.join(unknown)}, expected {', '.join(SQL_FUNCTIONS)}")
+
+
+def prepare_statements(conn):
+    """
+    Prepares a statement calling each of the `SQL_FUNCTIONS` on a connection, so the database parses and plans
+    the calls once instead of for every update. `send_updates` executes the prepared statements afterwards.
+
+    SQL functions missing in the database, or that can't be prepared, are called without a prepared statement.
+
+    Parameters
+    ----------
+    conn : psycopg2.extensions.connection
+        A connection object to the PostgreSQL database.
+
+    Returns
+    -------
+    tuple
+        The SQL functions with a prepared statement.
+    """
+    cursor = conn.cursor()
+    prepared = []
+    for function in SQL_FUNCTIONS:
+        try:
+            cursor.execute(f"PREPARE webmonchow_{function} AS SELECT * FROM {function}($1, $2, $3, $4, $5)")
+            conn.commit()
+            prepared.append(function)
+        except psycopg2.ProgrammingError as e:
+            conn.rollback()
+            print(f"Calling {function} without a prepared statement: {e}")
+    _PREPARED[conn] = frozenset(prepared)
+    return tuple(prepared)
+
+
+def update_template(conn, function):
+    """
+    Statement of a PV update through an SQL function, with placeholders for the instrument, PV name, value,
+    status, and timestamp. It executes the prepared statement of the function if the connection has one,
+    see `prepare_statements`, or else calls the function.
+
+    Raises
+    ------
+    SQLFunctionError
+        If the SQL function is not one of `SQL_FUNCTIONS`.
+    """
+    if function not in _SELECT:
+        check_functions([function])
+    return _EXECUTE[function] if function in _PREPARED.get(conn, ()) else _SELECT[function]
+
+
+def update_statements(conn, cursor, updates, timestamp=None):
+    """
+    Statements of PV updates, see `update_template`.
+
+    Parameters
+    ----------
+    conn : psycopg2.extensions.connection
+        A connection object to the PostgreSQL database.
+    cursor : psycopg2.extensions.cursor
+        A cursor of the connection.
+    updates : Iterable[tuple]
+        Tuples containing the SQL function name, instrument, PV name, and PV value, followed by the timestamp
+        of the update if `timestamp` is None.
+    timestamp : Optional[int]
+        Time of the updates, in seconds since the epoch.
+
+    Returns
+    -------
+    list
+        The statement of each update, as bytes.
+
+    Raises
+    ------
+    SQLFunctionError
+        If an SQL function is not one of `SQL_FUNCTIONS`.
+    """
+    templates = {}
+    statements = []
+    for function, inst, name, value, *rest in updates:
+        if function not in templates:
+            templates[function] = update_template(conn, function)
+        parameters = [inst, name, value, 0, timestamp if timestamp is not None else rest[0]]
+        statements.append(cursor.mogrify(templates[function], parameters))
+    return statements
+
+
+def send_updates(conn, cursor, updates, timestamp, metrics=None):
+    """
+    Sends PV updates to the database in one round trip, and commits them, see `update_statements`.
+
+    Parameters
+    ----------
+    conn : psycopg2.extensions.connection
+        A connection object to the PostgreSQL database.
+    cursor : psycopg2.extensions.cursor
+        A cursor of the connection.
+    updates : list
+        A list of tuples containing the SQL function name, instrument, PV name, and PV value.
+    timestamp : int
+        Time of the updates, in seconds since the epoch.
+    metrics : Optional[webmonchow.metrics.Metrics]
+        If given, the number of updates and the time to execute and commit them are observed.
+    """
+    statements = update_statements(conn, cursor, updates, timestamp)
+    start = time.perf_counter()
+    cursor.execute(b";".join(statements))
+    executed = time.perf_counter()
+    conn.commit()
+    if metrics is not None:
+        metrics.send.observe(executed - start)
+        metrics.commit.observe(time.perf_counter() - executed)
+        metrics.messages.inc(len(updates))
+
+
+class RowStream:
+    """
+    File-like object reading rows in the text format of `COPY FROM STDIN`, produced lazily by a generator.
+
+    Parameters
+    ----------
+    rows : Iterable[tuple]
+        The rows. Strings are escaped, other values are written with `str`.
+    """
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = ""
+        self.count = 0
+
+    def _line(self, row):
+        fields = (value.translate(_ESCAPES) if isinstance(value, str) else str(value) for value in row)
+        return "\t".join(fields) + "\n"
+
+    def read(self, size=-1):
+        """Read up to `size` characters, or all the rows if `size` is negative."""
+        parts = [self._buffer]
+        length = len(self._buffer)
+        for row in self._rows:
+            line = self._line(row)
+            parts.append(line)
+            length += len(line)
+            self.count += 1
+            if 0 <= size <= length:
+                break
+        text = "".join(parts)
+        if size < 0:
+            self._buffer = ""
+            return text
+        self._buffer = text[size:]
+        return text[:size]
+
+
+def pv_ids(cursor, pvs):
+    """
+    Ids of the instrument and of the name of PVs already registered in the database, e.g. by an update
+    through their SQL function.
+
+    Parameters
+    ----------
+    cursor : psycopg2.extensions.cursor
+        A cursor of a connection to the database.
+    pvs : Iterable[tuple]
+        The instrument and the name of each PV.
+
+    Returns
+    -------
+    dict
+        The ids of the instrument and of the name, by instrument and name.
+    """
+    ids = {}
+    for instrument, name in pvs:
+        cursor.execute("SELECT id FROM report_instrument WHERE lower(name) = lower(%s)", [instrument])
+        instrument_id = cursor.fetchone()[0]
+        cursor.execute("SELECT id FROM pvmon_pvname WHERE name = %s", [name])
+        ids[(instrument, name)] = (instrument_id, cursor.fetchone()[0])
+    return ids
+
+
+class TableWriter:
+    """
+    Writes PV updates straight into the tables of the PV history, bypassing the SQL functions,
+    to tell the cost of the SQL functions apart from the cost of writing the rows.
+
+    A writer is called like `send_updates`. The first update of a PV it hasn't seen yet goes through the
+    SQL function, so the database registers the instrument and the name of the PV, then the ids of the PV
+    are looked up once. Unlike the SQL functions, the writer only appends to the history tables: the cache of the latest
+    values is left as is.
+
+    Parameters
+    ----------
+    method : str
+        "copy" to stream the rows with `COPY FROM STDIN`, or "insert" for one multi-row INSERT per table.
+    register : bool
+        Send the first update of every PV through its SQL function. If False, the PVs must already be registered.
+    """
+
+    def __init__(self, method="copy", register=True):
+        if method not in ("copy", "insert"):
+            raise ValueError(f"unknown method {method!r}")
+        self.method = method
+        self.register = register
+        self.ids = {}  # ids of the instrument and of the name, by instrument and name
+
+    def __call__(self, conn, cursor, updates, timestamp, metrics=None):
+        """
+        Writes PV updates into the history tables, and commits them.
+
+        Parameters
+        ----------
+        conn : psycopg2.extensions.connection
+            A connection object to the PostgreSQL database.
+        cursor : psycopg2.extensions.cursor
+            A cursor of the connection.
+        updates : list
+            A list of tuples containing the SQL function name, instrument, PV name, and PV value.
+            The SQL functions must be keys of `TABLES`.
+        timestamp : int
+            Time of the updates, in seconds since the epoch.
+        metrics : Optional[webmonchow.metrics.Metrics]
+            If given, the number of updates and the time to write and commit them are observed.
+        """
+        first = {}  # first update of each PV not registered yet, sent through its SQL function
+        pending = {}  # updates to write, by SQL function
+        for update in updates:
+            key = (update[1], update[2])
+            if self.register and key not in self.ids and key not in first:
+                first[key] = update
+            else:
+                pending.setdefault(update[0], []).append(update)
+        if first:
+            send_updates(conn, cursor, list(first.values()), timestamp, metrics)
+            self.ids.update(pv_ids(cursor, first))
+        unknown = {(inst, name) for rows in pending.values() for _, inst, name, _ in rows} - self.ids.keys()
+        if unknown:
+            self.ids.update(pv_ids(cursor, unknown))
+        rows = {
+            TABLES[function]: [
+                (*self.ids[(inst, name)], value, 0, timestamp) for _, inst, name, value in function_updates
+            ]
+            for function, function_updates in pending.items()
+        }
+        if not rows:
+            return
+        start = time.perf_counter()
+        for table, table_rows in rows.items():
+            if self.method == "copy":
+                cursor.copy_expert(f"COPY {table} {COLUMNS} FROM STDIN", RowStream(table_rows))
+            else:
+                values = b",".join(cursor.mogrify("(%s, %s, %s, %s, %s)", row) for row in table_rows)
+                cursor.execute(f"INSERT INTO {table} {COLUMNS} VALUES ".encode() + values)
+        conn.commit()
+        if metrics is not None:
+            metrics.table.observe(time.perf_counter() - start)
+            metrics.messages.inc(sum(len(table_rows) for table_rows in rows.values()))
+
+
+def update_sender(path="function", method="copy"):
+    """
+    Function sending PV updates, with the signature of `send_updates`, for a way of writing them.
+
+    Parameters
+    ----------
+    path : str
+        One of `WRITE_PATHS`: "function" to send the updates through their SQL functions, "table" to write
+        them straight into the history tables with a `TableWriter`, or "both" to do one then the other,
+        each in its own transaction, so the time of both paths is observed on the same updates.
+    method : str
+        Method of the `TableWriter`, "copy" or "insert".
+
+    Returns
+    -------
+    Callable
+        The function sending updates.
+    """
+    if path == "function":
+        return send_updates
+    if path == "table":
+        return TableWriter(method)
+    table_writer = TableWriter(method, register=False)  # the SQL functions register the PVs first
+
+    def send_both(conn, cursor, updates, timestamp, metrics=None):
+        send_updates(conn, cursor, updates, timestamp, metrics)
+        table_writer(conn, cursor, updates, timestamp, metrics)
+
+    return send_both
+
+
+def shard(instrument, shards):
+    """Index of the shard for an instrument, stable across runs and processes."""
+    return zlib.crc32(instrument.encode()) % shards
+
+
+class Writer(threading.Thread):
+    """
+    Thread sending batches of PV updates through its own database connection.
+
+    Batches are taken from a bounded queue, so a producer putting batches into a full queue blocks until
+    the writer catches up. If the connection is lost, the writer reconnects and sends the batch again.
+
+    Parameters
+    ----------
+    connect : Callable[[], psycopg2.extensions.connection]
+        Opens a new connection to the database, e.g. a partial of `webmonchow.pv.broadcast.connect_to_database`.
+    queue_size : int
+        Maximum number of batches waiting to be sent.
+    max_batch_size : int
+        Maximum number of updates sent in one round trip. Larger batches are split.
+    name : Optional[str]
+        Name of the thread.
+    metrics : Optional[webmonchow.metrics.Metrics]
+        If given, the updates sent, the time to send and commit them, and the depth of the queue are observed.
+    send : Optional[Callable]
+        Sends a batch of updates, with the signature of `send_updates`, e.g. from `update_sender`.
+        Defaults to `send_updates`.
+    """
+
+    def __init__(self, connect, queue_size=100, max_batch_size=1000, name=None, metrics=None, send=None):
+        super().__init__(name=name, daemon=True)
+        self.connect = connect
+        self.send = send_updates if send is None else send
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.max_batch_size = max_batch_size
+        self.metrics = metrics
+        self.error = None
+
+    def run(self):
+        conn = cursor = None
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:  # no more batches
+                    break
+                timestamp, batch = item
+                for start in range(0, len(batch), self.max_batch_size):
+                    updates = batch[start : start + self.max_batch_size]
+                    while True:
+                        try:
+                            if conn is None:
+                                conn = self.connect()
+                                cursor = conn.cursor()
+                            self.send(conn, cursor, updates, timestamp, self.metrics)
+                            break
+                        except CONNECTION_ERRORS as e:
+                            print(f"{self.name} lost its connection to the database: {e}")
+                            close_connection(conn)
+                            conn = cursor = None
+        except Exception as e:  # noqa: BLE001 reported to the producer by `broadcast_sharded`
+            self.error = e
+        finally:
+            close_connection(conn)
+
+    def put(self, timestamp, batch):
+        """Queue a batch of updates, blocking while the queue is full. Raises RuntimeError if the writer died."""
+        if self.metrics is not None:
+            self.metrics.queue_depth.observe(self.queue.qsize())
+        while True:
+            if not self.is_alive():
+                raise RuntimeError(f"{self.name} stopped") from self.error
+            try:
+                self.queue.put((timestamp, batch), timeout=1.0)
+                return
+            except queue.Full:
+                continue
+
+    def stop(self):
+        """Let the writer send the queued batches, then wait for it to finish."""
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+        if self.error is not None:
+            raise RuntimeError(f"{self.name} stopped") from self.error
+
+
+def close_connection(conn):
+    """Close a connection to the database, ignoring the errors of a connection already lost."""
+    if conn is not None:
+        try:
+            conn.close()
+        except CONNECTION_ERRORS:
+            pass
+
+
+def broadcast_sharded(
+    connect, batch_gen, writers=4, queue_size=100, max_batch_size=1000, metrics=None, timer=None, send=None
+):
+    """
+    Sends batches of process variable (PV) updates through a pool of writers, each with its own connection.
+
+    Updates are sharded by instrument, so the updates of an instrument are always sent in order by the same writer,
+    and a slow instrument holds back only the instruments sharing its writer.
+
+    Parameters
+    ----------
+    connect : Callable[[], psycopg2.extensions.connection]
+        Opens a new connection to the database, e.g. a partial of `webmonchow.pv.broadcast.connect_to_database`.
+    batch_gen : generator
+        A python generator that yields lists of tuples containing the SQL function name, instrument, PV name,
+        and PV value, such as `webmonchow.pv.broadcast.pv_batch_generator`.
+    writers : int
+        Number of writers, and of database connections.
+    queue_size : int
+        Maximum number of batches waiting to be sent by each writer. The generator is held back while
+        the queue of a writer is full.
+    max_batch_size : int
+        Maximum number of updates sent in one round trip. Larger batches are split.
+    metrics : Optional[webmonchow.metrics.Metrics]
+        If given, the writers observe the updates sent, the time to send and commit them, and the depth of their queue.
+    timer : Optional[Callable[[], float]]
+        Gives the timestamp of each batch, in seconds since the epoch. Defaults to `time.time`.
+    send : Optional[Callable]
+        Sends a batch of updates, with the signature of `send_updates`, e.g. from `update_sender`.
+        Defaults to `send_updates`.
+    """
+    timer = time.time if timer is None else timer
+    pool = [Writer(connect, queue_size, max_batch_size, f"writer-{i}", metrics, send) for i in range(writers)]
+    for writer in pool:
+        writer.start()
+    try:
+        for batch in batch_gen:
+            timestamp = int(timer())
+            shards = [[] for _ in pool]
+            for update in batch:
+                shards[shard(update[1], writers)].append(update)
+            for writer, updates in zip(pool, shards):
+                if updates:
+                    writer.put(timestamp, updates)
+    finally:
+        for writer in pool:
+            writer.stop()
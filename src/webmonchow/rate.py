@@ -0,0 +1,296 @@
+r"""
+Load generation at a target rate of messages per second.
+
+Instead of replaying the frequencies of the content files, the broadcasters can emit messages at a target rate,
+possibly varying over time. The relative frequencies of the programmes are kept: the schedule of the content
+files is played faster or slower, by a clock whose time runs at (target rate) / (natural rate of the content).
+
+Rate profiles are written as
+
+- `5000/s`: constant rate. Units are `/s`, `/min` and `/h`, seconds being the default.
+- `step:1000/s@60,2000/s@60,5000/s`: 1000 messages per second for 60 seconds, then 2000/s for 60 seconds,
+  then 5000/s. The last step lasts forever.
+- `ramp:100/s..5000/s@300`: rate increasing linearly from 100/s to 5000/s over 300 seconds, then constant.
+- `burst:1000/s,10000/s@5/60`: 1000/s, with bursts of 10000/s lasting 5 seconds every 60 seconds.
+"""
+
+# standard imports
+import argparse
+import asyncio
+import bisect
+import itertools
+import math
+import time
+
+# webmonchow imports
+from webmonchow.scheduler import MonotonicClock
+
+_UNITS = {"s": 1.0, "min": 60.0, "h": 3600.0}
+
+
+def parse_rate(text):
+    """
+    Parse a rate such as "5000/s", "300/min", or "5000" (per second).
+
+    Returns
+    -------
+    float
+        The rate, in messages per second.
+
+    Raises
+    ------
+    ValueError
+        If the rate can't be parsed or is negative.
+    """
+    value, _, unit = text.strip().partition("/")
+    if unit.strip() not in ("", *_UNITS):
+        raise ValueError(f"unknown unit in rate {text!r}, expected one of /s, /min, /h")
+    rate = float(value) / _UNITS.get(unit.strip(), 1.0)
+    if rate < 0 or not math.isfinite(rate):
+        raise ValueError(f"rate must be a non-negative number, got {text!r}")
+    return rate
+
+
+def _parse_step(text):
+    rate, _, duration = text.partition("@")
+    return parse_rate(rate), float(duration) if duration else math.inf
+
+
+class RateProfile:
+    """
+    Target rate of messages as a function of time, made of segments where the rate is constant or varies linearly.
+
+    Parameters
+    ----------
+    segments : list[tuple]
+        Tuples of duration (seconds), rate at the start and rate at the end of the segment (messages per second).
+        Unless `repeat` is True, the last segment must have an infinite duration.
+    repeat : bool
+        Whether the segments repeat forever, e.g. for bursts.
+    """
+
+    def __init__(self, segments, repeat=False):
+        self._segments = list(segments)
+        self.repeat = repeat
+
+    def segments(self):
+        """Iterate over the segments of the profile, as tuples of duration, start rate and end rate."""
+        return itertools.cycle(self._segments) if self.repeat else iter(self._segments)
+
+    def rate(self, elapsed):
+        """Target rate, in messages per second, `elapsed` seconds after the start."""
+        start = 0.0
+        if self.repeat:
+            elapsed = elapsed % sum(duration for duration, _, _ in self._segments)
+        for duration, rate_start, rate_end in self.segments():
+            if elapsed < start + duration:
+                if duration == math.inf:
+                    return rate_start
+                return rate_start + (rate_end - rate_start) * (elapsed - start) / duration
+            start += duration
+        raise ValueError("the last segment of a rate profile must last forever")
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Parse a rate profile, see the documentation of module `webmonchow.rate` for the syntax.
+
+        Raises
+        ------
+        ValueError
+            If the profile can't be parsed.
+        """
+        kind, _, spec = text.strip().partition(":")
+        try:
+            if not spec:  # constant rate
+                return cls([(math.inf, parse_rate(kind), parse_rate(kind))])
+            if kind == "step":
+                steps = [_parse_step(step) for step in spec.split(",")]
+                steps[-1] = (steps[-1][0], math.inf)
+                return cls([(duration, rate, rate) for rate, duration in steps])
+            if kind == "ramp":
+                rates, _, duration = spec.partition("@")
+                start, _, end = rates.partition("..")
+                start, end = parse_rate(start), parse_rate(end)
+                return cls([(float(duration), start, end), (math.inf, end, end)])
+            if kind == "burst":
+                rates, _, timing = spec.partition("@")
+                base, _, peak = rates.partition(",")
+                length, _, period = timing.partition("/")
+                base, peak, length, period = parse_rate(base), parse_rate(peak), float(length), float(period)
+                if not 0 < length < period:
+                    raise ValueError("burst duration must be positive and shorter than its period")
+                return cls([(period - length, base, base), (length, peak, peak)], repeat=True)
+        except ValueError as e:
+            raise ValueError(f"invalid rate profile {text!r}: {e}") from e
+        raise ValueError(f"invalid rate profile {text!r}, expected a rate or one of step:, ramp:, burst:")
+
+
+def profile_argument(text):
+    """Parse a rate profile from the command line, see `RateProfile.parse`."""
+    try:
+        return RateProfile.parse(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e)) from e
+
+
+class WarpedClock:
+    """
+    Clock whose time runs faster or slower than the wall clock, so that a schedule emitting `natural_rate`
+    messages per second emits at the rate of a profile instead.
+
+    Parameters
+    ----------
+    profile : RateProfile
+        The target rate of messages as a function of the elapsed (wall clock) time.
+    natural_rate : float
+        Rate of messages of the schedule when played in real time, in messages per second.
+    origin : Optional[float]
+        Value of `time.monotonic()` taken as time zero. If None, the moment of creation is used.
+    """
+
+    def __init__(self, profile, natural_rate, origin=None):
+        if natural_rate <= 0:
+            raise ValueError("the schedule has no periodic messages to scale")
+        self.origin = time.monotonic() if origin is None else origin
+        self.natural_rate = natural_rate
+        self._segments = profile.segments()
+        # for each segment: wall time and clock time at its start, duration, speeds at its start and end
+        self._walls = []
+        self._taus = []
+        self._table = []
+        self._extend()
+
+    def _extend(self):
+        duration, rate_start, rate_end = next(self._segments)
+        wall, tau = 0.0, 0.0
+        if self._table:
+            wall = self._walls[-1] + self._table[-1][0]
+            tau = self._taus[-1] + self._advance(self._table[-1], self._table[-1][0])
+        self._walls.append(wall)
+        self._taus.append(tau)
+        self._table.append((duration, rate_start / self.natural_rate, rate_end / self.natural_rate))
+
+    @staticmethod
+    def _advance(segment, elapsed):
+        r"""Clock time elapsed `elapsed` wall seconds into a segment."""
+        duration, speed_start, speed_end = segment
+        if duration == math.inf or speed_start == speed_end:
+            return speed_start * elapsed
+        return speed_start * elapsed + (speed_end - speed_start) * elapsed**2 / (2 * duration)
+
+    def content_time(self, wall):
+        """Clock time at `wall` seconds after the origin."""
+        while self._walls[-1] + self._table[-1][0] <= wall:
+            self._extend()
+        index = bisect.bisect_right(self._walls, wall) - 1
+        return self._taus[index] + self._advance(self._table[index], wall - self._walls[index])
+
+    def wall_time(self, tau):
+        """Wall seconds after the origin at which the clock reaches time `tau`."""
+        while (
+            self._table[-1][0] < math.inf and self._taus[-1] + self._advance(self._table[-1], self._table[-1][0]) <= tau
+        ):
+            self._extend()
+        index = bisect.bisect_right(self._taus, tau) - 1
+        while self._table[index][1] == self._table[index][2] == 0 and index + 1 < len(self._table):
+            index += 1  # the clock is stopped during this segment, it reaches tau once it restarts
+        remaining = tau - self._taus[index]
+        duration, speed_start, speed_end = self._table[index]
+        if duration == math.inf or speed_start == speed_end:
+            if speed_start == 0:
+                raise ValueError("the rate profile ends with a rate of zero")
+            return self._walls[index] + remaining / speed_start
+        # solve speed_start * d + (speed_end - speed_start) * d**2 / (2 * duration) = remaining
+        a = (speed_end - speed_start) / (2 * duration)
+        discriminant = max(speed_start**2 + 4 * a * remaining, 0.0)
+        return self._walls[index] + min((-speed_start + math.sqrt(discriminant)) / (2 * a), duration)
+
+    def now(self):
+        """Clock time elapsed since the origin."""
+        return self.content_time(time.monotonic() - self.origin)
+
+    def sleep_until(self, deadline):
+        """Block until the clock reaches `deadline`. Returns immediately if already past."""
+        delay = self.wall_time(deadline) - (time.monotonic() - self.origin)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_until(self, deadline):
+        """Like `sleep_until`, but yield to the event loop instead of blocking."""
+        delay = self.wall_time(deadline) - (time.monotonic() - self.origin)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def rate_clock(profile, natural_rate, origin=None):
+    """
+    Clock of a schedule played at the rate of a profile, or in real time.
+
+    Parameters
+    ----------
+    profile : Optional[RateProfile]
+        The target rate. If None, the schedule is played in real time.
+    natural_rate : Optional[float]
+        Rate of messages of the schedule when played in real time, see `natural_rate`. Ignored without a profile.
+    origin : Optional[float]
+        Value of `time.monotonic()` taken as time zero. If None, the moment of creation is used.
+
+    Returns
+    -------
+    WarpedClock or webmonchow.scheduler.MonotonicClock
+    """
+    if profile is None:
+        return MonotonicClock(origin)
+    return WarpedClock(profile, natural_rate, origin)
+
+
+def natural_rate(frequencies):
+    """
+    Rate of messages of a schedule played in real time.
+
+    Parameters
+    ----------
+    frequencies : Iterable[float]
+        Time interval between messages of each programme or PV, in seconds. Zeros (sent once) are ignored.
+
+    Returns
+    -------
+    float
+        Messages per second.
+    """
+    return sum(1.0 / frequency for frequency in frequencies if frequency > 0)
+
+
+def report_rate(gen, profile=None, interval=10.0, size=None):
+    """
+    Pass through the items of a generator, printing the achieved rate every `interval` seconds.
+
+    Parameters
+    ----------
+    gen : generator
+        The generator of messages, PV updates, or batches of them.
+    profile : Optional[RateProfile]
+        The target rate, printed alongside the achieved rate.
+    interval : float
+        Time between two reports, in seconds.
+    size : Optional[Callable]
+        Number of messages in an item, e.g. `len` for batches. If None, each item counts as one message.
+
+    Yields
+    ------
+    object
+        The items of `gen`, unchanged.
+    """
+    start = last = time.monotonic()
+    count = total = 0
+    for item in gen:
+        yield item
+        count += 1 if size is None else size(item)
+        now = time.monotonic()
+        if now - last >= interval:
+            total += count
+            target = f" (target {profile.rate(now - start):.1f}/s)" if profile is not None else ""
+            print(f"Achieved {count / (now - last):.1f}/s{target}, {total} messages in {now - start:.0f} s")
+            last = now
+            count = 0
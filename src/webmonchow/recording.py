@@ -0,0 +1,439 @@
+r"""
+Record real AMQ messages or PV updates to a compact binary log, and replay them.
+
+A recording is an append-only file made of
+
+- a header, with the kind of records ("amq" or "pv"),
+- blocks of records, each compressed with zlib and preceded by its size, number of records, and first timestamp,
+- an index of the blocks, written when the recording is closed, so a replay can start at any time
+  without decompressing the blocks before it.
+
+A record holds the time it was received (seconds since the epoch), a channel (the destination of an AMQ message,
+or the SQL function of a PV update), and a payload (the body of the message, or the JSON of the instrument,
+name, and value of the PV). If the recorder is interrupted before writing the index, the index is rebuilt
+by scanning the blocks, and an incomplete last block is discarded.
+
+Replays memory-map the file and decompress one block at a time, so captures of any length are replayed
+without loading them into memory.
+"""
+
+# standard imports
+import argparse
+import csv
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+# third party imports
+import stomp
+
+# webmonchow imports
+from webmonchow.scheduler import MonotonicClock
+
+MAGIC = b"WMCREC1\n"
+INDEX_MAGIC = b"WMCIDX1\n"
+
+#: kinds of recordings
+KINDS = ("amq", "pv")
+
+# magic and kind of the recording
+_HEADER = struct.Struct("<8s8s")
+# size of the compressed block, number of records, time of the first record
+_BLOCK = struct.Struct("<IId")
+# time, length of the channel, length of the payload
+_RECORD = struct.Struct("<dHI")
+# offset, number of records, and time of the first record of a block
+_INDEX_ENTRY = struct.Struct("<QId")
+# offset of the index, number of blocks, magic
+_FOOTER = struct.Struct("<QQ8s")
+
+
+class RecordingError(ValueError):
+    """Raised when a file is not a recording, or not a recording of the expected kind"""
+
+
+def _read_header(buffer, path):
+    if len(buffer) < _HEADER.size:
+        raise RecordingError(f"{path} is not a webmonchow recording")
+    magic, kind = _HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise RecordingError(f"{path} is not a webmonchow recording")
+    return kind.rstrip(b"\0").decode()
+
+
+def _read_index(buffer):
+    r"""Index entries and end of the blocks, read from the footer or rebuilt by scanning the blocks."""
+    if len(buffer) >= _HEADER.size + _FOOTER.size:
+        index_offset, blocks, magic = _FOOTER.unpack_from(buffer, len(buffer) - _FOOTER.size)
+        if magic == INDEX_MAGIC and index_offset + blocks * _INDEX_ENTRY.size + _FOOTER.size == len(buffer):
+            entries = [_INDEX_ENTRY.unpack_from(buffer, index_offset + i * _INDEX_ENTRY.size) for i in range(blocks)]
+            return entries, index_offset
+    # no index, the recorder was interrupted: scan the complete blocks
+    entries = []
+    offset = _HEADER.size
+    while offset + _BLOCK.size <= len(buffer):
+        size, count, first = _BLOCK.unpack_from(buffer, offset)
+        if offset + _BLOCK.size + size > len(buffer):
+            break  # incomplete block
+        entries.append((offset, count, first))
+        offset += _BLOCK.size + size
+    return entries, offset
+
+
+class Recorder:
+    """
+    Writes records to a recording, appending to it if the file exists.
+
+    Parameters
+    ----------
+    path : str
+        Path to the recording.
+    kind : str
+        "amq" for AMQ messages, or "pv" for PV updates.
+    block_size : int
+        Number of records compressed together. Larger blocks compress better, smaller blocks lose fewer records
+        if the recorder is interrupted.
+
+    Raises
+    ------
+    RecordingError
+        If the file exists and is not a recording of the same kind.
+    """
+
+    def __init__(self, path, kind, block_size=1000):
+        if kind not in KINDS:
+            raise ValueError(f"kind must be one of {KINDS}, got {kind!r}")
+        self.path = path
+        self.kind = kind
+        self.block_size = block_size
+        self._records = []
+        self._first = None
+        self._lock = threading.Lock()
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                if _read_header(buffer, path) != kind:
+                    raise RecordingError(f"{path} is not a recording of {kind} records")
+                self._index, end = _read_index(buffer)
+            self._file = open(path, "r+b")
+            self._file.truncate(end)  # drop the index, written again on close
+            self._file.seek(end)
+        else:
+            self._index = []
+            self._file = open(path, "wb")
+            self._file.write(_HEADER.pack(MAGIC, kind.encode()))
+
+    def append(self, timestamp, channel, payload):
+        """
+        Record one message or PV update. Safe to call from several threads.
+
+        Parameters
+        ----------
+        timestamp : float
+            Time of the record, in seconds since the epoch.
+        channel : str
+            Destination of the AMQ message, or SQL function of the PV update.
+        payload : bytes
+            Body of the AMQ message, or JSON of the instrument, name, and value of the PV.
+        """
+        channel = channel.encode()
+        with self._lock:
+            if self._first is None:
+                self._first = timestamp
+            self._records.append(_RECORD.pack(timestamp, len(channel), len(payload)) + channel + payload)
+            if len(self._records) >= self.block_size:
+                self._write_block()
+
+    def append_update(self, timestamp, sql_function, instrument, name, value):
+        """Record one PV update."""
+        self.append(timestamp, sql_function, json.dumps([instrument, name, value]).encode())
+
+    def _write_block(self):
+        if not self._records:
+            return
+        data = zlib.compress(b"".join(self._records))
+        self._index.append((self._file.tell(), len(self._records), self._first))
+        self._file.write(_BLOCK.pack(len(data), len(self._records), self._first) + data)
+        self._file.flush()
+        self._records = []
+        self._first = None
+
+    def flush(self):
+        """Write the records received so far, even if they don't fill a block."""
+        with self._lock:
+            self._write_block()
+
+    def close(self):
+        """Write the last block and the index, and close the file."""
+        with self._lock:
+            self._write_block()
+            index_offset = self._file.tell()
+            for entry in self._index:
+                self._file.write(_INDEX_ENTRY.pack(*entry))
+            self._file.write(_FOOTER.pack(index_offset, len(self._index), INDEX_MAGIC))
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Recording:
+    """
+    Reads a recording lazily, from a memory map of the file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the recording.
+    kind : Optional[str]
+        If given, the kind of records expected.
+
+    Raises
+    ------
+    RecordingError
+        If the file is not a recording, or not a recording of the expected kind.
+    """
+
+    def __init__(self, path, kind=None):
+        self.path = path
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise RecordingError(f"{path} is not a webmonchow recording")
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.kind = _read_header(self._map, path)
+        if kind is not None and self.kind != kind:
+            raise RecordingError(f"{path} is a recording of {self.kind} records, not {kind}")
+        self._index, _ = _read_index(self._map)
+
+    def __len__(self):
+        return sum(count for _, count, _ in self._index)
+
+    @property
+    def start_time(self):
+        """Time of the first record, in seconds since the epoch, or None if the recording is empty."""
+        return self._index[0][2] if self._index else None
+
+    def records(self, start=None):
+        """
+        Iterate over the records, decompressing one block at a time.
+
+        Parameters
+        ----------
+        start : Optional[float]
+            If given, skip the records before this time, in seconds since the epoch.
+
+        Yields
+        ------
+        tuple
+            The time (seconds since the epoch), channel, and payload (bytes) of each record.
+        """
+        first_block = 0
+        if start is not None:  # the last block starting before `start` may hold the first record
+            while first_block + 1 < len(self._index) and self._index[first_block + 1][2] <= start:
+                first_block += 1
+        for offset, count, _ in self._index[first_block:]:
+            size, _, _ = _BLOCK.unpack_from(self._map, offset)
+            data = zlib.decompress(self._map[offset + _BLOCK.size : offset + _BLOCK.size + size])
+            position = 0
+            for _ in range(count):
+                timestamp, channel_length, payload_length = _RECORD.unpack_from(data, position)
+                position += _RECORD.size
+                channel = data[position : position + channel_length].decode()
+                position += channel_length
+                payload = data[position : position + payload_length]
+                position += payload_length
+                if start is None or timestamp >= start:
+                    yield timestamp, channel, payload
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def replay(recording, speed=1.0, clock=None):
+    """
+    Replay the records of a recording at their recorded pace.
+
+    Parameters
+    ----------
+    recording : Recording
+        The recording to replay.
+    speed : float
+        Playback speed, e.g. 1 for the recorded pace, 10 for ten times faster.
+        If infinite, records are replayed as fast as possible.
+    clock : Optional[webmonchow.scheduler.MonotonicClock]
+        Clock timing the replay. If None, a new `MonotonicClock` is used.
+
+    Yields
+    ------
+    tuple
+        The channel and payload of each record.
+    """
+    if speed <= 0:
+        raise ValueError(f"speed must be positive, got {speed}")
+    clock = MonotonicClock() if clock is None else clock
+    origin = recording.start_time
+    for timestamp, channel, payload in recording.records():
+        if math.isfinite(speed):
+            clock.sleep_until((timestamp - origin) / speed)
+        yield channel, payload
+
+
+def replay_messages(path, speed=1.0, clock=None):
+    """
+    Replay a recording of AMQ messages, in the format of `webmonchow.amq.broadcast.message_generator`.
+
+    Yields
+    ------
+    tuple
+        The destination and the body (bytes) of each message.
+    """
+    with Recording(path, "amq") as recording:
+        yield from replay(recording, speed, clock)
+
+
+def replay_updates(path, speed=1.0, clock=None):
+    """
+    Replay a recording of PV updates, in the format of `webmonchow.pv.broadcast.pv_generator`.
+
+    Yields
+    ------
+    tuple
+        The SQL function name, instrument, name, and value of each PV update.
+    """
+    with Recording(path, "pv") as recording:
+        for sql_function, payload in replay(recording, speed, clock):
+            instrument, name, value = json.loads(payload)
+            yield sql_function, instrument, name, value
+
+
+def record_trace(recorder, filename):
+    """
+    Record the PV updates of a CSV trace, with columns time (seconds since the epoch), instrument, name, and value.
+
+    Numeric values are recorded as updates of "pvUpdate", other values as updates of "pvStringUpdate".
+    An optional column "function" gives the SQL function explicitly.
+
+    Returns
+    -------
+    int
+        The number of updates recorded.
+    """
+    count = 0
+    with open(filename, newline="") as f:
+        for row in csv.DictReader(f):
+            value = row["value"]
+            try:
+                value = float(value)
+                sql_function = "pvUpdate"
+            except ValueError:
+                sql_function = "pvStringUpdate"
+            recorder.append_update(
+                float(row["time"]), row.get("function") or sql_function, row["instrument"], row["name"], value
+            )
+            count += 1
+    return count
+
+
+class _RecordingListener(stomp.ConnectionListener):
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.count = 0
+
+    def on_message(self, frame):
+        body = frame.body if isinstance(frame.body, bytes) else frame.body.encode()
+        self.recorder.append(time.time(), frame.headers["destination"], body)
+        self.count += 1
+
+
+def record_broker(recorder, connection, destinations, duration=None):
+    """
+    Record the messages received from a broker on some destinations.
+
+    Parameters
+    ----------
+    recorder : Recorder
+        The recorder of AMQ messages.
+    connection : stomp.Connection
+        An active connection to the AMQ message broker.
+    destinations : List[str]
+        Queues or topics to subscribe to, e.g. "/topic/SNS.>".
+    duration : Optional[float]
+        Time to record, in seconds. If None, record until interrupted.
+
+    Returns
+    -------
+    int
+        The number of messages recorded.
+    """
+    listener = _RecordingListener(recorder)
+    connection.set_listener("webmonchow-recorder", listener)
+    for index, destination in enumerate(destinations):
+        connection.subscribe(destination, id=f"webmonchow-recorder-{index}", ack="auto")
+    end = None if duration is None else time.monotonic() + duration
+    try:
+        while end is None or time.monotonic() < end:
+            time.sleep(10.0 if end is None else max(min(10.0, end - time.monotonic()), 0.0))
+            recorder.flush()
+            print(f"Recorded {listener.count} messages")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        connection.disconnect()
+    return listener.count
+
+
+def get_options(argv):
+    parser = argparse.ArgumentParser(description="Record AMQ messages from a broker, or PV updates from a trace")
+    parser.add_argument("output", help="Path to the recording. Records are appended if it exists")
+    parser.add_argument("--user", "-u", dest="user", default=os.getenv("ICAT_USER", "icat"))
+    parser.add_argument("--password", "-p", dest="password", default=os.getenv("ICAT_PASS", "icat"))
+    parser.add_argument("--broker", "-b", dest="broker", default=os.getenv("BROKER", "localhost:61613"))
+    parser.add_argument(
+        "--destinations",
+        default="/topic/SNS.>",
+        help="Queues and topics to record, separated by commas",
+    )
+    parser.add_argument(
+        "--pv-trace",
+        dest="pv_trace",
+        default=None,
+        help="CSV file of PV updates (columns time, instrument, name, value) to record instead of the broker",
+    )
+    parser.add_argument("--duration", type=float, default=None, help="Time (seconds) to record the broker")
+    parser.add_argument("--block-size", type=int, default=1000, help="Number of records compressed together")
+    options = parser.parse_args(argv)
+    return options
+
+
+def main(argv=None):
+    options = get_options(argv)
+    if options.pv_trace is not None:
+        with Recorder(options.output, "pv", options.block_size) as recorder:
+            count = record_trace(recorder, options.pv_trace)
+        print(f"Recorded {count} PV updates to {options.output}")
+        return
+    # imported here, as webmonchow.amq.broadcast imports this module to replay recordings
+    from webmonchow.amq.broadcast import connect_to_broker
+
+    connection = connect_to_broker(options.broker, options.user, options.password)
+    with Recorder(options.output, "amq", options.block_size) as recorder:
+        destinations = [destination.strip() for destination in options.destinations.split(",")]
+        count = record_broker(recorder, connection, destinations, options.duration)
+    print(f"Recorded {count} messages to {options.output}")
+
+
+if __name__ == "__main__":
+    main()
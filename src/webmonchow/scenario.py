@@ -0,0 +1,247 @@
+r"""
+Scenarios: scripted run lifecycles of simulated instruments, sending correlated AMQ messages and PV updates.
+
+A scenario describes one run, repeated forever on every instrument: the steps of the run are AMQ messages sent
+at given times since the start of the run, and the PVs of the run are updated throughout. For instance,
+a run starts with DASMON messages announcing the recording, continues with count rate updates, and ends with
+a DATA_READY message followed by the messages of the postprocessing chain.
+
+.. code-block:: json
+
+    {"instruments": 10,
+     "run_period": 120,
+     "steps": [
+       {"at": 0, "every": 5, "until": 100, "destination": "/topic/SNS.{instrument}.APP.DASMON",
+        "message": {"run_number": 0, "recording": true}, "fields": {"run_number": "{run}"}},
+       {"at": 100, "destination": "POSTPROCESS.DATA_READY",
+        "message": {"instrument": "{instrument}", "run_number": "{run}"}}],
+     "pvs": [
+       {"sql_function": "pvUpdate", "name": "count_rate", "frequency": 5, "function": "9000*({phase}<100)"}]}
+
+Keys of a scenario:
+
+- `instruments`: number of simulated instruments, named `prefix` (default "SIM") followed by a number,
+  or the list of their names.
+- `run_period`: time between the starts of two runs of an instrument, in seconds.
+- `stagger`: time between the starts of the runs of two consecutive instruments, in seconds.
+  By default the instruments are spread evenly over the run period.
+- `first_run`: number of the first run of every instrument (default 1).
+- `steps`: AMQ messages of a run. A step is sent at time `at` of the run, or if `every` is given, every `every`
+  seconds from `at` until `until` (default the end of the run). `{instrument}` is replaced with the name
+  of the instrument in the destination and in the strings of the message, and strings containing `{run}`
+  get the number of the run. Generated `fields` (see `webmonchow.amq.templates`) may use `{run}` too.
+- `pvs`: PVs of every instrument, with the keys of PVs in content files and the name of their `sql_function`.
+  Besides `{x}`, their functions may use `{run}`, the number of the current run, and `{phase}`,
+  the time since its start.
+- `seed`: if given, every PV draws its random numbers from its own stream seeded from it,
+  see `webmonchow.pv.broadcast.compile_contents`.
+
+Every step of every instrument is a periodic item of the scheduler, with the run period as its period
+and its time in the run, plus the offset of the instrument, as its offset. All steps of a run thus come
+from one timeline, and the run number of a message is the number of messages already sent by its step.
+"""
+
+# standard imports
+import json
+import os
+
+# webmonchow imports
+from webmonchow.amq.broadcast import serialize_contents
+from webmonchow.pv.broadcast import compile_contents
+from webmonchow.pv.expressions import ExpressionError
+
+
+class ScenarioError(ValueError):
+    """Raised when a scenario is not valid."""
+
+
+def scenario_files():
+    r"""Absolute paths to the scenario *.json files shipped under directory scenarios/, by name."""
+    scenarios_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scenarios")
+    return {
+        os.path.splitext(filename)[0]: os.path.join(scenarios_dir, filename)
+        for filename in sorted(os.listdir(scenarios_dir))
+        if filename.endswith(".json")
+    }
+
+
+def load_scenario(filename):
+    """
+    Reads a scenario file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to a JSON scenario file, or the name of a scenario shipped with webmonchow (see `scenario_files`).
+
+    Returns
+    -------
+    dict
+        The scenario.
+    """
+    if not os.path.exists(filename) and filename in scenario_files():
+        filename = scenario_files()[filename]
+    with open(filename) as f:
+        return json.load(f)
+
+
+def instrument_names(scenario):
+    """Names of the simulated instruments of a scenario."""
+    instruments = scenario.get("instruments", 1)
+    if isinstance(instruments, list):
+        return instruments
+    prefix = scenario.get("prefix", "SIM")
+    width = len(str(instruments))
+    return [f"{prefix}{number:0{width}d}" for number in range(1, instruments + 1)]
+
+
+def _replace_instrument(value, instrument):
+    r"""Replace "{instrument}" in the strings of a message, and in the keys of its objects."""
+    if isinstance(value, str):
+        return value.replace("{instrument}", instrument)
+    if isinstance(value, list):
+        return [_replace_instrument(item, instrument) for item in value]
+    if isinstance(value, dict):
+        return {_replace_instrument(k, instrument): _replace_instrument(v, instrument) for k, v in value.items()}
+    return value
+
+
+def _run_fields(value, run, path=""):
+    r"""Expressions of the strings of a message containing "{run}", by dotted path."""
+    if isinstance(value, str) and "{run}" in value:
+        parts = [repr(part).replace("{", "{{").replace("}", "}}") for part in value.split("{run}")]
+        return {path: f" + str({run}) + ".join(parts)}
+    fields = {}
+    items = enumerate(value) if isinstance(value, list) else value.items() if isinstance(value, dict) else ()
+    for key, item in items:
+        fields.update(_run_fields(item, run, f"{path}.{key}" if path else str(key)))
+    return fields
+
+
+def _times(step, run_period):
+    r"""Times of the messages of a step, in seconds since the start of the run."""
+    at = step.get("at", 0.0)
+    every = step.get("every")
+    until = step.get("until", run_period)
+    if not 0 <= at < run_period:
+        raise ScenarioError(f"step at {at} s is not within the run period of {run_period} s")
+    if every is None:
+        return [at]
+    if every <= 0 or until > run_period:
+        raise ScenarioError(f"step every {every} s until {until} s: 'every' must be positive, 'until' within the run")
+    count = int((until - at) / every) + 1
+    return [at + index * every for index in range(count) if at + index * every < until]
+
+
+def _programme(step, instrument, run_period, first_run):
+    r"""Destination and programme of a step of a run of an instrument."""
+    destination = _replace_instrument(step["destination"], instrument)
+    message = _replace_instrument(step["message"], instrument)
+    # each programme fires once per run, so {n} counts the runs
+    run = f"({first_run}+{{n}})"
+    fields = _run_fields(message, run)
+    for path, expression in step.get("fields", {}).items():
+        fields[path] = _replace_instrument(expression, instrument).replace("{run}", run)
+    programme = {"frequency": run_period, "message": message}
+    if fields:
+        programme["fields"] = fields
+    return destination, programme
+
+
+def _pv(entry, instrument, start, run_period, first_run):
+    r"""PV of an instrument whose runs start at `start` plus multiples of `run_period`."""
+    function = entry["function"]
+    if isinstance(function, str):
+        run = f"({first_run}+int(({{x}}-{start})//{run_period}))"
+        phase = f"(({{x}}-{start})%{run_period})"
+        function = _replace_instrument(function, instrument).replace("{run}", run).replace("{phase}", phase)
+    return {
+        "frequency": entry["frequency"],
+        "instrument": instrument,
+        "name": _replace_instrument(entry["name"], instrument),
+        "function": function,
+    }
+
+
+def compile_scenario(scenario):
+    """
+    Expands a scenario into the AMQ programmes and PVs of every instrument, with the offset of each programme.
+
+    Parameters
+    ----------
+    scenario : dict
+        The scenario, see the module documentation.
+
+    Returns
+    -------
+    tuple
+        AMQ content, in the format returned by `webmonchow.amq.broadcast.serialize_contents`, where the frequency
+        of every programme is the run period; the offset of each programme, as lists in the same format;
+        and PV content, in the format returned by `webmonchow.pv.broadcast.compile_contents`.
+
+    Raises
+    ------
+    ScenarioError
+        If the scenario is not valid.
+    ExpressionError
+        If any of the generated fields or PV functions can't be compiled.
+    """
+    try:
+        run_period = float(scenario["run_period"])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ScenarioError(f"invalid run period: {e!r}") from e
+    if run_period <= 0:
+        raise ScenarioError(f"run period must be positive, got {run_period}")
+    instruments = instrument_names(scenario)
+    stagger = scenario.get("stagger", run_period / max(len(instruments), 1))
+    first_run = int(scenario.get("first_run", 1))
+    amq_data = {}
+    offsets = {}
+    pv_data = {}
+    for index, instrument in enumerate(instruments):
+        start = index * stagger
+        for step in scenario.get("steps", []):
+            destination, programme = _programme(step, instrument, run_period, first_run)
+            for time in _times(step, run_period):
+                amq_data.setdefault(destination, []).append(programme)
+                offsets.setdefault(destination, []).append(start + time)
+        for entry in scenario.get("pvs", []):
+            pv_data.setdefault(entry.get("sql_function", "pvUpdate"), []).append(
+                _pv(entry, instrument, start, run_period, first_run)
+            )
+    try:
+        return serialize_contents(amq_data), offsets, compile_contents(pv_data, scenario.get("seed"))
+    except ExpressionError as e:
+        raise ExpressionError(f"scenario: {e}") from e
+
+
+def schedule_scenario(scheduler, scenario):
+    """
+    Add the AMQ programmes and PVs of a scenario to a scheduler, in the format of
+    `webmonchow.engine.schedule_contents`.
+
+    Parameters
+    ----------
+    scheduler : webmonchow.scheduler.Scheduler
+        The scheduler to add the programmes and PVs to.
+    scenario : dict
+        The scenario, see the module documentation.
+
+    Returns
+    -------
+    tuple
+        Number of AMQ messages and of PV updates of all the instruments, per run period.
+    """
+    amq_data, offsets, pv_data = compile_scenario(scenario)
+    messages = 0
+    for queue_or_topic, programmes in amq_data.items():
+        for programme, offset in zip(programmes, offsets[queue_or_topic]):
+            scheduler.add(("amq", queue_or_topic, programme.message), programme.frequency, offset)
+            messages += 1
+    updates = 0.0
+    run_period = float(scenario["run_period"])
+    for sql_function, pvs in pv_data.items():
+        for entry in pvs:
+            scheduler.add(("pv", sql_function, entry), entry.frequency)
+            updates += run_period / entry.frequency if entry.frequency > 0 else 0
+    return messages, int(updates)
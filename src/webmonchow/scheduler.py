@@ -0,0 +1,221 @@
+# standard imports
+import asyncio
+import heapq
+import itertools
+import math
+import time
+
+
+class MonotonicClock:
+    """
+    Clock measuring the seconds elapsed since its creation with `time.monotonic`.
+
+    Parameters
+    ----------
+    origin : Optional[float]
+        Value of `time.monotonic()` taken as time zero. If None, the moment of creation is used.
+    """
+
+    def __init__(self, origin=None):
+        self.origin = time.monotonic() if origin is None else origin
+
+    def now(self):
+        """Seconds elapsed since the origin of the clock."""
+        return time.monotonic() - self.origin
+
+    def sleep_until(self, deadline):
+        """Block until `deadline` seconds have elapsed since the origin. Returns immediately if already past."""
+        delay = deadline - self.now()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_until(self, deadline):
+        """Like `sleep_until`, but yield to the event loop instead of blocking."""
+        delay = deadline - self.now()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class SimulatedClock:
+    """
+    Clock of simulated time, running `speed` times faster than the wall clock from time `offset`.
+
+    Parameters
+    ----------
+    speed : float
+        Simulated seconds per second of the wall clock.
+    offset : float
+        Simulated time at the origin of the clock, in seconds. Schedules start at this time, see `Scheduler`.
+    sleep : bool
+        If False, the clock never sleeps: it jumps to the deadlines it's asked to wait for,
+        so a schedule runs as fast as its items are consumed.
+    origin : Optional[float]
+        Value of `time.monotonic()` taken as time zero. If None, the moment of creation is used.
+    """
+
+    def __init__(self, speed=1.0, offset=0.0, sleep=True, origin=None):
+        if speed <= 0:
+            raise ValueError(f"Speed must be positive, got {speed}")
+        self.speed = speed
+        self.start = offset
+        self.sleep = sleep
+        self.origin = time.monotonic() if origin is None else origin
+        self._time = offset
+
+    def now(self):
+        """Simulated time, in seconds."""
+        if not self.sleep:
+            return self._time
+        return self.start + self.speed * (time.monotonic() - self.origin)
+
+    def _delay(self, deadline):
+        if not self.sleep:
+            self._time = max(self._time, deadline)
+            return 0.0
+        return (deadline - self.now()) / self.speed
+
+    def sleep_until(self, deadline):
+        """Block until the simulated time reaches `deadline`. Returns immediately if already past."""
+        delay = self._delay(deadline)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_until(self, deadline):
+        """Like `sleep_until`, but yield to the event loop instead of blocking."""
+        delay = self._delay(deadline)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class Scheduler:
+    """
+    Priority queue of periodic items ordered by their next deadline.
+
+    Each item fires at `offset + n * period` for n = 0, 1, 2, ..., so rounding errors and late wake-ups
+    never accumulate into drift. Items with a period of zero fire once, at their offset.
+    Items sharing a deadline fire in the order they were added.
+
+    Parameters
+    ----------
+    clock : Optional[MonotonicClock]
+        Object with methods `now()`, `sleep_until(deadline)` and, for asynchronous iteration, coroutine
+        `wait_until(deadline)`. If None, a new `MonotonicClock` is used.
+        If the clock has an attribute `start`, offsets of items count from this time instead of zero.
+    metrics : Optional[webmonchow.metrics.Metrics]
+        If given, the lag between the deadline of each item (or batch) and the moment it fires is observed.
+    end : Optional[float]
+        If given, items no longer fire after this time of the clock, and iteration stops.
+    """
+
+    def __init__(self, clock=None, metrics=None, end=None):
+        self.clock = MonotonicClock() if clock is None else clock
+        self.metrics = metrics
+        self.start = getattr(self.clock, "start", 0.0)
+        self.end = math.inf if end is None else end
+        self._heap = []
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, item, period, offset=0.0):
+        """
+        Schedule an item.
+
+        Parameters
+        ----------
+        item : object
+            The object yielded every time the deadline of the item is reached.
+        period : float
+            Time interval between two consecutive firings, in seconds. If 0, the item fires only once.
+        offset : float
+            Time of the first firing, in seconds since the start of the clock.
+        """
+        if period < 0:
+            raise ValueError(f"Period must be non-negative, got {period}")
+        deadline = self.start + float(offset)
+        if deadline <= self.end:
+            heapq.heappush(self._heap, (deadline, next(self._sequence), 0, float(period), deadline, item))
+
+    def __iter__(self):
+        """
+        Sleep until the earliest deadline and yield the item due, for as long as items remain scheduled.
+
+        Yields
+        ------
+        tuple
+            A tuple containing the deadline (seconds since the origin of the clock) and the item.
+        """
+        heap = self._heap
+        while heap:
+            deadline, sequence, count, period, offset, item = heapq.heappop(heap)
+            self.clock.sleep_until(deadline)
+            if self.metrics is not None:
+                self.metrics.lag.observe(max(self.clock.now() - deadline, 0.0))
+            if period > 0 and offset + (count + 1) * period <= self.end:
+                count += 1
+                heapq.heappush(heap, (offset + count * period, sequence, count, period, offset, item))
+            yield deadline, item
+
+    def batches(self, max_delay=0.0):
+        """
+        Like iterating over the scheduler, but yield together all the items due at about the same time.
+
+        A batch starts with the earliest deadline and gathers the items due up to `max_delay` seconds later.
+        The scheduler sleeps until the last deadline in the batch, so no item fires early and none fires
+        more than `max_delay` seconds late.
+
+        Parameters
+        ----------
+        max_delay : float
+            Maximum time an item is held back waiting for the rest of the batch, in seconds.
+            If 0, batches contain only the items sharing the same deadline.
+
+        Yields
+        ------
+        list
+            A list of tuples, each containing the deadline and an item, in the order they are due.
+        """
+        while self._heap:
+            batch = self._pop_batch(max_delay)
+            self.clock.sleep_until(batch[-1][0])
+            self._observe_lag(batch)
+            yield batch
+
+    async def abatches(self, max_delay=0.0):
+        """
+        Asynchronous version of `batches`, waiting for the deadlines without blocking the event loop.
+
+        Parameters
+        ----------
+        max_delay : float
+            Maximum time an item is held back waiting for the rest of the batch, in seconds.
+
+        Yields
+        ------
+        list
+            A list of tuples, each containing the deadline and an item, in the order they are due.
+        """
+        while self._heap:
+            batch = self._pop_batch(max_delay)
+            await self.clock.wait_until(batch[-1][0])
+            self._observe_lag(batch)
+            yield batch
+
+    def _observe_lag(self, batch):
+        r"""Observe the lag of the last item of a batch, the earlier items being held back on purpose."""
+        if self.metrics is not None:
+            self.metrics.lag.observe(max(self.clock.now() - batch[-1][0], 0.0))
+
+    def _pop_batch(self, max_delay):
+        r"""Pop the items due up to `max_delay` seconds after the earliest deadline, and reschedule them."""
+        heap = self._heap
+        cutoff = heap[0][0] + max_delay
+        batch = []
+        while heap and heap[0][0] <= cutoff:
+            deadline, sequence, count, period, offset, item = heapq.heappop(heap)
+            if period > 0 and offset + (count + 1) * period <= self.end:
+                count += 1
+                heapq.heappush(heap, (offset + count * period, sequence, count, period, offset, item))
+            batch.append((deadline, item))
+        return batch
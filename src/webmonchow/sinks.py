@@ -0,0 +1,350 @@
+r"""
+Local stand-ins for the AMQ broker and the PostgreSQL database, to run the broadcasters without external services.
+
+The sinks implement the part of `stomp.Connection` and of psycopg2 connections used by the broadcasters:
+
+- `NullStompConnection` and `NullDatabaseConnection` only count what they receive.
+- `NdjsonStompConnection` and `RecorderConnection` given a file write every message or PV update
+  as a line of JSON, with the time it was received.
+- `RecorderConnection` records the calls to each SQL function, and the latest value of each PV.
+- `StompServer` is a minimal STOMP server on the local host, so the broadcaster goes through a real
+  STOMP client and socket.
+
+Every sink counts what it receives in a `SinkStats`, to compare the throughput seen by the sink
+with the one reported by the broadcaster.
+"""
+
+# standard imports
+import json
+import re
+import socketserver
+import threading
+import time
+
+# third party imports
+from psycopg2.extensions import adapt
+from stomp.utils import Frame
+
+# name of the SQL function called by a statement of the broadcasters
+_FUNCTION = re.compile(r"SELECT \* FROM (\w+)\(")
+
+
+class SinkStats:
+    """Messages or PV updates received by sinks, their size, and the times of the first and last ones."""
+
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.first = None
+        self.last = None
+        self._lock = threading.Lock()
+
+    def record(self, count=1, size=0):
+        """Count `count` messages or PV updates of `size` bytes in total, received now."""
+        now = time.perf_counter()
+        with self._lock:
+            self.count += count
+            self.bytes += size
+            if self.first is None:
+                self.first = now
+            self.last = now
+
+    def summary(self):
+        """One line with the number of messages or PV updates received, and their rate."""
+        elapsed = 0.0 if self.first is None else self.last - self.first
+        rate = f"{self.count / elapsed:.1f}/s" if elapsed > 0 else "n/a"
+        return f"{self.count} received, {self.bytes} bytes, in {elapsed:.2f} s ({rate})"
+
+
+class NdjsonFile:
+    """
+    File of JSON records, one per line, shared by the threads of a broadcaster.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file, overwritten.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "w")
+        self._lock = threading.Lock()
+
+    def write(self, line):
+        """Write a line of JSON, without its end of line."""
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class NullStompConnection:
+    """
+    Stand-in for `stomp.Connection`, counting the messages and bytes sent. Messages sent with a receipt header
+    are acknowledged right away.
+
+    Parameters
+    ----------
+    stats : Optional[SinkStats]
+        Counts the messages received. If None, a new one is used.
+    """
+
+    def __init__(self, stats=None):
+        self.stats = SinkStats() if stats is None else stats
+        self._listeners = {}
+
+    def set_listener(self, name, listener):
+        self._listeners[name] = listener
+
+    def is_connected(self):
+        return True
+
+    def disconnect(self):
+        pass
+
+    def send(self, destination, body, **headers):
+        body = body if isinstance(body, bytes) else body.encode()
+        self.stats.record(1, len(body))
+        self._receive(destination, body)
+        if "receipt" in headers:
+            frame = Frame("RECEIPT", {"receipt-id": headers["receipt"]})
+            for listener in list(self._listeners.values()):
+                listener.on_receipt(frame)
+
+    def _receive(self, destination, body):
+        r"""Handle a message after it's counted."""
+
+
+class NdjsonStompConnection(NullStompConnection):
+    """
+    Stand-in for `stomp.Connection`, writing every message to a file of JSON records with keys
+    "time" (seconds since the epoch), "destination", and "message".
+
+    Parameters
+    ----------
+    file : NdjsonFile
+        The file of records.
+    stats : Optional[SinkStats]
+        Counts the messages received. If None, a new one is used.
+    """
+
+    def __init__(self, file, stats=None):
+        super().__init__(stats)
+        self.file = file
+
+    def _receive(self, destination, body):
+        try:
+            message = json.dumps(json.loads(body))
+        except ValueError:
+            message = json.dumps(body.decode(errors="replace"))
+        self.file.write(f'{{"time": {time.time()!r}, "destination": {json.dumps(destination)}, "message": {message}}}')
+
+
+class _Cursor:
+    r"""Cursor of the fake database connections, quoting the arguments of statements as psycopg2 does."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.statements = 0
+        self._result = None
+
+    def mogrify(self, query, args):
+        match = _FUNCTION.match(query)
+        if match is not None:
+            self.connection._calls.append((match.group(1), *args))
+        return (query % tuple(adapt(arg).getquoted().decode() for arg in args)).encode()
+
+    def execute(self, query, args=None):
+        if args is not None:
+            query = self.mogrify(query, args)
+        if isinstance(query, bytes) and query.startswith(b"INSERT INTO"):  # rows written without the SQL functions
+            self.connection.stats.record(query.count(b"),(") + 1, len(query))
+        self.statements += query.count(b";") + 1
+        self._result = (1,)
+
+    def fetchone(self):
+        return self._result
+
+    def copy_expert(self, sql, file, size=8192):  # noqa: ARG002 signature of psycopg2 cursors
+        rows = 0
+        size_read = 0
+        while chunk := file.read(size):
+            rows += chunk.count("\n")
+            size_read += len(chunk)
+        self.connection.stats.record(rows, size_read)
+
+    def close(self):
+        pass
+
+
+class NullDatabaseConnection:
+    """
+    Stand-in for a psycopg2 connection, counting the PV updates committed.
+
+    Parameters
+    ----------
+    stats : Optional[SinkStats]
+        Counts the PV updates committed. If None, a new one is used.
+    """
+
+    def __init__(self, stats=None):
+        self.stats = SinkStats() if stats is None else stats
+        self.commits = 0
+        self._calls = []  # calls to SQL functions since the last commit
+        self._cursor = _Cursor(self)
+
+    def cursor(self):
+        return self._cursor
+
+    def commit(self):
+        self.commits += 1
+        if self._calls:
+            self.stats.record(len(self._calls))
+            self._commit(self._calls)
+            self._calls = []
+
+    def rollback(self):
+        self._calls = []
+
+    def close(self):
+        pass
+
+    def _commit(self, calls):
+        r"""Handle the calls to SQL functions of a transaction, after they're counted."""
+
+
+class RecorderConnection(NullDatabaseConnection):
+    """
+    Stand-in for a psycopg2 connection, recording the calls to the SQL functions of the PV updates committed.
+
+    Parameters
+    ----------
+    file : Optional[NdjsonFile]
+        If given, every call is written as a JSON record with keys "time" (seconds since the epoch), "function",
+        "instrument", "name", "value", "status", and "update_time".
+    stats : Optional[SinkStats]
+        Counts the PV updates committed. If None, a new one is used.
+
+    Attributes
+    ----------
+    calls : dict
+        Number of calls to each SQL function.
+    values : dict
+        Latest value of each PV, by instrument and name.
+    """
+
+    def __init__(self, file=None, stats=None):
+        super().__init__(stats)
+        self.file = file
+        self.calls = {}
+        self.values = {}
+
+    def _commit(self, calls):
+        now = time.time()
+        for function, instrument, name, value, status, update_time in calls:
+            self.calls[function] = self.calls.get(function, 0) + 1
+            self.values[(instrument, name)] = value
+            if self.file is not None:
+                record = {
+                    "time": now,
+                    "function": function,
+                    "instrument": instrument,
+                    "name": name,
+                    "value": value,
+                    "status": status,
+                    "update_time": update_time,
+                }
+                self.file.write(json.dumps(record))
+
+
+class _StompHandler(socketserver.StreamRequestHandler):
+    r"""One client connection of `StompServer`."""
+
+    def handle(self):
+        while True:
+            frame = self._read_frame()
+            if frame is None:
+                return
+            command, headers, body = frame
+            if command in ("CONNECT", "STOMP"):
+                version = headers.get("accept-version", "1.0").split(",")[-1]
+                self._write_frame("CONNECTED", {"version": version, "heart-beat": "0,0", "server": "webmonchow"})
+                continue
+            if command == "SEND":
+                self.server.stats.record(1, len(body))
+            if "receipt" in headers:
+                self._write_frame("RECEIPT", {"receipt-id": headers["receipt"]})
+            if command == "DISCONNECT":
+                return
+
+    def _read_frame(self):
+        r"""Command, headers and body of the next frame, or None at the end of the connection."""
+        line = b"\n"
+        while line in (b"\n", b"\r\n"):  # heart-beats
+            line = self.rfile.readline()
+            if not line:
+                return None
+        command = line.strip().decode()
+        headers = {}
+        while (line := self.rfile.readline().rstrip(b"\r\n")) != b"":
+            key, _, value = line.decode().partition(":")
+            headers.setdefault(key, value)  # the first occurrence of a header wins
+        if "content-length" in headers:
+            body = self.rfile.read(int(headers["content-length"]))
+            self.rfile.read(1)  # NUL
+        else:
+            body = b""
+            while (byte := self.rfile.read(1)) not in (b"\x00", b""):
+                body += byte
+        return command, headers, body
+
+    def _write_frame(self, command, headers):
+        lines = [command, *(f"{key}:{value}" for key, value in headers.items())]
+        self.wfile.write(("\n".join(lines) + "\n\n").encode() + b"\x00")
+        self.wfile.flush()
+
+
+class StompServer(socketserver.ThreadingTCPServer):
+    """
+    Minimal STOMP server, accepting any login, counting the messages sent to it, and sending the receipts
+    requested. Messages are not delivered to subscribers.
+
+    Parameters
+    ----------
+    host : str
+        The address to listen on.
+    port : int
+        The port to listen on. If 0, a free port is picked, see `address`.
+    stats : Optional[SinkStats]
+        Counts the messages received. If None, a new one is used.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, stats=None):
+        super().__init__((host, port), _StompHandler)
+        self.stats = SinkStats() if stats is None else stats
+
+    @property
+    def address(self):
+        """The address of the server, "host:port", as accepted by `webmonchow.amq.broadcast.connect_to_broker`."""
+        host, port = self.server_address[:2]
+        return f"{host}:{port}"
+
+
+def serve_stomp(host="127.0.0.1", port=0, stats=None):
+    """
+    Start a `StompServer` in a daemon thread.
+
+    Returns
+    -------
+    StompServer
+        The server, to be stopped with `shutdown()`.
+    """
+    server = StompServer(host, port, stats)
+    threading.Thread(target=server.serve_forever, name="stomp-server", daemon=True).start()
+    return server
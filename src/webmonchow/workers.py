@@ -0,0 +1,169 @@
+r"""
+Broadcast from several processes, to generate more load than one CPU core can.
+
+The content is partitioned across worker processes, each with its own connection to the broker or the database.
+All workers schedule their messages on clocks sharing the same origin, so their ticks stay aligned as if
+the content was broadcast by a single process. The workers send their metrics to the parent process,
+which reports them together.
+"""
+
+# standard imports
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+import zlib
+
+# webmonchow imports
+from webmonchow.metrics import Metrics
+
+#: Time between two transfers of the metrics of a worker to the parent process, in seconds
+TRANSFER_INTERVAL = 1.0
+
+
+def partition_destinations(data, workers):
+    """
+    Split AMQ content across workers, assigning the destinations to the workers in turn.
+
+    Parameters
+    ----------
+    data : dict
+        AMQ content, a dictionary where each key is a destination and each value is a list of programmes.
+    workers : int
+        Number of parts.
+
+    Returns
+    -------
+    list
+        The content of each worker, in the same format as `data`. Some may be empty.
+    """
+    parts = [{} for _ in range(workers)]
+    for index, (queue_or_topic, programmes) in enumerate(data.items()):
+        parts[index % workers][queue_or_topic] = programmes
+    return parts
+
+
+def partition_pvs(data, workers):
+    """
+    Split PV content across workers by instrument, so the updates of an instrument are sent in order by one worker.
+
+    Parameters
+    ----------
+    data : dict
+        PV content, a dictionary where each key is the name of an SQL function and each value is a list of PVs.
+    workers : int
+        Number of parts.
+
+    Returns
+    -------
+    list
+        The content of each worker, in the same format as `data`. Some may be empty.
+    """
+    parts = [{} for _ in range(workers)]
+    for sql_function, pvs in data.items():
+        for pv in pvs:
+            part = parts[zlib.crc32(pv["instrument"].encode()) % workers]
+            part.setdefault(sql_function, []).append(pv)
+    return parts
+
+
+def _transfer(metrics, results, index, stopped):
+    r"""Send the metrics of a worker to the parent every `TRANSFER_INTERVAL` seconds, until stopped."""
+    while not stopped.wait(TRANSFER_INTERVAL):
+        results.put((index, metrics.drain()))
+
+
+def _run(target, index, part, origin, results):
+    r"""Body of a worker process."""
+    metrics = Metrics()
+    stopped = threading.Event()
+    transfer = threading.Thread(target=_transfer, args=(metrics, results, index, stopped), daemon=True)
+    transfer.start()
+    try:
+        target(part, origin, metrics)
+    except KeyboardInterrupt:
+        pass  # stopped by the parent, or by Ctrl-C in the terminal
+    finally:
+        stopped.set()
+        transfer.join()
+        results.put((index, metrics.drain()))
+        results.put((index, None))  # done
+
+
+def run_workers(target, parts, metrics=None, start_delay=1.0):
+    """
+    Run a broadcast in one process per part of the content, until all of them finish.
+
+    Parameters
+    ----------
+    target : Callable
+        Broadcasts a part of the content, called in each worker process as `target(part, origin, metrics)`
+        where `origin` is the value of `time.monotonic()` shared by the clocks of all workers, and `metrics`
+        the `webmonchow.metrics.Metrics` of the worker. Must be picklable, e.g. a partial of a module function.
+    parts : list
+        The part of the content of each worker, e.g. from `partition_pvs` or `partition_destinations`.
+    metrics : Optional[webmonchow.metrics.Metrics]
+        Metrics the metrics of the workers are merged into, as they are received.
+    start_delay : float
+        Time given to the workers to load their content and connect before the first tick, in seconds.
+
+    Returns
+    -------
+    list
+        The number of messages or PV updates sent by each worker.
+
+    Raises
+    ------
+    RuntimeError
+        If a worker fails. The other workers are terminated.
+    """
+    metrics = Metrics() if metrics is None else metrics
+    origin = time.monotonic() + start_delay  # time.monotonic is the same clock in all the processes of a host
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=_run, args=(target, index, part, origin, results), name=f"worker-{index}")
+        for index, part in enumerate(parts)
+    ]
+    sent = [0] * len(processes)
+    running = set(range(len(processes)))
+    for process in processes:
+        process.start()
+    try:
+        try:
+            _collect(results, processes, running, sent, metrics)
+        except KeyboardInterrupt:
+            for process in processes:
+                if process.is_alive():
+                    os.kill(process.pid, signal.SIGINT)
+            _collect(results, processes, running, sent, metrics)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+    for index, count in enumerate(sent):
+        print(f"worker-{index} sent {count} messages")
+    print(f"{len(processes)} workers sent {sum(sent)} messages")
+    return sent
+
+
+def _collect(results, processes, running, sent, metrics):
+    r"""Merge the metrics received from the workers, until all of them are done."""
+    while running:
+        try:
+            index, drained = results.get(timeout=1.0)
+        except queue.Empty:
+            for index in running:
+                if processes[index].exitcode not in (None, 0):  # died without saying it was done
+                    raise RuntimeError(f"worker-{index} failed with exit code {processes[index].exitcode}") from None
+            continue
+        if drained is None:
+            running.discard(index)
+            processes[index].join()
+            if processes[index].exitcode != 0:
+                raise RuntimeError(f"worker-{index} failed with exit code {processes[index].exitcode}")
+        else:
+            sent[index] += drained["messages"]
+            metrics.merge(drained)
@@ -9,6 +9,30 @@ this_module_path = sys.modules[__name__].__file__
 repo_rootpath = os.path.dirname(os.path.dirname(this_module_path))
 
 
+class FakeClock:
+    """Clock that jumps to the requested deadline instead of sleeping"""
+
+    def __init__(self):
+        self.time = 0.0
+        self.sleeps = []
+
+    def now(self):
+        return self.time
+
+    def sleep_until(self, deadline):
+        if deadline > self.time:
+            self.sleeps.append(deadline - self.time)
+            self.time = deadline
+
+    async def wait_until(self, deadline):
+        self.sleep_until(deadline)
+
+
+@pytest.fixture()
+def fake_clock():
+    return FakeClock()
+
+
 @pytest.fixture(scope="session")
 def content_files():
     content = dict()
@@ -2,7 +2,7 @@
 import json
 import os
 from unittest import TestCase
-from unittest.mock import mock_open, patch
+from unittest.mock import MagicMock, patch
 
 # third-party imports
 import pytest
@@ -13,10 +13,14 @@ from webmonchow.amq.broadcast import (
     broadcast,
     connect_to_broker,
     get_options,
+    main,
     message_generator,
     read_contents,
+    serialize_contents,
     service_content_files,
 )
+from webmonchow.pv.expressions import ExpressionError
+from webmonchow.scheduler import Scheduler
 
 
 def test_service_content_files():
@@ -24,21 +28,44 @@ def test_service_content_files():
     assert sorted(result) == ["dasmon.json", "pvsd.json", "translation.json"]
 
 
-def test_read_contents():
-    mock_files = {"/fake/dir/file1.json": '{"key1": "value1"}', "/fake/dir/file2.json": '{"key2": "value2"}'}
+def test_read_contents(tmp_path):
+    file1 = tmp_path / "file1.json"
+    file1.write_text('{"key1": [{"a": 1}], "key2": [{"a": 2}]}')
+    file2 = tmp_path / "file2.ndjson"
+    file2.write_text('{"key2": {"a": 3}}\n{"key3": [{"a": 4}]}\n')
+    result = read_contents([str(file1), str(file2)])
+    assert result == {"key1": [{"a": 1}], "key2": [{"a": 2}, {"a": 3}], "key3": [{"a": 4}]}
 
-    m = mock_open()
 
-    # Adding side_effect to mock open to include the 'name' attribute.
-    def mock_file_open(file, *args, **kwargs):
-        file_object = m(file, *args, **kwargs)
-        file_object.name = file
-        return file_object
+def test_serialize_contents():
+    data = {
+        "queue1": [{"frequency": 1, "message": {"status": "0"}}],
+        "queue2": [{"frequency": 0, "message": b'{"run_number": "1"}'}],
+    }
+    serialized = serialize_contents(data)
+    assert serialized == {
+        "queue1": [{"frequency": 1, "message": b'{"status": "0"}'}],
+        "queue2": [{"frequency": 0, "message": b'{"run_number": "1"}'}],
+    }
+    assert data["queue1"][0]["message"] == {"status": "0"}  # input left untouched
+
 
-    with patch("builtins.open", mock_file_open):
-        with patch("json.load", side_effect=lambda f: json.loads(mock_files[f.name])):
-            result = read_contents(["/fake/dir/file1.json", "/fake/dir/file2.json"])
-            assert result == {"key1": "value1", "key2": "value2"}
+def test_serialize_contents_fields(fake_clock):
+    data = {"queue1": [{"frequency": 1, "message": {"run_number": "321"}, "fields": {"run_number": "str(321+{n})"}}]}
+    gen = message_generator(serialize_contents(data), scheduler=Scheduler(clock=fake_clock))
+    assert next(gen) == ("queue1", b'{"run_number": "321"}')
+    assert next(gen) == ("queue1", b'{"run_number": "322"}')
+
+
+def test_serialize_contents_reports_all_errors():
+    data = {
+        "queue1": [{"frequency": 1, "message": {"run_number": "321"}, "fields": {"run": "{n}"}}],
+        "queue2": [{"frequency": 1, "message": {"run_number": "321"}, "fields": {"run_number": "{n"}}],
+    }
+    with pytest.raises(ExpressionError) as e:
+        serialize_contents(data)
+    assert "queue1" in str(e.value)
+    assert "queue2" in str(e.value)
 
 
 def test_message_generator():
@@ -55,6 +82,15 @@ def test_message_generator():
     assert next(gen) == ("queue2", "msg2")
 
 
+def test_message_generator_sub_second(fake_clock):
+    data = {"queue1": [{"frequency": 0.25, "message": "msg1"}], "queue2": [{"frequency": 1.5, "message": "msg2"}]}
+    gen = message_generator(data, scheduler=Scheduler(clock=fake_clock))
+    sent = [next(gen) for _ in range(9)]
+    assert sent.count(("queue1", "msg1")) == 7
+    assert sent[1] == sent[-1] == ("queue2", "msg2")
+    assert fake_clock.now() == 1.5
+
+
 class TestConnectToBroker(TestCase):
     @patch("stomp.Connection")
     def test_connects_successfully(self, mock_connection):
@@ -88,6 +124,32 @@ def test_broadcast():
             mock_conn.send.assert_any_call("queue2", "msg2")
 
 
+def test_broadcast_serialized():
+    mock_conn = MagicMock()
+    with patch("json.dumps") as mock_dumps:
+        broadcast(mock_conn, iter([("queue1", b'{"status": "0"}')]))
+        mock_dumps.assert_not_called()
+    mock_conn.send.assert_called_once_with("queue1", b'{"status": "0"}')
+
+
+def test_broadcast_reconnects():
+    lost = MagicMock()
+    lost.send.side_effect = stomp.exception.NotConnectedException()
+    new = MagicMock()
+    broken = iter([stomp.exception.ConnectFailedException("refused")])
+
+    def connect():
+        error = next(broken, None)
+        if error is not None:
+            raise error
+        return new
+
+    message_gen = iter([("queue1", b"1"), ("queue1", b"2"), ("queue1", b"3")])
+    broadcast(lost, message_gen, connect=connect, backoff=(0.0, 0.0))
+    lost.disconnect.assert_called_once()
+    assert [call.args for call in new.send.call_args_list] == [("queue1", b"1"), ("queue1", b"2"), ("queue1", b"3")]
+
+
 def test_get_options_default():
     options = get_options([])
     assert options.user == "icat"
@@ -95,6 +157,50 @@ def test_get_options_default():
     assert options.broker == "localhost:61613"
     file_names = [os.path.basename(filename) for filename in options.content_files.split(",")]
     assert sorted(file_names) == ["dasmon.json", "pvsd.json", "translation.json"]
+    assert options.rate is None
+    assert options.replay is None
+    assert options.workers == 1
+    assert options.speed == 1.0
+    assert options.report_interval == 10.0
+    assert options.async_send is False
+    assert options.queue_size == 1000
+    assert options.window is None
+    assert options.brokers == ["localhost:61613"]
+    assert options.broker_mode == "fanout"
+    assert options.buffer_size == 10000
+    assert options.overflow == "drop-oldest"
+    assert options.spill_file is None
+
+
+def test_get_options_async():
+    options = get_options(["--async", "--window", "100"])
+    assert options.async_send is True
+    assert options.window == 100
+    with pytest.raises(SystemExit):
+        get_options(["--window", "100"])
+
+
+def test_get_options_brokers():
+    options = get_options(["--broker", "amq1:61613, amq2:61613", "--broker-mode", "spread", "--window", "10"])
+    assert options.brokers == ["amq1:61613", "amq2:61613"]
+    assert options.broker_mode == "spread"
+    assert options.window == 10
+
+
+def test_get_options_rate():
+    options = get_options(["--rate", "ramp:10/s..100/s@60"])
+    assert options.rate.rate(30) == pytest.approx(55.0)
+    with pytest.raises(SystemExit):
+        get_options(["--rate", "fast"])
+
+
+def test_main_rate_without_periodic_messages(tmp_path, capsys):
+    content_file = tmp_path / "messages.json"
+    content_file.write_text(json.dumps({"/queue/TEST": [{"frequency": 0, "message": {"run_number": 1}}]}))
+    with pytest.raises(SystemExit) as exit_info:
+        main(["--content-files", str(content_file), "--rate", "100/s", "--report-interval", "0"])
+    assert exit_info.value.code == 2
+    assert "--rate requires periodic messages" in capsys.readouterr().err
 
 
 def test_get_options():
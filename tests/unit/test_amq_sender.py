@@ -0,0 +1,161 @@
+# standard imports
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+# third-party imports
+import pytest
+import stomp
+
+# webmonchow imports
+from webmonchow.amq.sender import Sender, broadcast_async, broadcast_brokers
+from webmonchow.metrics import Metrics
+
+
+class ReceiptConnection:
+    """Connection sending receipts on demand, like a broker acknowledging messages."""
+
+    def __init__(self):
+        self.sent = []
+        self.listener = None
+        self.lock = threading.Lock()
+
+    def set_listener(self, name, listener):  # noqa: ARG002 signature of stomp.Connection.set_listener
+        self.listener = listener
+
+    def send(self, destination, body, **headers):
+        with self.lock:
+            self.sent.append((destination, body, headers))
+
+    def acknowledge(self, count):
+        with self.lock:
+            receipts = [headers["receipt"] for _, _, headers in self.sent[:count]]
+        for receipt in receipts:
+            self.listener.on_receipt(SimpleNamespace(headers={"receipt-id": receipt}))
+
+
+def test_broadcast_async():
+    connection = MagicMock()
+    metrics = Metrics()
+    messages = [("/queue/a", b'{"a": 1}'), ("/topic/b", {"b": 2})]
+    broadcast_async(connection, iter(messages), queue_size=1, metrics=metrics)
+    assert [call.args for call in connection.send.call_args_list] == [
+        ("/queue/a", b'{"a": 1}'),
+        ("/topic/b", '{"b": 2}'),
+    ]
+    assert metrics.messages.value == 2
+    assert metrics.send.count == 2
+    assert metrics.queue_depth.count == 2
+
+
+def test_sender_window():
+    connection = ReceiptConnection()
+    metrics = Metrics()
+    sender = Sender(connection, queue_size=10, window=2, metrics=metrics)
+    sender.start()
+    for i in range(5):
+        sender.put("/queue/a", b"%d" % i)
+    sender.join(0.2)  # the sender waits for receipts
+    assert len(connection.sent) == 2
+    assert sender.in_flight == 2
+    connection.acknowledge(2)
+    sender.join(0.2)
+    assert len(connection.sent) == 4
+    assert [headers["receipt"] for _, _, headers in connection.sent] == [f"sender-{i}" for i in range(4)]
+    connection.acknowledge(4)
+    sender.join(0.2)
+    connection.acknowledge(5)
+    sender.stop()
+    assert sender.in_flight == 0
+    assert metrics.ack.count == 5
+    assert metrics.messages.value == 5
+
+
+def test_sender_stop_without_receipts(capsys):
+    connection = ReceiptConnection()
+    sender = Sender(connection, window=10)
+    sender.start()
+    sender.put("/queue/a", b"1")
+    sender.stop(timeout=0.1)
+    assert "no receipt for 1 messages" in capsys.readouterr().out
+
+
+def test_sender_error():
+    connection = MagicMock()
+    connection.send.side_effect = OSError("connection lost")
+    sender = Sender(connection)
+    sender.start()
+    sender.put("/queue/a", b"1")
+    sender.join()
+    with pytest.raises(RuntimeError, match="sender stopped"):
+        sender.put("/queue/a", b"2")
+    with pytest.raises(RuntimeError):
+        sender.stop()
+
+
+def test_broadcast_brokers_fanout():
+    connections = [ReceiptConnection(), ReceiptConnection()]
+    connects = [lambda connection=connection: connection for connection in connections]
+    messages = [("/queue/a", b"1"), ("/topic/b", b"2")]
+    broadcast_brokers(connects, iter(messages), mode="fanout")
+    for connection in connections:
+        assert [(destination, body) for destination, body, _ in connection.sent] == messages
+
+
+def test_broadcast_brokers_spread():
+    connections = [ReceiptConnection(), ReceiptConnection(), ReceiptConnection()]
+    connects = [lambda connection=connection: connection for connection in connections]
+    messages = [(f"/queue/{i % 10}", b"%d" % i) for i in range(100)]
+    broadcast_brokers(connects, iter(messages), mode="spread")
+    sent = [[(destination, body) for destination, body, _ in connection.sent] for connection in connections]
+    assert sorted(sum(sent, [])) == sorted(messages)  # every message once
+    destinations = [{destination for destination, _ in messages} for messages in sent]
+    assert sum(len(d) for d in destinations) == 10  # every destination on one broker only
+    assert all(destinations)
+
+
+def test_sender_reconnects(capsys):
+    lost = MagicMock()
+    lost.send.side_effect = stomp.exception.NotConnectedException("connection lost")
+    working = ReceiptConnection()
+    attempts = iter([lost, stomp.exception.ConnectFailedException("refused"), working])
+
+    def connect():
+        attempt = next(attempts)
+        if isinstance(attempt, Exception):
+            raise attempt
+        return attempt
+
+    metrics = Metrics()
+    sender = Sender(None, metrics=metrics, connect=connect, backoff=(0.01, 0.02))
+    sender.start()
+    sender.put("/queue/a", b"1")
+    sender.put("/queue/a", b"2")
+    deadline = time.monotonic() + 5.0
+    while len(working.sent) < 2 and time.monotonic() < deadline:  # a sender stopped while disconnected gives up
+        time.sleep(0.01)
+    sender.stop()
+    assert [body for _, body, _ in working.sent] == [b"1", b"2"]
+    lost.disconnect.assert_called_once()
+    output = capsys.readouterr().out
+    assert "sender lost its connection to the broker: connection lost" in output
+    assert "sender failed to connect, next attempt in 0.01 s: refused" in output
+    assert metrics.messages.value == 2
+
+
+def test_sender_drops_while_disconnected(capsys):
+    def connect():
+        raise stomp.exception.ConnectFailedException("refused")
+
+    sender = Sender(None, queue_size=2, connect=connect, backoff=(0.01, 0.01))
+    sender.start()
+    for i in range(10):
+        sender.put("/queue/a", b"%d" % i)  # doesn't block
+    assert sender.dropped >= 7
+    sender.stop()
+    assert f"sender dropped {sender.dropped} messages while disconnected" in capsys.readouterr().out
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,60 @@
+# standard imports
+import json
+from unittest.mock import patch
+
+# third-party imports
+import pytest
+
+# webmonchow imports
+from webmonchow.amq.templates import MessageTemplate
+from webmonchow.pv.expressions import ExpressionError
+
+message = {
+    "instrument": "HYSA",
+    "ipts": "IPTS-12345",
+    "run_number": "321",
+    "monitors": {"1": 0, "2": 0},
+    "facility": "SNS",
+}
+
+
+def test_render():
+    fields = {"run_number": "str(321+{n})", "monitors.2": "{x}*10", "monitors.1": "{n}"}
+    template = MessageTemplate(message, fields)
+    rendered = [json.loads(template.render(x)) for x in (0.0, 1.5, 3.0)]
+    assert [body["run_number"] for body in rendered] == ["321", "322", "323"]
+    assert [body["monitors"] for body in rendered] == [{"1": 0, "2": 0.0}, {"1": 1, "2": 15.0}, {"1": 2, "2": 30.0}]
+    assert all(body["facility"] == "SNS" for body in rendered)
+    assert message["run_number"] == "321"  # input left untouched
+
+
+def test_render_patches_serialized_message():
+    template = MessageTemplate(message, {"ipts": "'IPTS-{n}'"})
+    expected = json.dumps({**message, "ipts": "IPTS-0"}).encode()
+    with patch("json.dumps", side_effect=json.dumps) as mock_dumps:
+        assert template.render(0.0) == expected
+        mock_dumps.assert_called_once_with("IPTS-0")  # only the generated field is serialized
+
+
+def test_render_time():
+    template = MessageTemplate({"timestamp": 0}, {"timestamp": "int({t})"})
+    with patch("time.time", return_value=1234.5):
+        assert template.render(0.0) == b'{"timestamp": 1234}'
+
+
+@pytest.mark.parametrize(
+    "fields",
+    [
+        {"run": "{n}"},  # no such field
+        {"monitors.3": "{n}"},
+        {"run_number": "{y}"},  # unknown variable
+        {"run_number": "os.getpid()"},
+    ],
+)
+def test_invalid_fields(fields):
+    with pytest.raises(ExpressionError):
+        MessageTemplate(message, fields)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
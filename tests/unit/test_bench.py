@@ -0,0 +1,65 @@
+# standard imports
+import json
+
+# third-party imports
+import pytest
+
+# webmonchow imports
+from webmonchow.bench import (
+    amq_contents,
+    compare,
+    main,
+    measure,
+    pv_contents,
+    run_benchmarks,
+)
+
+
+def test_synthetic_contents():
+    data = pv_contents(100)
+    pvs = [(entry["instrument"], entry["name"]) for entries in data.values() for entry in entries]
+    assert len(pvs) == len(set(pvs)) == 100
+    programmes = amq_contents(50)
+    assert sum(len(entries) for entries in programmes.values()) == 50
+
+
+def test_measure():
+    calls = []
+    result = measure("test", {"size": 1}, lambda: len(calls), lambda state: calls.append(state) or 10, repeat=3)
+    assert calls == [0, 1, 2]
+    assert result["name"] == "test"
+    assert result["items"] == 10
+    assert result["rate"] == pytest.approx(10 / result["seconds"])
+
+
+def test_run_benchmarks():
+    report = run_benchmarks(sizes=[5], emissions=50, repeat=1)
+    names = {result["name"] for result in report["results"]}
+    assert {"pv_generator", "message_generator", "expression", "amq_serialization", "pv_broadcast"} <= names
+    assert all(result["items"] > 0 for result in report["results"])
+    json.dumps(report)  # serializable
+
+
+def test_compare():
+    baseline = {"results": [{"name": "a", "parameters": {"size": 1}, "rate": 100.0}]}
+    report = {
+        "results": [
+            {"name": "a", "parameters": {"size": 1}, "rate": 90.0},
+            {"name": "b", "parameters": {}, "rate": 1.0},
+        ]
+    }
+    assert compare(report, baseline) == ['a {"size": 1}: 90/s vs 100/s (-10.0%)']
+
+
+def test_main(tmp_path, capsys):
+    output = tmp_path / "bench.json"
+    main(["--sizes", "3", "--emissions", "20", "--repeat", "1", "--output", str(output)])
+    report = json.loads(output.read_text())
+    main(["--sizes", "3", "--emissions", "20", "--repeat", "1", "--compare", str(output)])
+    captured = capsys.readouterr()
+    assert json.loads(captured.out)["emissions"] == 20
+    assert len(captured.err.splitlines()) >= len(report["results"])
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
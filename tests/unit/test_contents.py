@@ -0,0 +1,107 @@
+# standard imports
+import io
+import json
+import sys
+
+# third-party imports
+import pytest
+
+# webmonchow imports
+from webmonchow.contents import PV, ContentError, Programme, iter_json, iter_ndjson, load_contents
+
+CONTENT = {
+    "pvUpdate": [
+        {"frequency": 10, "instrument": "HYSA", "name": "sinPV", "function": "100*math.sin({x}/3600)"},
+        {"frequency": 0.5, "instrument": "ARCS", "name": "temp", "function": "300"},
+    ],
+    "empty": [],
+    "pvStringUpdate": [{"frequency": 12345, "instrument": "HYSA", "name": "s", "function": "'a , ] } \\\" x'"}],
+}
+
+
+def test_records():
+    pv = PV(10, "HYSA", "sinPV", "{x}")
+    assert pv.name == "sinPV"
+    assert pv["instrument"] == "HYSA"
+    assert pv == {"frequency": 10, "instrument": "HYSA", "name": "sinPV", "function": "{x}"}
+    assert {**pv, "name": "cosPV"}["name"] == "cosPV"
+    assert repr(pv) == "PV(frequency=10, instrument='HYSA', name='sinPV', function='{x}')"
+    with pytest.raises(KeyError):
+        pv["message"]
+    with pytest.raises(AttributeError):
+        pv.extra = 1  # no __dict__
+    programme = Programme(0, b"{}")
+    assert dict(programme) == {"frequency": 0, "message": b"{}"}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 1 << 16])
+def test_iter_json(chunk_size):
+    text = json.dumps(CONTENT, indent=2)
+    entries = list(iter_json(io.StringIO(text), chunk_size))
+    assert entries == [(key, entry) for key, value in CONTENT.items() for entry in value]
+
+
+def test_iter_json_single_entry():
+    assert list(iter_json(io.StringIO('{"a": {"b": 1}, "c": 12}'), chunk_size=1)) == [("a", {"b": 1}), ("c", 12)]
+    assert list(iter_json(io.StringIO(" { } "))) == []
+
+
+@pytest.mark.parametrize("text", ["", "[]", '{"a": [1,, 2]}', '{"a": [1, 2]', '{"a" [1]}', "{1: [2]}"])
+def test_iter_json_invalid(text):
+    with pytest.raises(ContentError):
+        list(iter_json(io.StringIO(text), chunk_size=4))
+
+
+def test_iter_ndjson():
+    text = '{"a": {"b": 1}}\n\n{"a": [{"b": 2}, {"b": 3}], "c": {"d": 4}}\n'
+    assert list(iter_ndjson(io.StringIO(text))) == [("a", {"b": 1}), ("a", {"b": 2}), ("a", {"b": 3}), ("c", {"d": 4})]
+    with pytest.raises(ContentError, match="line 2"):
+        list(iter_ndjson(io.StringIO('{"a": {}}\n[1]\n')))
+
+
+def test_load_contents(tmp_path, capsys):
+    file1 = tmp_path / "pvs.json"
+    file1.write_text(json.dumps(CONTENT))
+    file2 = tmp_path / "more.jsonl"
+    file2.write_text('{"pvUpdate": {"frequency": 1, "instrument": "HYSA", "name": "more", "function": "1"}}\n')
+    data = load_contents([str(file1), str(file2)])
+    assert [pv["name"] for pv in data["pvUpdate"]] == ["sinPV", "temp", "more"]
+    assert "empty" not in data  # no entries
+    assert data["pvUpdate"][0]["instrument"] is data["pvUpdate"][2]["instrument"]  # shared
+    output = capsys.readouterr().out
+    assert "Loaded 4 entries of 2 keys from 2 files in" in output
+    assert "peak memory" in output
+
+
+def test_load_contents_streamed(tmp_path):
+    path = tmp_path / "pvs.json"
+    path.write_text(json.dumps(CONTENT))
+    assert load_contents([str(path)], stream_size=0) == load_contents([str(path)])
+
+
+@pytest.mark.parametrize("stream_size", [0, 2**20])
+def test_load_contents_repeated_key(tmp_path, stream_size):
+    path = tmp_path / "repeated.json"
+    path.write_text('{"k": [{"a": 1}], "other": [], "k": {"a": 2}}')
+    assert load_contents([str(path)], stream_size) == {"k": [{"a": 1}, {"a": 2}]}
+
+
+@pytest.mark.parametrize("stream_size", [0, 2**20])
+@pytest.mark.parametrize("text", ['{"pvUpdate": [{"frequency": 1}', "[1, 2]"])
+def test_load_contents_invalid(tmp_path, text, stream_size):
+    path = tmp_path / "invalid.json"
+    path.write_text(text)
+    with pytest.raises(ContentError, match="invalid.json"):
+        load_contents([str(path)], stream_size)
+
+
+def test_load_contents_without_resource(tmp_path, capsys, monkeypatch):
+    monkeypatch.setitem(sys.modules, "resource", None)  # as on Windows
+    path = tmp_path / "pvs.json"
+    path.write_text(json.dumps(CONTENT))
+    load_contents([str(path)])
+    assert "peak memory" not in capsys.readouterr().out
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
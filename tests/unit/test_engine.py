@@ -0,0 +1,92 @@
+# standard imports
+import asyncio
+import json
+import os
+from unittest.mock import MagicMock, patch
+
+# third-party imports
+import psycopg2
+import pytest
+
+# webmonchow imports
+from webmonchow.engine import broadcast, get_options
+from webmonchow.scheduler import Scheduler, SimulatedClock
+
+amq_data = {
+    "/topic/SNS.TEST.STATUS.DASMON": [{"frequency": 0, "message": {"status": "0"}}],
+    "POSTPROCESS.DATA_READY": [{"frequency": 0, "message": {"run_number": "1"}}],
+}
+pv_data = {"pvUpdate": [{"frequency": 0, "instrument": "TEST", "name": "testPV", "function": "{x}+1"}]}
+
+
+def mock_pv_connection():
+    conn = MagicMock()
+    conn.cursor.return_value.mogrify.side_effect = lambda query, args: (
+        query % tuple(repr(arg) for arg in args)
+    ).encode()
+    return conn
+
+
+@patch("time.time", return_value=123456)
+def test_broadcast(_, fake_clock):
+    amq_connection = MagicMock()
+    pv_connection = mock_pv_connection()
+    asyncio.run(broadcast(amq_connection, pv_connection, amq_data, pv_data, scheduler=Scheduler(clock=fake_clock)))
+    amq_connection.send.assert_any_call("/topic/SNS.TEST.STATUS.DASMON", json.dumps({"status": "0"}))
+    amq_connection.send.assert_any_call("POSTPROCESS.DATA_READY", json.dumps({"run_number": "1"}))
+    pv_connection.cursor().execute.assert_called_once_with(b"SELECT * FROM pvUpdate('TEST', 'testPV', 1.0, 0, 123456)")
+    pv_connection.commit.assert_called_once()
+
+
+def test_broadcast_one_clock(fake_clock):
+    amq_connection = MagicMock()
+    pv_connection = mock_pv_connection()
+    amq_periodic = {"queue": [{"frequency": 1, "message": "msg"}]}
+    pv_periodic = {"pvUpdate": [{"frequency": 0.5, "instrument": "TEST", "name": "testPV", "function": "{x}"}]}
+    pv_connection.commit.side_effect = [None] * 5 + [psycopg2.OperationalError("connection lost")]
+    with pytest.raises(psycopg2.OperationalError):
+        asyncio.run(
+            broadcast(amq_connection, pv_connection, amq_periodic, pv_periodic, scheduler=Scheduler(clock=fake_clock))
+        )
+    values = [call.args[1][2] for call in pv_connection.cursor().mogrify.call_args_list]
+    assert values[:6] == [0.0, 0.5, 1.0, 1.5, 2.0, 2.5]
+    assert amq_connection.send.call_count >= 3  # messages at times 0, 1, 2
+
+
+def test_broadcast_scenario():
+    amq_connection = MagicMock()
+    pv_connection = mock_pv_connection()
+    scenario = {
+        "instruments": 2,
+        "run_period": 10,
+        "steps": [{"at": 5, "destination": "POSTPROCESS.DATA_READY", "message": {"run_number": "{run}"}}],
+        "pvs": [{"name": "run_number", "frequency": 10, "function": "{run}"}],
+    }
+    scheduler = Scheduler(clock=SimulatedClock(sleep=False), end=20)
+    asyncio.run(broadcast(amq_connection, pv_connection, {}, {}, scheduler=scheduler, scenario=scenario))
+    runs = [json.loads(call.args[1])["run_number"] for call in amq_connection.send.call_args_list]
+    assert runs == ["1", "1", "2", "2"]
+    pvs = [tuple(call.args[1][:3]) for call in pv_connection.cursor().mogrify.call_args_list]
+    assert pvs[:2] == [("SIM1", "run_number", 1), ("SIM2", "run_number", 0)]
+
+
+def test_get_options_default():
+    options = get_options([])
+    assert options.amq_user == "icat"
+    assert options.broker == "localhost:61613"
+    assert options.db_user == "postgres"
+    assert options.database == "workflow"
+    assert os.path.basename(options.pv_files) == "dasmon.json"
+    assert options.max_delay == 0.0
+    assert options.scenario is None
+
+
+def test_get_options_scenario():
+    options = get_options(["--scenario", "runs", "--instruments", "50", "--run-period", "60"])
+    assert (options.scenario, options.instruments, options.run_period) == ("runs", 50, 60.0)
+    with pytest.raises(SystemExit):
+        get_options(["--instruments", "50"])
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,123 @@
+# standard imports
+import itertools
+import urllib.request
+
+# third-party imports
+import pytest
+
+# webmonchow imports
+from webmonchow.metrics import Counter, Histogram, Metrics, Reporter, serve_metrics
+from webmonchow.scheduler import Scheduler
+
+
+def test_counter():
+    counter = Counter("messages_total", "Messages sent")
+    counter.inc()
+    counter.inc(4)
+    assert counter.window() == 5
+    counter.inc()
+    assert counter.window() == 1
+    assert counter.window() == 0
+    assert counter.value == 6
+    assert counter.exposition()[-1] == "webmonchow_messages_total 6"
+
+
+def test_histogram_window():
+    histogram = Histogram("send_seconds", "Time to send", buckets=(0.001, 0.01, 0.1))
+    assert histogram.window() is None
+    for value in [0.0005] * 60 + [0.005] * 39 + [0.5]:
+        histogram.observe(value)
+    assert histogram.window() == (0.001, 0.01, 0.5)
+    histogram.observe(0.002)
+    assert histogram.window() == (0.002, 0.002, 0.002)  # never more than the maximum
+    assert histogram.count == 101
+    assert histogram.counts == [60, 40, 0, 1]
+
+
+def test_histogram_exposition():
+    histogram = Histogram("queue_depth", "Batches waiting", buckets=(0, 1, 2), unit="")
+    for value in (0, 1, 1, 5):
+        histogram.observe(value)
+    assert histogram.exposition() == [
+        "# HELP webmonchow_queue_depth Batches waiting",
+        "# TYPE webmonchow_queue_depth histogram",
+        'webmonchow_queue_depth_bucket{le="0"} 1',
+        'webmonchow_queue_depth_bucket{le="1"} 3',
+        'webmonchow_queue_depth_bucket{le="2"} 3',
+        'webmonchow_queue_depth_bucket{le="+Inf"} 4',
+        "webmonchow_queue_depth_sum 7",
+        "webmonchow_queue_depth_count 4",
+    ]
+
+
+def test_metrics_summary():
+    metrics = Metrics()
+    metrics.messages.inc(50)
+    metrics.send.observe(0.0012)
+    metrics.lag.observe(2e-6)
+    summary = metrics.summary(10.0)
+    assert summary.startswith("50 sent (5.0/s) | ")
+    assert "send_seconds p50 1.2ms p99 1.2ms max 1.2ms" in summary
+    assert "scheduler_lag_seconds p50 2µs" in summary
+    assert "commit_seconds" not in summary  # nothing observed
+    assert metrics.summary(10.0) == "0 sent (0.0/s)"
+    metrics.dropped.inc(3)
+    assert metrics.summary(10.0) == "0 sent (0.0/s), 3 dropped, 0 late"
+
+
+def test_metrics_merge():
+    worker = Metrics()
+    worker.messages.inc(4)
+    worker.late.inc(2)
+    worker.commit.observe(0.003)
+    worker.queue_depth.observe(7)
+    parent = Metrics()
+    parent.commit.observe(0.001)
+    parent.merge(worker.drain())
+    assert worker.drain()["messages"] == 0  # drained once
+    assert parent.messages.value == 4
+    assert parent.late.value == 2
+    assert parent.commit.count == 2
+    assert parent.commit.sum == pytest.approx(0.004)
+    assert parent.queue_depth.window() == (7, 7, 7)
+
+
+def test_scheduler_lag(fake_clock):
+    metrics = Metrics()
+    scheduler = Scheduler(clock=fake_clock, metrics=metrics)
+    scheduler.add("a", 1.0)
+    fake_clock.time = 2.5  # late by 2.5 seconds, then catching up
+    list(itertools.islice(scheduler, 4))
+    assert metrics.lag.count == 4
+    assert metrics.lag.sum == pytest.approx(2.5 + 1.5 + 0.5 + 0.0)
+
+
+def test_reporter(capsys):
+    metrics = Metrics()
+    metrics.messages.inc(3)
+    reporter = Reporter(metrics, interval=0.05)
+    reporter.start()
+    reporter.join(0.12)
+    reporter.stop()
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == "3 sent (60.0/s)"
+    assert all(line == "0 sent (0.0/s)" for line in lines[1:])
+
+
+def test_serve_metrics():
+    metrics = Metrics()
+    metrics.messages.inc(7)
+    server = serve_metrics(metrics, 0)
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics") as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            body = response.read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert "webmonchow_messages_total 7\n" in body
+    assert "# TYPE webmonchow_send_seconds histogram" in body
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
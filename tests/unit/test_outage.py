@@ -0,0 +1,135 @@
+# standard imports
+import os
+
+# third-party imports
+import pytest
+
+# webmonchow imports
+from webmonchow.metrics import Metrics
+from webmonchow.outage import Delivery, OutageBuffer
+
+
+class LostError(Exception):
+    pass
+
+
+class FlakyLink:
+    """Connections to a fake server, which is down while `down` is True."""
+
+    def __init__(self):
+        self.down = False
+        self.received = []
+        self.connections = 0
+
+    def connect(self):
+        if self.down:
+            raise LostError("connection refused")
+        self.connections += 1
+        return self.connections
+
+    def send(self, connection, item):  # noqa: ARG002 signature of `Delivery`
+        if self.down:
+            raise LostError("connection lost")
+        self.received.append(item)
+
+
+def test_outage_buffer():
+    buffer = OutageBuffer(3)
+    for item in range(3):
+        buffer.append(item)
+    assert buffer.full()
+    assert buffer.peek() == 0
+    assert [buffer.popleft() for _ in range(3)] == [0, 1, 2]
+    assert not buffer
+    with pytest.raises(ValueError, match="unknown overflow policy"):
+        OutageBuffer(3, "drop-random")
+
+
+def test_outage_buffer_spill(tmp_path):
+    spill = str(tmp_path / "spill.pickle")
+    buffer = OutageBuffer(10, spill=spill, memory_size=2)
+    for item in range(4):
+        buffer.append(("pvUpdate", "TEST", f"pv{item}", item))
+    assert os.path.getsize(spill) > 0  # two in memory, two in the file
+    assert buffer.popleft()[2] == "pv0"
+    buffer.append(("pvUpdate", "TEST", "pv4", 4))  # after the spilled ones
+    assert [buffer.popleft()[3] for _ in range(4)] == [1, 2, 3, 4]
+    assert os.path.getsize(spill) == 0
+    buffer.close()
+    assert not os.path.exists(spill)
+
+
+def test_delivery():
+    link = FlakyLink()
+    metrics = Metrics()
+    delivery = Delivery(None, link.send, (LostError,), link.connect, backoff=(0.0, 0.0), metrics=metrics)
+    delivery.send(1)
+    link.down = True
+    delivery.send(2)
+    delivery.send(3)
+    link.down = False
+    delivery.send(4)
+    assert link.received == [1, 2, 3, 4]
+    assert link.connections == 2
+    assert delivery.late == 2
+    assert metrics.late.value == 2
+    delivery.close()
+
+
+@pytest.mark.parametrize(
+    "policy, received",
+    [("drop-oldest", [1, 4, 5, 6]), ("drop-newest", [1, 3, 4, 6])],
+)
+def test_delivery_drop(policy, received):
+    link = FlakyLink()
+    metrics = Metrics()
+    buffer = OutageBuffer(2, policy)
+    delivery = Delivery(None, link.send, (LostError,), link.connect, buffer=buffer, backoff=(0, 0), metrics=metrics)
+    delivery.send(1)
+    link.down = True
+    for item in (3, 4, 5):
+        delivery.send(item)
+    link.down = False
+    delivery.send(6)
+    assert link.received == received
+    assert delivery.dropped == metrics.dropped.value == 1
+    assert delivery.late == 2
+
+
+def test_delivery_block(monkeypatch):
+    link = FlakyLink()
+    delivery = Delivery(None, link.send, (LostError,), link.connect, buffer=OutageBuffer(1, "block"), backoff=(0, 0))
+    delivery.send(1)
+    link.down = True
+    delivery.send(2)  # held
+
+    def sleep(seconds):  # noqa: ARG001 signature of time.sleep
+        link.down = False  # the server comes back while blocked
+
+    monkeypatch.setattr("time.sleep", sleep)
+    delivery.send(3)  # the buffer is full, blocks until reconnected
+    assert link.received == [1, 2, 3]
+    assert delivery.dropped == 0
+    assert delivery.late == 2
+
+
+def test_delivery_close_counts_lost(capsys):
+    link = FlakyLink()
+    delivery = Delivery(None, link.send, (LostError,), link.connect, backoff=(0.0, 0.0), size=len)
+    link.down = True
+    delivery.send([1, 2, 3])
+    delivery.close()
+    assert delivery.dropped == 3
+    assert "3 dropped and 0 sent late" in capsys.readouterr().out
+
+
+def test_delivery_without_connect():
+    link = FlakyLink()
+    delivery = Delivery(link.connect(), link.send, (LostError,))
+    link.down = True
+    with pytest.raises(LostError):
+        delivery.send(1)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
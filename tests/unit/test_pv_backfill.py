@@ -0,0 +1,105 @@
+# standard imports
+from unittest.mock import MagicMock
+
+# third-party imports
+import psycopg2
+import pytest
+
+# webmonchow imports
+from webmonchow.pv.backfill import RowStream, backfill, get_options, history, send_history
+
+DATA = {
+    "pvUpdate": [{"instrument": "TEST", "name": "pv1", "function": "{x}", "frequency": 10}],
+    "pvStringUpdate": [{"instrument": "TEST", "name": "pv2", "function": "'a\\tb'", "frequency": 30}],
+}
+
+
+def mock_connection(copy_error=None):
+    conn = MagicMock()
+    cursor = conn.cursor.return_value
+    cursor.mogrify.side_effect = lambda query, args: (query % tuple(repr(arg) for arg in args)).encode()
+    cursor.fetchone.side_effect = lambda: (7,)
+    conn.copied = {}
+
+    def copy_expert(sql, stream):
+        if copy_error is not None:
+            raise copy_error
+        chunks = []
+        while chunk := stream.read(8):
+            chunks.append(chunk)
+        conn.copied[sql] = "".join(chunks)
+
+    cursor.copy_expert.side_effect = copy_expert
+    return conn
+
+
+def test_history():
+    updates = list(history(DATA, 1000.0, 1060.0, offset=5.0))
+    assert updates[:2] == [("pvUpdate", "TEST", "pv1", 5.0, 1000), ("pvStringUpdate", "TEST", "pv2", "a\tb", 1000)]
+    assert [u[4] for u in updates if u[2] == "pv1"] == [1000, 1010, 1020, 1030, 1040, 1050, 1060]
+    assert [u[4] for u in updates if u[2] == "pv2"] == [1000, 1030, 1060]
+
+
+def test_row_stream():
+    stream = RowStream([(1, "a\tb", 2.5), (3, "c\\d", 4)])
+    assert stream.read(3) == "1\ta"
+    assert stream.read() == "\\tb\t2.5\n3\tc\\\\d\t4\n"
+    assert stream.read(10) == ""
+    assert stream.count == 2
+
+
+def test_send_history():
+    conn = mock_connection()
+    updates = [("pvUpdate", "TEST", "pv1", i, 1000 + i) for i in range(5)]
+    assert send_history(conn, conn.cursor(), updates, batch_size=2) == 5
+    assert conn.cursor().execute.call_count == 3
+    assert conn.commit.call_count == 3
+    assert conn.cursor().execute.call_args_list[0].args[0] == (
+        b"SELECT * FROM pvUpdate('TEST', 'pv1', 0, 0, 1000);SELECT * FROM pvUpdate('TEST', 'pv1', 1, 0, 1001)"
+    )
+
+
+def test_backfill_copy(capsys):
+    conn = mock_connection()
+    assert backfill(conn, DATA, 1000.0, 1060.0) == 10
+    # the first update of each PV goes through its SQL function, registering the PV
+    statements = [call.args[0] for call in conn.cursor().execute.call_args_list if isinstance(call.args[0], bytes)]
+    assert statements == [
+        b"SELECT * FROM pvUpdate('TEST', 'pv1', 0.0, 0, 1000)",
+        b"SELECT * FROM pvStringUpdate('TEST', 'pv2', 'a\\tb', 0, 1000)",
+    ]
+    # the others are copied, with the ids of the instrument and of the name
+    sql = "COPY pvmon_pv (instrument_id, name_id, value, status, update_time) FROM STDIN"
+    assert conn.copied[sql] == "".join(f"7\t7\t{x:.1f}\t0\t{1000 + x}\n" for x in range(10, 70, 10))
+    sql = "COPY pvmon_pvstring (instrument_id, name_id, value, status, update_time) FROM STDIN"
+    assert conn.copied[sql] == "7\t7\ta\\tb\t0\t1030\n7\t7\ta\\tb\t0\t1060\n"
+    assert "7 updates of 1 PVs copied into pvmon_pv" in capsys.readouterr().out
+
+
+def test_backfill_fallback(capsys):
+    conn = mock_connection(copy_error=psycopg2.errors.UndefinedTable("relation does not exist"))
+    assert backfill(conn, {"pvUpdate": DATA["pvUpdate"]}, 1000.0, 1060.0) == 7
+    conn.rollback.assert_called_once()
+    output = capsys.readouterr().out
+    assert "Failed to copy into pvmon_pv" in output
+    assert "7 updates of 1 PVs sent through pvUpdate" in output
+
+
+def test_backfill_function():
+    conn = mock_connection()
+    assert backfill(conn, DATA, 1000.0, 1060.0, method="function", batch_size=100) == 10
+    conn.cursor().copy_expert.assert_not_called()
+    assert conn.cursor().execute.call_count == 2
+
+
+def test_get_options():
+    options = get_options(["--start", "2024-01-01T00:00:00+00:00", "--end", "2024-01-02T00:00:00+00:00"])
+    assert options.start == 1704067200.0
+    assert options.end == 1704153600.0
+    assert options.method == "copy"
+    with pytest.raises(SystemExit):
+        get_options(["--start", "yesterday"])
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
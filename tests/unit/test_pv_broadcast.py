@@ -1,21 +1,30 @@
 # standard imports
 import json
 import os
-from unittest.mock import MagicMock, mock_open, patch
+from unittest.mock import MagicMock, patch
 
 # third-party imports
 import psycopg2
 import pytest
 
 # webmonchow imports
+from webmonchow.metrics import Metrics
+from webmonchow.outage import OutageBuffer
 from webmonchow.pv.broadcast import (
     broadcast,
+    broadcast_batches,
+    compile_contents,
     connect_to_database,
     get_options,
+    main,
+    pv_batch_generator,
     pv_generator,
     read_contents,
     service_content_files,
 )
+from webmonchow.pv.expressions import ExpressionError
+from webmonchow.pv.writers import SQLFunctionError
+from webmonchow.scheduler import Scheduler
 
 
 def test_service_content_files():
@@ -23,21 +32,58 @@ def test_service_content_files():
     assert result == ["dasmon.json"]
 
 
-def test_read_contents():
-    mock_files = {"/fake/dir/file1.json": '{"key1": "value1"}', "/fake/dir/file2.json": '{"key2": "value2"}'}
+def test_read_contents(tmp_path):
+    file1 = tmp_path / "file1.json"
+    file1.write_text('{"key1": [{"a": 1}], "key2": [{"a": 2}]}')
+    file2 = tmp_path / "file2.ndjson"
+    file2.write_text('{"key2": {"a": 3}}\n{"key3": [{"a": 4}]}\n')
+    result = read_contents([str(file1), str(file2)])
+    assert result == {"key1": [{"a": 1}], "key2": [{"a": 2}, {"a": 3}], "key3": [{"a": 4}]}
 
-    m = mock_open()
 
-    # Adding side_effect to mock open to include the 'name' attribute.
-    def mock_file_open(file, *args, **kwargs):
-        file_object = m(file, *args, **kwargs)
-        file_object.name = file
-        return file_object
+def test_compile_contents():
+    data = {"pvUpdate": [{"frequency": 1, "instrument": "TEST", "name": "testPV", "function": "2*{x}"}]}
+    compiled = compile_contents(data)
+    assert compiled["pvUpdate"][0]["function"](3.0) == 6.0
+    assert data["pvUpdate"][0]["function"] == "2*{x}"  # input left untouched
+    assert compile_contents(compiled)["pvUpdate"][0]["function"] is compiled["pvUpdate"][0]["function"]
 
-    with patch("builtins.open", mock_file_open):
-        with patch("json.load", side_effect=lambda f: json.loads(mock_files[f.name])):
-            result = read_contents(["/fake/dir/file1.json", "/fake/dir/file2.json"])
-            assert result == {"key1": "value1", "key2": "value2"}
+
+def test_compile_contents_unknown_function():
+    data = {"pvUpdate(); DROP TABLE pvmon_pv;": [{"frequency": 1, "instrument": "TEST", "name": "pv", "function": 1}]}
+    with pytest.raises(SQLFunctionError):
+        compile_contents(data)
+
+
+def test_compile_contents_seed():
+    pvs = [{"frequency": 1, "instrument": "TEST", "name": f"pv{i}", "function": "random.random()"} for i in range(3)]
+
+    def values(pvs, seed):
+        return {
+            pv.name: [pv.function(x) for x in range(5)] for pv in compile_contents({"pvUpdate": pvs}, seed)["pvUpdate"]
+        }
+
+    # every PV has its own stream, whatever the other PVs
+    assert values(pvs, 7) == values(pvs, 7)
+    assert values(pvs[::-1], 7) == values(pvs, 7)
+    assert values(pvs[1:2], 7)["pv1"] == values(pvs, 7)["pv1"]
+    assert values(pvs, 7)["pv0"] != values(pvs, 7)["pv1"]
+    assert values(pvs, 8) != values(pvs, 7)
+
+
+def test_compile_contents_reports_all_errors():
+    data = {
+        "pvUpdate": [
+            {"frequency": 1, "instrument": "TEST", "name": "badPV1", "function": "2*{x"},
+            {"frequency": 1, "instrument": "TEST", "name": "goodPV", "function": "{x}"},
+            {"frequency": 1, "instrument": "TEST", "name": "badPV2", "function": "os.getcwd()"},
+        ]
+    }
+    with pytest.raises(ExpressionError) as e:
+        compile_contents(data)
+    assert "badPV1" in str(e.value)
+    assert "badPV2" in str(e.value)
+    assert "goodPV" not in str(e.value)
 
 
 def test_pv_generator():
@@ -56,6 +102,34 @@ def test_pv_generator():
     assert next(pv_gen) == ("pvUpdate", "TEST", "testPV2", 2.0)
 
 
+def test_pv_generator_sub_second(fake_clock):
+    test_data = {"pvUpdate": [{"frequency": 0.5, "instrument": "TEST", "name": "testPV", "function": "2*{x}"}]}
+    pv_gen = pv_generator(test_data, scheduler=Scheduler(clock=fake_clock))
+    assert [next(pv_gen)[3] for _ in range(4)] == [0.0, 1.0, 2.0, 3.0]
+    assert fake_clock.sleeps == [0.5, 0.5, 0.5]
+
+
+def test_pv_batch_generator(fake_clock):
+    test_data = {
+        "pvUpdate": [
+            {"frequency": 0, "instrument": "TEST", "name": "testPV1", "function": "100"},
+            {"frequency": 1, "instrument": "TEST", "name": "testPV2", "function": "{x}"},
+        ],
+        "pvStringUpdate": [{"frequency": 2, "instrument": "TEST", "name": "testPV3", "function": "'string {x}'"}],
+    }
+    batch_gen = pv_batch_generator(test_data, scheduler=Scheduler(clock=fake_clock))
+    assert next(batch_gen) == [
+        ("pvUpdate", "TEST", "testPV1", 100),
+        ("pvUpdate", "TEST", "testPV2", 0.0),
+        ("pvStringUpdate", "TEST", "testPV3", "string 0.0"),
+    ]
+    assert next(batch_gen) == [("pvUpdate", "TEST", "testPV2", 1.0)]
+    assert next(batch_gen) == [
+        ("pvUpdate", "TEST", "testPV2", 2.0),
+        ("pvStringUpdate", "TEST", "testPV3", "string 2.0"),
+    ]
+
+
 @patch("psycopg2.connect")
 def test_connect_to_database(mock_psycopg2_connect):
     connect_to_database("database", "user", "password", "host", "port")
@@ -64,6 +138,16 @@ def test_connect_to_database(mock_psycopg2_connect):
     )
 
 
+@patch("psycopg2.connect")
+def test_connect_to_database_prepare(mock_psycopg2_connect):
+    connect_to_database("database", "user", "password", "host", "port", prepare=True)
+    statements = [call.args[0] for call in mock_psycopg2_connect.return_value.cursor().execute.call_args_list]
+    assert statements == [
+        "PREPARE webmonchow_pvUpdate AS SELECT * FROM pvUpdate($1, $2, $3, $4, $5)",
+        "PREPARE webmonchow_pvStringUpdate AS SELECT * FROM pvStringUpdate($1, $2, $3, $4, $5)",
+    ]
+
+
 def test_connect_to_database_fails():
     with pytest.raises(psycopg2.OperationalError) as e:
         connect_to_database("database", "user", "password", "host", "port", attempts=2, interval=1.0)
@@ -89,6 +173,124 @@ def test_broadcast(mock_time):
     )
 
 
+@patch("time.time")
+def test_broadcast_batches(mock_time):
+    mock_time.return_value = 123456
+    mock_conn = MagicMock()
+    mock_cursor = mock_conn.cursor.return_value
+    mock_cursor.mogrify.side_effect = lambda query, args: (query % tuple(repr(arg) for arg in args)).encode()
+    batch_gen = [
+        [("pvUpdate", "TEST", "testPV1", 100), ("pvStringUpdate", "TEST", "testPV2", "on"), ("pvUpdate", "T", "p", 1)],
+        [("pvUpdate", "TEST", "testPV1", 101)],
+    ]
+
+    broadcast_batches(mock_conn, batch_gen, max_batch_size=2)
+
+    assert mock_cursor.execute.call_count == 3
+    assert mock_conn.commit.call_count == 3
+    assert mock_cursor.execute.call_args_list[0].args[0] == (
+        b"SELECT * FROM pvUpdate('TEST', 'testPV1', 100, 0, 123456);"
+        b"SELECT * FROM pvStringUpdate('TEST', 'testPV2', 'on', 0, 123456)"
+    )
+    mock_cursor.execute.assert_called_with(b"SELECT * FROM pvUpdate('TEST', 'testPV1', 101, 0, 123456)")
+
+
+@patch("time.time")
+def test_broadcast_metrics(mock_time, capsys):
+    mock_time.return_value = 123456
+    metrics = Metrics()
+    pv_gen = [("pvUpdate", "TEST", "testPV1", 100), ("pvUpdate", "TEST", "testPV2", 1)]
+
+    broadcast(MagicMock(), pv_gen, metrics)
+    assert capsys.readouterr().out == ""
+    assert metrics.messages.value == 2
+    assert metrics.send.count == metrics.commit.count == 2
+
+    broadcast(MagicMock(), pv_gen[:1], verbose=True)
+    assert capsys.readouterr().out == "Sending TEST testPV1 100 to pvUpdate\n"
+
+
+@patch("time.time")
+def test_broadcast_reconnects(mock_time):
+    mock_time.return_value = 123456
+    lost = MagicMock()
+    lost.cursor().execute.side_effect = psycopg2.OperationalError("server closed the connection unexpectedly")
+    new = MagicMock()
+    metrics = Metrics()
+    pv_gen = [("pvUpdate", "TEST", "pv1", 1), ("pvUpdate", "TEST", "pv1", 2)]
+
+    broadcast(lost, pv_gen, metrics, connect=lambda: new, backoff=(0.0, 0.0))
+
+    lost.close.assert_called_once()
+    # the update held during the outage keeps its timestamp
+    statements = [call.args[1] for call in new.cursor().execute.call_args_list]
+    assert statements == [["TEST", "pv1", 1, 0, 123456], ["TEST", "pv1", 2, 0, 123456]]
+    assert metrics.messages.value == 2
+    assert metrics.late.value == 1
+
+    with pytest.raises(psycopg2.OperationalError):
+        broadcast(lost, pv_gen)  # without reconnection
+
+
+@patch("time.time")
+def test_broadcast_batches_outage(mock_time, tmp_path):
+    mock_time.return_value = 123456
+    conn = MagicMock()
+    conn.cursor().mogrify.return_value = b"SELECT 1"
+    conn.cursor().execute.side_effect = psycopg2.OperationalError("server closed the connection unexpectedly")
+    metrics = Metrics()
+    batch_gen = [[("pvUpdate", "TEST", "pv1", 1), ("pvUpdate", "TEST", "pv2", 1)], [("pvUpdate", "TEST", "pv1", 2)]]
+
+    def connect():
+        raise psycopg2.OperationalError("connection refused")
+
+    buffer = OutageBuffer(1, "drop-newest", str(tmp_path / "spill"))
+    broadcast_batches(conn, batch_gen, metrics=metrics, connect=connect, buffer=buffer, backoff=(0.0, 0.0))
+    # the first batch was held, the second dropped, and the first lost when the broadcast ended
+    assert metrics.dropped.value == 3
+    assert metrics.messages.value == 0
+
+
+def test_broadcast_timer():
+    mock_conn = MagicMock()
+    timestamps = iter([1000.7, 2000.2])
+    broadcast(
+        mock_conn, [("pvUpdate", "TEST", "pv1", 1), ("pvUpdate", "TEST", "pv1", 2)], timer=lambda: next(timestamps)
+    )
+    mock_conn.cursor().execute.assert_called_with(
+        "SELECT * FROM pvUpdate(%s, %s, %s, %s, %s)", ["TEST", "pv1", 2, 0, 2000]
+    )
+
+
+@patch("time.time")
+def test_main_backfill(mock_time, tmp_path):
+    mock_time.return_value = 100000.0
+    pv_file = tmp_path / "pvs.json"
+    pv_file.write_text(
+        json.dumps({"pvUpdate": [{"frequency": 10, "instrument": "TEST", "name": "pv1", "function": "{x}"}]})
+    )
+    mock_conn = MagicMock()
+    mock_cursor = mock_conn.cursor.return_value
+    mock_cursor.mogrify.side_effect = lambda query, args: (query % tuple(repr(arg) for arg in args)).encode()
+    argv = [
+        "--pv-files",
+        str(pv_file),
+        "--batch",
+        "--backfill",
+        "60",
+        "--time-offset",
+        "3600",
+        "--report-interval",
+        "0",
+    ]
+    with patch("webmonchow.pv.broadcast.connect_to_database", return_value=mock_conn):
+        main(argv)
+    statements = [call.args[0] for call in mock_cursor.execute.call_args_list]
+    assert statements[0] == b"SELECT * FROM pvUpdate('TEST', 'pv1', 3600.0, 0, 99940)"
+    assert statements[-1] == b"SELECT * FROM pvUpdate('TEST', 'pv1', 3660.0, 0, 100000)"
+    assert len(statements) == 7
+
+
 def test_get_options_default():
     options = get_options([])
     assert options.user == "postgres"
@@ -97,6 +299,40 @@ def test_get_options_default():
     assert options.port == "5432"
     assert options.database == "workflow"
     assert os.path.basename(options.pv_files) == "dasmon.json"
+    assert options.batch is False
+    assert options.max_batch_size == 1000
+    assert options.max_delay == 0.0
+    assert options.writers == 1
+    assert options.rate is None
+    assert options.replay is None
+    assert options.workers == 1
+    assert options.time_offset == 0.0
+    assert options.backfill is None
+    assert options.speed == 1.0
+    assert options.metrics_port is None
+    assert options.prepare is True
+    assert options.buffer_size == 10000
+    assert options.overflow == "drop-oldest"
+    assert options.spill_file is None
+    assert options.verbose is False
+    assert get_options(["--no-prepare"]).prepare is False
+    with pytest.raises(SystemExit):
+        get_options(["--spill-file", "held.pickle", "--workers", "2"])
+
+
+def test_get_options_rate_and_speed():
+    with pytest.raises(SystemExit):
+        get_options(["--rate", "100/s", "--speed", "60"])
+
+
+def test_main_rate_without_periodic_updates(tmp_path, capsys):
+    pv_file = tmp_path / "pvs.json"
+    pv = {"frequency": 0, "instrument": "TEST", "name": "pv1", "function": "1"}  # sent once
+    pv_file.write_text(json.dumps({"pvUpdate": [pv]}))
+    with pytest.raises(SystemExit) as exit_info:
+        main(["--pv-files", str(pv_file), "--rate", "100/s", "--report-interval", "0"])
+    assert exit_info.value.code == 2
+    assert "--rate requires periodic PV updates" in capsys.readouterr().err
 
 
 def test_get_options():
@@ -0,0 +1,69 @@
+# standard imports
+import json
+import math
+
+# third-party imports
+import pytest
+
+# webmonchow imports
+from webmonchow.pv.expressions import ExpressionError, compile_function, pv_seed
+
+
+@pytest.mark.parametrize(
+    "template, x, expected",
+    [
+        ("100", 5.0, 100),
+        ("{x}", 5.0, 5.0),
+        ("{x}%600", 650.0, 50.0),
+        ("100*math.sin({x}/3600)", 1800.0, 100 * math.sin(0.5)),
+        ("'string {x}'", 1.0, "string 1.0"),
+        ("'{{literal}} {x} and {x}'", 2.0, "{literal} 2.0 and 2.0"),
+        ("max({x}, 3)", 2.0, 3),
+    ],
+)
+def test_compile_function(template, x, expected):
+    assert compile_function(template)(x) == expected
+
+
+def test_compile_function_matches_format_eval(content_files):
+    with open(content_files["pv"]["dasmon"]) as f:
+        data = json.load(f)
+    for pvs in data.values():
+        for pv in pvs:
+            if "random" not in pv["function"]:
+                assert compile_function(pv["function"])(42.0) == eval(pv["function"].format(x=42.0))
+
+
+def test_compile_function_random():
+    assert compile_function("random.choice([0, 1])")(0.0) in (0, 1)
+
+
+@pytest.mark.parametrize(
+    "template",
+    [
+        "100*math.sin({x}/",  # syntax error
+        "{y}",  # unknown template field
+        "os.system('true')",  # name not allowed
+        "__import__('os')",  # builtin not allowed
+        "math.__dict__",  # private attribute
+        "(lambda: 1)()",
+    ],
+)
+def test_compile_function_invalid(template):
+    with pytest.raises(ExpressionError):
+        compile_function(template)
+
+
+def test_compile_function_names():
+    assert compile_function("offset + {x}", names={"offset": 10})(1.0) == 11.0
+
+
+def test_pv_seed():
+    assert pv_seed(1, "HYSA", "sinPV") == pv_seed(1, "HYSA", "sinPV")
+    assert len({pv_seed(1, "HYSA", "sinPV"), pv_seed(2, "HYSA", "sinPV"), pv_seed(1, "ARCS", "sinPV")}) == 3
+    assert pv_seed(1, "A", "BC") != pv_seed(1, "AB", "C")
+    assert 0 <= pv_seed(1, "HYSA", "sinPV") < 2**64
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
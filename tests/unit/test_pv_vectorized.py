@@ -0,0 +1,202 @@
+# standard imports
+import itertools
+import json
+
+# third-party imports
+import pytest
+
+# webmonchow imports
+from webmonchow.pv.broadcast import pv_generator
+from webmonchow.pv.expressions import compile_function, seeded_names
+from webmonchow.scheduler import Scheduler
+
+np = pytest.importorskip("numpy")
+from webmonchow.pv.vectorized import (  # noqa: E402
+    NotVectorizableError,
+    PVStreams,
+    group_contents,
+    structure,
+    vectorized_pv_batch_generator,
+    vectorized_pv_generator,
+)
+
+
+def test_structure():
+    _, key1, constants1 = structure("300+10*math.sin({x}/300)+random.random()*2")
+    _, key2, constants2 = structure("490+10*math.sin({x}/300)+random.random()")
+    _, key3, constants3 = structure("490+10*math.sin({x}/300)+random.random()*1")
+    assert key1 == key3 != key2
+    assert constants1 == [300, 10, 300, 2]
+    assert constants3 == [490, 10, 300, 1]
+
+
+@pytest.mark.parametrize(
+    "template",
+    ["'string {x}'", "math.gcd(2, 4)", "random.randint(1, 3)", "{x} > 2", "math.sin({x}, 2)", "abs({x}, 2)"],
+)
+def test_structure_not_vectorizable(template):
+    with pytest.raises(NotVectorizableError):
+        structure(template)
+
+
+def test_group_contents():
+    data = {
+        "pvUpdate": [
+            {"frequency": 1, "instrument": "A", "name": "pv1", "function": "1+{x}"},
+            {"frequency": 1, "instrument": "B", "name": "pv2", "function": "2+{x}"},
+            {"frequency": 2, "instrument": "C", "name": "pv3", "function": "3+{x}"},
+        ],
+        "pvStringUpdate": [{"frequency": 1, "instrument": "A", "name": "pv4", "function": "'x={x}'"}],
+    }
+    groups, scalars = group_contents(data)
+    assert [len(group) for group in groups] == [2, 1]
+    assert groups[0].evaluate(10.0, np.random.default_rng()) == [11.0, 12.0]
+    assert scalars == {"pvStringUpdate": data["pvStringUpdate"]}
+
+
+def _group(*templates, seed=None):
+    pvs = [{"frequency": 1, "instrument": "A", "name": f"pv{i}", "function": t} for i, t in enumerate(templates)]
+    groups, scalars = group_contents({"pvUpdate": pvs}, seed)
+    assert len(groups) == 1 and not scalars
+    return groups[0]
+
+
+@pytest.mark.parametrize(
+    "template",
+    [
+        *(
+            f"math.{function}(0.25+{{x}}/100)"
+            for function in "acos asin atan ceil cos cosh exp fabs floor log log10 sin sinh sqrt tan tanh".split()
+        ),
+        "math.log(2+{x}, 10)",
+        "abs(2-{x})",
+    ],
+)
+def test_vectorized_math_matches_scalar(template):
+    group = _group(template, template.replace("0.25", "0.5").replace("2", "3"))
+    scalars = [compile_function(t) for t in group.templates]
+    for x in (0.0, 1.0, 5.0, 5.0):  # evaluated twice, the constants of the group are left untouched
+        assert group.evaluate(x, np.random.default_rng()) == pytest.approx([f(x) for f in scalars])
+
+
+@pytest.mark.parametrize(
+    "template, error",
+    [("1/({x}-1)", ZeroDivisionError), ("math.sqrt(2-{x}*3)", ValueError), ("math.exp({x}*1000)", OverflowError)],
+)
+def test_vectorized_errors_as_scalar(template, error):
+    group = _group(template, template.replace("1", "2", 1))
+    with pytest.raises(error):
+        compile_function(template)(1.0)
+    with pytest.raises(error):
+        group.evaluate(1.0, np.random.default_rng())
+
+
+def test_vectorized_overflow_as_scalar():
+    group = _group("1e308*10*{x}", "1e308*20*{x}")  # Python floats overflow to inf without raising
+    assert group.evaluate(1.0, np.random.default_rng()) == [float("inf"), float("inf")]
+
+
+def test_vectorized_overflow_seeded():
+    templates = [f"{i}+random.random()+1/(1e308*10*({{x}}+1))" for i in range(2)]  # NumPy overflows, Python doesn't
+
+    def run():
+        group = _group(*templates, seed=1)
+        return [group.evaluate(x, PVStreams([1, 2])) for x in range(3)]
+
+    scalars = [compile_function(t, seeded_names(1, "A", f"pv{i}")) for i, t in enumerate(templates)]
+    assert run() == run() == [[f(x) for f in scalars] for x in range(3)]
+
+
+def test_vectorized_matches_scalar(fake_clock, content_files):
+    with open(content_files["pv"]["dasmon"]) as f:
+        data = json.load(f)
+    deterministic = {
+        sql_function: [pv for pv in pvs if "random" not in pv["function"]] for sql_function, pvs in data.items()
+    }
+    expected = itertools.islice(pv_generator(deterministic, scheduler=Scheduler(clock=fake_clock)), 50)
+    generated = itertools.islice(vectorized_pv_generator(deterministic, scheduler=Scheduler(clock=fake_clock)), 50)
+    key = lambda update: update[:3]  # noqa: E731
+    for actual, wanted in zip(sorted(generated, key=key), sorted(expected, key=key)):
+        assert actual[:3] == wanted[:3]
+        assert actual[3] == pytest.approx(wanted[3])
+
+
+def test_vectorized_batches(fake_clock):
+    data = {
+        "pvUpdate": [
+            {"frequency": 1, "instrument": "A", "name": "pv1", "function": "1+{x}"},
+            {"frequency": 1, "instrument": "B", "name": "pv2", "function": "2+{x}"},
+        ],
+        "pvStringUpdate": [{"frequency": 1, "instrument": "A", "name": "pv3", "function": "'x={x}'"}],
+    }
+    batch_gen = vectorized_pv_batch_generator(data, scheduler=Scheduler(clock=fake_clock))
+    next(batch_gen)
+    assert next(batch_gen) == [
+        ("pvUpdate", "A", "pv1", 2.0),
+        ("pvUpdate", "B", "pv2", 3.0),
+        ("pvStringUpdate", "A", "pv3", "x=1.0"),
+    ]
+
+
+def test_vectorized_random_choice():
+    data = {
+        "pvUpdate": [
+            {"frequency": 1, "instrument": "A", "name": f"pv{i}", "function": f"random.choice([{i}, {i + 100}])"}
+            for i in range(50)
+        ]
+    }
+    groups, _ = group_contents(data)
+    values = groups[0].evaluate(0.0, np.random.default_rng(1))
+    assert all(value in (i, i + 100) for i, value in enumerate(values))
+
+
+def test_vectorized_random_choice_many():
+    options = list(range(100))  # more options than numpy.choose takes
+    group = _group(*(f"{i}+random.choice({options})" for i in range(3)))
+    values = group.evaluate(0.0, np.random.default_rng(1))
+    assert all(value - i in options for i, value in enumerate(values))
+
+
+def test_vectorized_seed(fake_clock, content_files):
+    with open(content_files["pv"]["dasmon"]) as f:
+        data = json.load(f)
+
+    def run(seed):
+        clock = type(fake_clock)()  # every run starts at time zero
+        return list(itertools.islice(vectorized_pv_generator(data, seed, Scheduler(clock=clock)), 100))
+
+    assert run(7) == run(7)
+    assert run(7) != run(8)
+
+
+def test_vectorized_seed_per_pv(fake_clock):
+    data = {
+        "pvUpdate": [
+            {"frequency": 1, "instrument": "A", "name": f"pv{i}", "function": f"{i}+random.gauss(0, 1)"}
+            for i in range(6)
+        ]
+    }
+
+    def run(pvs):
+        clock = type(fake_clock)()
+        updates = itertools.islice(vectorized_pv_generator({"pvUpdate": pvs}, 7, Scheduler(clock=clock)), 3 * len(pvs))
+        return sorted(updates)
+
+    everything = run(data["pvUpdate"])
+    # the values of a PV don't depend on the order of the PVs, nor on the other PVs of its group
+    assert run(data["pvUpdate"][::-1]) == everything
+    assert sorted(run(data["pvUpdate"][:3]) + run(data["pvUpdate"][3:])) == everything
+
+
+def test_pv_streams():
+    streams = PVStreams([1, 2, 1])
+    values = np.concatenate([streams.random(3) for _ in range(1000)])
+    assert ((values >= 0) & (values < 1)).all()
+    assert abs(values.mean() - 0.5) < 0.02
+    first = PVStreams([1, 2, 1]).random(3)
+    assert first[0] == first[2] != first[1]
+    assert set(PVStreams(range(100)).integers(0, 3, 100)) == {0, 1, 2}
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,205 @@
+# standard imports
+import threading
+from unittest.mock import MagicMock
+
+# third-party imports
+import psycopg2
+import pytest
+
+# webmonchow imports
+from webmonchow.metrics import Metrics
+from webmonchow.pv.writers import (
+    SQLFunctionError,
+    TableWriter,
+    Writer,
+    broadcast_sharded,
+    prepare_statements,
+    send_updates,
+    shard,
+    update_sender,
+    update_statements,
+)
+
+
+def mock_connection():
+    conn = MagicMock()
+    conn.cursor.return_value.mogrify.side_effect = lambda query, args: (
+        query % tuple(repr(arg) for arg in args)
+    ).encode()
+    return conn
+
+
+def test_send_updates():
+    conn = mock_connection()
+    send_updates(conn, conn.cursor(), [("pvUpdate", "TEST", "pv1", 1), ("pvUpdate", "TEST", "pv2", 2)], 42)
+    conn.cursor().execute.assert_called_once_with(
+        b"SELECT * FROM pvUpdate('TEST', 'pv1', 1, 0, 42);SELECT * FROM pvUpdate('TEST', 'pv2', 2, 0, 42)"
+    )
+    conn.commit.assert_called_once()
+
+
+def test_prepare_statements():
+    conn = mock_connection()
+    assert prepare_statements(conn) == ("pvUpdate", "pvStringUpdate")
+    assert conn.cursor().execute.call_args_list[0].args[0] == (
+        "PREPARE webmonchow_pvUpdate AS SELECT * FROM pvUpdate($1, $2, $3, $4, $5)"
+    )
+    updates = [("pvUpdate", "TEST", "pv1", 1), ("pvStringUpdate", "TEST", "pv2", "a")]
+    assert update_statements(conn, conn.cursor(), updates, 42) == [
+        b"EXECUTE webmonchow_pvUpdate('TEST', 'pv1', 1, 0, 42)",
+        b"EXECUTE webmonchow_pvStringUpdate('TEST', 'pv2', 'a', 0, 42)",
+    ]
+    # other connections still call the SQL functions
+    other = mock_connection()
+    assert update_statements(other, other.cursor(), [(*updates[0], 43)]) == [
+        b"SELECT * FROM pvUpdate('TEST', 'pv1', 1, 0, 43)"
+    ]
+
+
+def test_prepare_statements_missing_function():
+    conn = mock_connection()
+    conn.cursor().execute.side_effect = [None, psycopg2.ProgrammingError("function pvStringUpdate does not exist")]
+    assert prepare_statements(conn) == ("pvUpdate",)
+    conn.rollback.assert_called_once()
+    updates = [("pvUpdate", "TEST", "pv1", 1), ("pvStringUpdate", "TEST", "pv2", "a")]
+    assert update_statements(conn, conn.cursor(), updates, 42) == [
+        b"EXECUTE webmonchow_pvUpdate('TEST', 'pv1', 1, 0, 42)",
+        b"SELECT * FROM pvStringUpdate('TEST', 'pv2', 'a', 0, 42)",
+    ]
+
+
+def test_update_statements_unknown_function():
+    conn = mock_connection()
+    with pytest.raises(SQLFunctionError, match="unknown SQL functions pvDrop"):
+        update_statements(conn, conn.cursor(), [("pvDrop", "TEST", "pv1", 1)], 42)
+
+
+def table_connection():
+    conn = mock_connection()
+    cursor = conn.cursor()
+    cursor.fetchone.side_effect = lambda: (7,)
+    conn.copied = []
+    cursor.copy_expert.side_effect = lambda sql, stream: conn.copied.append((sql, stream.read()))
+    return conn
+
+
+def test_table_writer_copy():
+    conn = table_connection()
+    writer = TableWriter()
+    metrics = Metrics()
+    updates = [("pvUpdate", "TEST", "pv1", 1.5), ("pvStringUpdate", "TEST", "pv2", "a"), ("pvUpdate", "TEST", "pv1", 2)]
+    writer(conn, conn.cursor(), updates, 42, metrics)
+    # the first update of each PV registers it through its SQL function
+    assert conn.cursor().execute.call_args_list[0].args[0] == (
+        b"SELECT * FROM pvUpdate('TEST', 'pv1', 1.5, 0, 42);SELECT * FROM pvStringUpdate('TEST', 'pv2', 'a', 0, 42)"
+    )
+    assert conn.copied == [
+        ("COPY pvmon_pv (instrument_id, name_id, value, status, update_time) FROM STDIN", "7\t7\t2\t0\t42\n")
+    ]
+    assert writer.ids == {("TEST", "pv1"): (7, 7), ("TEST", "pv2"): (7, 7)}
+    # known PVs go straight to the tables
+    conn.cursor().execute.reset_mock()
+    writer(conn, conn.cursor(), updates[:1], 43, metrics)
+    conn.cursor().execute.assert_not_called()
+    assert metrics.send.count == 1
+    assert metrics.table.count == 2
+    assert metrics.messages.value == 4
+
+
+@pytest.mark.parametrize("method, statement", [("copy", "COPY pvmon_pv"), ("insert", "INSERT INTO pvmon_pv")])
+def test_table_writer_one_update_per_batch(method, statement):
+    conn = table_connection()
+    writer = TableWriter(method)
+    writer(conn, conn.cursor(), [("pvUpdate", "TEST", "pv1", 1)], 42)
+    assert writer.ids == {("TEST", "pv1"): (7, 7)}
+    assert conn.copied == []
+    # the PV is registered, the next updates go straight to the table
+    conn.cursor().execute.reset_mock()
+    writer(conn, conn.cursor(), [("pvUpdate", "TEST", "pv1", 2)], 43)
+    writer(conn, conn.cursor(), [("pvUpdate", "TEST", "pv1", 3)], 44)
+    statements = [sql for sql, _ in conn.copied]
+    statements += [call.args[0].decode() for call in conn.cursor().execute.call_args_list]
+    assert not any(sql.startswith("SELECT * FROM pvUpdate") for sql in statements)
+    assert [sql.startswith(statement) for sql in statements] == [True, True]
+
+
+def test_table_writer_insert():
+    conn = table_connection()
+    writer = TableWriter("insert", register=False)
+    writer(conn, conn.cursor(), [("pvUpdate", "TEST", "pv1", 1), ("pvUpdate", "TEST", "pv2", 2)], 42)
+    statement = conn.cursor().execute.call_args_list[-1].args[0]
+    assert statement == b"INSERT INTO pvmon_pv (instrument_id, name_id, value, status, update_time) VALUES " + (
+        b"(7, 7, 1, 0, 42),(7, 7, 2, 0, 42)"
+    )
+    conn.commit.assert_called_once()
+    with pytest.raises(ValueError):
+        TableWriter("upsert")
+
+
+def test_update_sender():
+    assert update_sender() is send_updates
+    assert isinstance(update_sender("table", "insert"), TableWriter)
+    conn = table_connection()
+    metrics = Metrics()
+    update_sender("both")(conn, conn.cursor(), [("pvUpdate", "TEST", "pv1", 1)], 42, metrics)
+    assert (metrics.send.count, metrics.table.count) == (1, 1)
+    assert conn.commit.call_count == 2
+
+
+def test_shard():
+    assert shard("ARCS", 4) == shard("ARCS", 4)
+    assert {shard(f"INST{i}", 4) for i in range(100)} == {0, 1, 2, 3}
+
+
+def test_broadcast_sharded():
+    connections = []
+    lock = threading.Lock()
+
+    def connect():
+        with lock:
+            connections.append(mock_connection())
+            return connections[-1]
+
+    instruments = ["ARCS", "HYSA", "REF_M", "REF_L", "CNCS", "EQSANS"]
+    batches = [[("pvUpdate", inst, "pv", i) for inst in instruments] for i in range(10)]
+    broadcast_sharded(connect, iter(batches), writers=3, queue_size=2)
+
+    assert len(connections) == 3
+    sent = {}
+    for conn in connections:
+        for call in conn.cursor().mogrify.call_args_list:
+            inst, _, value, _, _ = call.args[1]
+            sent.setdefault(inst, []).append(value)
+        conn.close.assert_called_once()
+    assert sent == {inst: list(range(10)) for inst in instruments}  # every update, in order
+
+
+def test_writer_reconnects():
+    failing = mock_connection()
+    failing.cursor.return_value.execute.side_effect = psycopg2.OperationalError("connection lost")
+    healthy = mock_connection()
+    connections = iter([failing, healthy])
+    writer = Writer(lambda: next(connections), name="writer")
+    writer.start()
+    writer.put(42, [("pvUpdate", "TEST", "pv", 1)])
+    writer.stop()
+    failing.close.assert_called_once()
+    healthy.cursor().execute.assert_called_once()
+    healthy.commit.assert_called_once()
+
+
+def test_writer_error():
+    conn = mock_connection()
+    conn.cursor.return_value.execute.side_effect = psycopg2.ProgrammingError("function does not exist")
+    writer = Writer(lambda: conn, name="writer")
+    writer.start()
+    writer.put(42, [("pvUpdate", "TEST", "pv", 1)])
+    writer.join()
+    with pytest.raises(RuntimeError, match="writer stopped"):
+        writer.put(43, [("pvUpdate", "TEST", "pv", 2)])
+    with pytest.raises(RuntimeError):
+        writer.stop()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,106 @@
+# standard imports
+import itertools
+import math
+from unittest.mock import patch
+
+# third-party imports
+import pytest
+
+# webmonchow imports
+from webmonchow.rate import RateProfile, WarpedClock, natural_rate, parse_rate, report_rate
+from webmonchow.scheduler import Scheduler
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [("5000/s", 5000.0), ("5000", 5000.0), ("120/min", 2.0), ("7200 / h", 2.0), ("0/s", 0.0)],
+)
+def test_parse_rate(text, expected):
+    assert parse_rate(text) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("text", ["fast", "10/day", "-5/s", "inf"])
+def test_parse_rate_invalid(text):
+    with pytest.raises(ValueError):
+        parse_rate(text)
+
+
+def test_rate_profile_parse():
+    assert RateProfile.parse("5000/s").rate(1e6) == 5000.0
+    step = RateProfile.parse("step:1000/s@60,2000/s@60,5000/s")
+    assert [step.rate(t) for t in (0, 59, 60, 120, 1e6)] == [1000.0, 1000.0, 2000.0, 5000.0, 5000.0]
+    ramp = RateProfile.parse("ramp:100/s..5000/s@300")
+    assert [ramp.rate(t) for t in (0, 150, 300, 1e6)] == pytest.approx([100.0, 2550.0, 5000.0, 5000.0])
+    burst = RateProfile.parse("burst:1000/s,10000/s@5/60")
+    assert [burst.rate(t) for t in (0, 54.9, 55, 59.9, 60, 115)] == [1000.0, 1000.0, 10000.0, 10000.0, 1000.0, 1e4]
+
+
+@pytest.mark.parametrize("text", ["", "wave:1/s", "ramp:1/s..2/s", "burst:1/s,2/s@5/5", "step:1/s@x,2/s"])
+def test_rate_profile_parse_invalid(text):
+    with pytest.raises(ValueError):
+        RateProfile.parse(text)
+
+
+@pytest.mark.parametrize(
+    "text",
+    ["500/s", "step:100/s@10,0/s@5,1000/s", "ramp:10/s..1000/s@30", "ramp:1000/s..10/s@30", "burst:100/s,1000/s@2/7"],
+)
+def test_warped_clock_inverse(text):
+    clock = WarpedClock(RateProfile.parse(text), natural_rate=100.0, origin=0.0)
+    for wall in (0.0, 1.0, 9.99, 12.5, 15.0, 29.0, 30.0, 100.0, 1000.0):
+        tau = clock.content_time(wall)
+        assert clock.content_time(clock.wall_time(tau)) == pytest.approx(tau)
+
+
+def test_warped_clock_speed():
+    # content emitting 10 messages per second, played at 100/s then 1000/s
+    clock = WarpedClock(RateProfile.parse("step:100/s@10,1000/s"), natural_rate=10.0, origin=0.0)
+    assert clock.content_time(10.0) == pytest.approx(100.0)
+    assert clock.content_time(11.0) == pytest.approx(200.0)
+    assert clock.wall_time(150.0) == pytest.approx(10.5)
+    ramp = WarpedClock(RateProfile.parse("ramp:0/s..20/s@10"), natural_rate=10.0, origin=0.0)
+    assert ramp.content_time(10.0) == pytest.approx(10.0)  # average speed of 1 over the ramp
+    assert ramp.wall_time(2.5) == pytest.approx(5.0)
+    with pytest.raises(ValueError):
+        WarpedClock(RateProfile.parse("10/s"), natural_rate=0.0)
+
+
+def test_warped_clock_sleep():
+    with patch("time.monotonic", return_value=100.0):
+        clock = WarpedClock(RateProfile.parse("200/s"), natural_rate=100.0)
+    with patch("time.monotonic", return_value=101.0), patch("time.sleep") as mock_sleep:
+        assert clock.now() == pytest.approx(2.0)
+        clock.sleep_until(3.0)
+        mock_sleep.assert_called_once_with(pytest.approx(0.5))
+
+
+def test_scheduler_at_target_rate():
+    # two PVs updated every 2 and 4 seconds have a natural rate of 0.75 messages per second
+    rate = natural_rate([2.0, 4.0, 0])
+    assert rate == pytest.approx(0.75)
+    clock = WarpedClock(RateProfile.parse("300/s"), rate, origin=0.0)
+    walls = []
+    with patch("time.monotonic", return_value=0.0), patch("time.sleep", side_effect=walls.append):
+        scheduler = Scheduler(clock)
+        scheduler.add("a", 2.0)
+        scheduler.add("b", 4.0)
+        fired = list(itertools.islice(scheduler, 301))
+    assert fired[-1][0] == pytest.approx(400.0)  # 300 messages sent over one second of wall clock
+    assert walls[-1] == pytest.approx(1.0)
+
+
+def test_report_rate(capsys):
+    times = iter([0.0, 2.0, 4.0, 6.0, 11.0, 12.0])
+    with patch("time.monotonic", side_effect=lambda: next(times)):
+        items = list(report_rate(iter([[1, 2], [3], [4, 5, 6], [7], [8]]), RateProfile.parse("1/s"), 5.0, size=len))
+    assert items == [[1, 2], [3], [4, 5, 6], [7], [8]]
+    lines = capsys.readouterr().out.splitlines()
+    assert lines == [
+        "Achieved 1.0/s (target 1.0/s), 6 messages in 6 s",
+        "Achieved 0.2/s (target 1.0/s), 7 messages in 11 s",
+    ]
+    assert math.isclose(natural_rate([]), 0.0)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
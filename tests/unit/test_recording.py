@@ -0,0 +1,130 @@
+# standard imports
+import json
+import os
+from unittest.mock import MagicMock
+
+# third-party imports
+import pytest
+
+# webmonchow imports
+from webmonchow.recording import (
+    Recorder,
+    Recording,
+    RecordingError,
+    get_options,
+    main,
+    record_broker,
+    replay,
+    replay_messages,
+    replay_updates,
+)
+
+
+def _record(path, count, block_size=10, start=1000.0):
+    with Recorder(path, "amq", block_size) as recorder:
+        for i in range(count):
+            recorder.append(start + i * 0.5, f"/topic/TEST.{i % 3}", json.dumps({"i": i}).encode())
+
+
+def test_record_and_read(tmp_path):
+    path = str(tmp_path / "feed.rec")
+    _record(path, 25)
+    with Recording(path, "amq") as recording:
+        assert len(recording) == 25
+        assert recording.start_time == 1000.0
+        records = list(recording.records())
+    assert records[0] == (1000.0, "/topic/TEST.0", b'{"i": 0}')
+    assert records[-1] == (1012.0, "/topic/TEST.0", b'{"i": 24}')
+    assert os.path.getsize(path) < sum(len(channel) + len(payload) for _, channel, payload in records)
+
+
+def test_records_start(tmp_path):
+    path = str(tmp_path / "feed.rec")
+    _record(path, 25)
+    with Recording(path) as recording:
+        assert [timestamp for timestamp, _, _ in recording.records(start=1005.2)][:2] == [1005.5, 1006.0]
+        assert list(recording.records(start=2000.0)) == []
+
+
+def test_append_to_recording(tmp_path):
+    path = str(tmp_path / "feed.rec")
+    _record(path, 5)
+    _record(path, 5, start=2000.0)
+    with Recording(path) as recording:
+        assert len(recording) == 10
+        assert [timestamp for timestamp, _, _ in recording.records()][4:6] == [1002.0, 2000.0]
+    with pytest.raises(RecordingError):
+        Recorder(path, "pv")
+
+
+def test_interrupted_recording(tmp_path):
+    path = str(tmp_path / "feed.rec")
+    recorder = Recorder(path, "amq", block_size=10)
+    for i in range(25):
+        recorder.append(1000.0 + i, "/topic/TEST", b"{}")
+    with Recording(path) as recording:  # two complete blocks, no index
+        assert len(recording) == 20
+    with open(path, "ab") as f:
+        f.write(b"\x00" * 7)  # incomplete block
+    with Recording(path) as recording:
+        assert len(recording) == 20
+
+
+def test_not_a_recording(tmp_path):
+    path = tmp_path / "feed.json"
+    path.write_text("{}")
+    with pytest.raises(RecordingError):
+        Recording(str(path))
+    _record(str(tmp_path / "feed.rec"), 1)
+    with pytest.raises(RecordingError):
+        Recording(str(tmp_path / "feed.rec"), "pv")
+
+
+def test_replay(tmp_path, fake_clock):
+    path = str(tmp_path / "feed.rec")
+    _record(path, 5)
+    messages = list(replay_messages(path, speed=2.0, clock=fake_clock))
+    assert messages[1] == ("/topic/TEST.1", b'{"i": 1}')
+    assert fake_clock.time == pytest.approx(1.0)  # 2 seconds recorded, replayed twice faster
+    fake_clock.time = 0.0
+    with Recording(path) as recording:
+        assert len(list(replay(recording, speed=float("inf"), clock=fake_clock))) == 5
+    assert fake_clock.time == 0.0
+    with pytest.raises(ValueError):
+        list(replay_messages(path, speed=0))
+
+
+def test_record_pv_trace(tmp_path, fake_clock):
+    trace = tmp_path / "trace.csv"
+    trace.write_text("time,instrument,name,value\n100.0,HYSA,temperature,300.5\n101.5,HYSA,state,RUNNING\n")
+    path = str(tmp_path / "pv.rec")
+    main([path, "--pv-trace", str(trace)])
+    updates = list(replay_updates(path, clock=fake_clock))
+    assert updates == [("pvUpdate", "HYSA", "temperature", 300.5), ("pvStringUpdate", "HYSA", "state", "RUNNING")]
+    assert fake_clock.time == 1.5
+
+
+def test_record_broker(tmp_path):
+    path = str(tmp_path / "feed.rec")
+    connection = MagicMock()
+    with Recorder(path, "amq") as recorder:
+        count = record_broker(recorder, connection, ["/topic/SNS.>"], duration=0)
+        listener = connection.set_listener.call_args.args[1]
+        frame = MagicMock(headers={"destination": "/topic/SNS.HYSA.STATUS.DASMON"}, body='{"status": "0"}')
+        listener.on_message(frame)
+    assert count == 0
+    connection.subscribe.assert_called_once()
+    connection.disconnect.assert_called_once()
+    with Recording(path) as recording:
+        assert [record[1:] for record in recording.records()] == [("/topic/SNS.HYSA.STATUS.DASMON", b'{"status": "0"}')]
+
+
+def test_get_options():
+    options = get_options(["feed.rec"])
+    assert options.destinations == "/topic/SNS.>"
+    assert options.pv_trace is None
+    assert options.duration is None
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
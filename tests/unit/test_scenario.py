@@ -0,0 +1,110 @@
+# standard imports
+import itertools
+import json
+
+# third-party imports
+import pytest
+
+# webmonchow imports
+from webmonchow.amq.templates import MessageTemplate
+from webmonchow.pv.expressions import ExpressionError
+from webmonchow.scenario import (
+    ScenarioError,
+    compile_scenario,
+    instrument_names,
+    load_scenario,
+    scenario_files,
+    schedule_scenario,
+)
+from webmonchow.scheduler import Scheduler, SimulatedClock
+
+SCENARIO = {
+    "instruments": ["HYSA", "ARCS"],
+    "run_period": 100,
+    "first_run": 10,
+    "steps": [
+        {
+            "at": 0,
+            "every": 30,
+            "destination": "/topic/SNS.{instrument}.APP.DASMON",
+            "message": {"run_number": 0, "recording": True},
+            "fields": {"run_number": "{run}"},
+        },
+        {
+            "at": 80,
+            "destination": "POSTPROCESS.DATA_READY",
+            "message": {"instrument": "{instrument}", "data_file": "/SNS/{instrument}/{instrument}_{run}.nxs.h5"},
+        },
+    ],
+    "pvs": [{"sql_function": "pvUpdate", "name": "run", "frequency": 25, "function": "{run}+{phase}/1000"}],
+}
+
+
+def _events(scenario, end):
+    scheduler = Scheduler(SimulatedClock(sleep=False), end=end)
+    schedule_scenario(scheduler, scenario)
+    for x, (feed, target, content) in scheduler:
+        if feed == "amq":
+            message = content.render(x) if isinstance(content, MessageTemplate) else content
+            yield x, target, json.loads(message)
+        else:
+            yield x, content.instrument, content.function(x)
+
+
+def test_instrument_names():
+    assert instrument_names({"instruments": 3}) == ["SIM1", "SIM2", "SIM3"]
+    assert instrument_names({"instruments": 10, "prefix": "BL"})[:2] == ["BL01", "BL02"]
+    assert instrument_names({"instruments": ["HYSA"]}) == ["HYSA"]
+
+
+def test_compile_scenario():
+    amq_data, offsets, pv_data = compile_scenario(SCENARIO)
+    assert list(amq_data) == [
+        "/topic/SNS.HYSA.APP.DASMON",
+        "POSTPROCESS.DATA_READY",
+        "/topic/SNS.ARCS.APP.DASMON",
+    ]
+    # the instruments are spread over the run period
+    assert offsets["/topic/SNS.HYSA.APP.DASMON"] == [0, 30, 60, 90]
+    assert offsets["/topic/SNS.ARCS.APP.DASMON"] == [50, 80, 110, 140]
+    assert offsets["POSTPROCESS.DATA_READY"] == [80, 130]
+    assert all(programme.frequency == 100 for programme in amq_data["POSTPROCESS.DATA_READY"])
+    assert [(pv.instrument, pv.name) for pv in pv_data["pvUpdate"]] == [("HYSA", "run"), ("ARCS", "run")]
+
+
+def test_scenario_timeline():
+    events = list(_events(SCENARIO, end=230))
+    data_ready = [(x, message["instrument"], message["data_file"]) for x, target, message in events if "POST" in target]
+    assert data_ready == [
+        (80, "HYSA", "/SNS/HYSA/HYSA_10.nxs.h5"),
+        (130, "ARCS", "/SNS/ARCS/ARCS_10.nxs.h5"),
+        (180, "HYSA", "/SNS/HYSA/HYSA_11.nxs.h5"),
+        (230, "ARCS", "/SNS/ARCS/ARCS_11.nxs.h5"),
+    ]
+    dasmon = [(x, message["run_number"]) for x, target, message in events if target == "/topic/SNS.ARCS.APP.DASMON"]
+    assert dasmon == [(50, 10), (80, 10), (110, 10), (140, 10), (150, 11), (180, 11), (210, 11)]
+    # the PVs follow the run of their instrument
+    updates = dict((x, value) for x, instrument, value in events if instrument == "ARCS")
+    assert [updates[x] for x in (50, 75, 150, 175)] == [10.0, 10.025, 11.0, 11.025]
+
+
+def test_scenario_invalid():
+    with pytest.raises(ScenarioError):
+        compile_scenario({"steps": []})
+    with pytest.raises(ScenarioError):
+        compile_scenario({**SCENARIO, "steps": [{**SCENARIO["steps"][1], "at": 100}]})
+    with pytest.raises(ExpressionError) as e:
+        compile_scenario({**SCENARIO, "pvs": [{"name": "bad", "frequency": 1, "function": "{run"}]})
+    assert "HYSA bad" in str(e.value)
+
+
+def test_shipped_scenarios():
+    assert "runs" in scenario_files()
+    scenario = load_scenario("runs")
+    events = list(itertools.islice(_events(scenario, end=scenario["run_period"]), 1000))
+    targets = {target for _, target, _ in events}
+    assert {"POSTPROCESS.DATA_READY", "REDUCTION.STARTED", "REDUCTION.COMPLETE"} <= targets
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
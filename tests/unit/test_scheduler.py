@@ -0,0 +1,99 @@
+# standard imports
+import itertools
+from unittest.mock import patch
+
+# third-party imports
+import pytest
+
+# webmonchow imports
+from webmonchow.scheduler import MonotonicClock, Scheduler, SimulatedClock
+
+
+def test_monotonic_clock():
+    with patch("time.monotonic", return_value=100.0):
+        clock = MonotonicClock()
+    with patch("time.monotonic", return_value=102.5), patch("time.sleep") as mock_sleep:
+        assert clock.now() == pytest.approx(2.5)
+        clock.sleep_until(3.0)
+        mock_sleep.assert_called_once_with(pytest.approx(0.5))
+        clock.sleep_until(1.0)  # already past
+        mock_sleep.assert_called_once()
+
+
+def test_scheduler_order(fake_clock):
+    scheduler = Scheduler(clock=fake_clock)
+    scheduler.add("a", 1.0)
+    scheduler.add("b", 2.0)
+    scheduler.add("c", 0)
+    fired = list(itertools.islice(scheduler, 7))
+    assert fired == [(0.0, "a"), (0.0, "b"), (0.0, "c"), (1.0, "a"), (2.0, "a"), (2.0, "b"), (3.0, "a")]
+
+
+def test_scheduler_sub_second_without_drift(fake_clock):
+    scheduler = Scheduler(clock=fake_clock)
+    scheduler.add("fast", 0.1)
+    scheduler.add("slow", 0.25, offset=0.05)
+    fired = list(itertools.islice(scheduler, 1000))
+    fast = [deadline for deadline, item in fired if item == "fast"]
+    assert fast[-1] == pytest.approx(0.1 * (len(fast) - 1), abs=1e-12)
+    assert [deadline for deadline, item in fired if item == "slow"][:3] == [0.05, 0.3, 0.55]
+    assert fake_clock.time == fired[-1][0]
+
+
+def test_scheduler_batches(fake_clock):
+    scheduler = Scheduler(clock=fake_clock)
+    scheduler.add("a", 1.0)
+    scheduler.add("b", 0.4)
+    batches = list(itertools.islice(scheduler.batches(), 4))
+    assert batches == [[(0.0, "a"), (0.0, "b")], [(0.4, "b")], [(0.8, "b")], [(1.0, "a")]]
+
+
+def test_scheduler_batches_max_delay(fake_clock):
+    scheduler = Scheduler(clock=fake_clock)
+    scheduler.add("a", 1.0)
+    scheduler.add("b", 0.25)
+    batches = scheduler.batches(max_delay=0.6)
+    assert next(batches) == [(0.0, "a"), (0.0, "b"), (0.25, "b"), (0.5, "b")]
+    assert fake_clock.now() == 0.5  # slept until the last deadline of the batch
+    assert next(batches) == [(0.75, "b"), (1.0, "a"), (1.0, "b"), (1.25, "b")]
+
+
+def test_scheduler_exhausted(fake_clock):
+    scheduler = Scheduler(clock=fake_clock)
+    scheduler.add("once", 0, offset=5.0)
+    assert len(scheduler) == 1
+    assert list(scheduler) == [(5.0, "once")]
+    assert len(scheduler) == 0
+
+
+def test_scheduler_negative_period(fake_clock):
+    with pytest.raises(ValueError):
+        Scheduler(clock=fake_clock).add("item", -1)
+
+
+def test_simulated_clock():
+    with patch("time.monotonic", return_value=100.0):
+        clock = SimulatedClock(speed=60.0, offset=3600.0)
+    with patch("time.monotonic", return_value=101.0), patch("time.sleep") as mock_sleep:
+        assert clock.now() == pytest.approx(3660.0)
+        clock.sleep_until(3720.0)
+        mock_sleep.assert_called_once_with(pytest.approx(1.0))
+    with pytest.raises(ValueError):
+        SimulatedClock(speed=0)
+
+
+def test_scheduler_offset_and_end():
+    clock = SimulatedClock(offset=1000.0, sleep=False)
+    scheduler = Scheduler(clock, end=1025.0)
+    scheduler.add("a", 10.0)
+    scheduler.add("b", 0.0, offset=5.0)
+    scheduler.add("c", 10.0, offset=30.0)  # starts after the end
+    assert list(scheduler) == [(1000.0, "a"), (1005.0, "b"), (1010.0, "a"), (1020.0, "a")]
+    assert clock.now() == 1020.0
+    batches = Scheduler(SimulatedClock(sleep=False), end=2.0)
+    batches.add("a", 0.5)
+    assert [len(batch) for batch in batches.batches(max_delay=1.0)] == [3, 2]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,152 @@
+# standard imports
+import json
+import time
+from unittest.mock import MagicMock
+
+# third-party imports
+import pytest
+
+# webmonchow imports
+from webmonchow.amq import broadcast as amq
+from webmonchow.amq.sender import broadcast_async
+from webmonchow.metrics import Metrics
+from webmonchow.pv import broadcast as pv
+from webmonchow.recording import Recorder
+from webmonchow.sinks import (
+    NdjsonFile,
+    NdjsonStompConnection,
+    NullDatabaseConnection,
+    NullStompConnection,
+    RecorderConnection,
+    SinkStats,
+    serve_stomp,
+)
+
+
+def test_sink_stats():
+    stats = SinkStats()
+    assert stats.summary() == "0 received, 0 bytes, in 0.00 s (n/a)"
+    stats.record(2, 10)
+    stats.record(1, 5)
+    assert (stats.count, stats.bytes) == (3, 15)
+    assert stats.first <= stats.last
+
+
+def test_null_stomp_connection():
+    connection = NullStompConnection()
+    connection.send("/queue/TEST", b'{"a": 1}')
+    assert (connection.stats.count, connection.stats.bytes) == (1, 8)
+
+
+def test_null_stomp_connection_receipts():
+    connection = NullStompConnection()
+    metrics = Metrics()
+    broadcast_async(connection, iter([("/queue/TEST", b"1")] * 5), window=2, metrics=metrics)
+    assert connection.stats.count == 5
+    assert metrics.ack.count == 5
+
+
+def test_ndjson_stomp_connection(tmp_path):
+    file = NdjsonFile(str(tmp_path / "messages.ndjson"))
+    connection = NdjsonStompConnection(file)
+    amq.broadcast(connection, iter([("/queue/A", b'{"a": 1}'), ("/topic/B", {"b": [2]})]))
+    file.close()
+    records = [json.loads(line) for line in (tmp_path / "messages.ndjson").read_text().splitlines()]
+    assert [(record["destination"], record["message"]) for record in records] == [
+        ("/queue/A", {"a": 1}),
+        ("/topic/B", {"b": [2]}),
+    ]
+    assert records[0]["time"] == pytest.approx(time.time(), abs=60)
+
+
+def test_null_database_connection():
+    conn = NullDatabaseConnection()
+    pv.broadcast_batches(conn, [[("pvUpdate", "TEST", "pv1", 1.5), ("pvStringUpdate", "TEST", "pv2", "it's")]])
+    assert conn.cursor().statements == 2
+    assert conn.commits == 1
+    assert conn.stats.count == 2
+    assert conn.cursor().mogrify("SELECT f(%s, %s)", ["it's", 2]) == b"SELECT f('it''s', 2)"
+
+
+def test_recorder_connection(tmp_path):
+    file = NdjsonFile(str(tmp_path / "pvs.ndjson"))
+    conn = RecorderConnection(file)
+    updates = [("pvUpdate", "TEST", "pv1", 1.5), ("pvUpdate", "TEST", "pv1", 2.5), ("pvStringUpdate", "TEST", "s", "a")]
+    pv.broadcast(conn, iter(updates), timer=lambda: 42.0)
+    conn.cursor().mogrify("SELECT * FROM pvUpdate(%s, %s, %s, %s, %s)", ["TEST", "pv1", 9.0, 0, 43])
+    conn.rollback()  # not committed
+    conn.commit()
+    file.close()
+    assert conn.calls == {"pvUpdate": 2, "pvStringUpdate": 1}
+    assert conn.values == {("TEST", "pv1"): 2.5, ("TEST", "s"): "a"}
+    records = [json.loads(line) for line in (tmp_path / "pvs.ndjson").read_text().splitlines()]
+    assert records[0]["function"] == "pvUpdate"
+    assert records[-1] == {**records[-1], "name": "s", "value": "a", "status": 0, "update_time": 42}
+
+
+def test_stomp_server():
+    server = serve_stomp()
+    try:
+        connection = amq.connect_to_broker(server.address, "user", "password", attempts=1)
+        listener = MagicMock()
+        connection.set_listener("receipts", listener)
+        for i in range(10):
+            connection.send("/queue/TEST", b'{"i": %d}' % i, receipt=f"r{i}")
+        deadline = time.monotonic() + 5.0
+        while listener.on_receipt.call_count < 10 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert [call.args[0].headers["receipt-id"] for call in listener.on_receipt.call_args_list] == [
+            f"r{i}" for i in range(10)
+        ]
+        assert server.stats.count == 10
+        connection.disconnect()
+    finally:
+        server.shutdown()
+
+
+def test_amq_main_stomp_sink(tmp_path, capsys):
+    path = str(tmp_path / "messages.rec")
+    with Recorder(path, "amq") as recorder:
+        for i in range(20):
+            recorder.append(1000.0 + i, "/queue/TEST", b'{"i": %d}' % i)
+    amq.main(["--replay", path, "--speed", "inf", "--sink", "stomp", "--async", "--window", "5"])
+    assert "Sink stomp: 20 received" in capsys.readouterr().out
+
+
+def test_pv_main_recorder_sink(tmp_path, capsys):
+    pv_file = tmp_path / "pvs.json"
+    pv_file.write_text(
+        json.dumps({"pvUpdate": [{"frequency": 10, "instrument": "TEST", "name": "pv1", "function": "{x}"}]})
+    )
+    pv.main(["--pv-files", str(pv_file), "--backfill", "60", "--sink", "recorder", "--report-interval", "0"])
+    output = capsys.readouterr().out
+    assert "Sink recorder: 7 received" in output
+    assert "pvUpdate: 7 calls" in output
+
+
+@pytest.mark.parametrize("method", ["copy", "insert"])
+def test_pv_main_table_path(tmp_path, capsys, method):
+    pv_file = tmp_path / "pvs.json"
+    pv_file.write_text(
+        json.dumps({"pvUpdate": [{"frequency": 10, "instrument": "TEST", "name": "pv1", "function": "{x}"}]})
+    )
+    argv = ["--pv-files", str(pv_file), "--backfill", "60", "--sink", "null", "--report-interval", "0"]
+    pv.main([*argv, "--write-path", "both", "--table-method", method])
+    # every update through the SQL function, then into the table
+    assert "Sink null: 14 received" in capsys.readouterr().out
+    pv.main([*argv, "--write-path", "table", "--table-method", method])
+    # the first update registers the PV through the SQL function
+    assert "Sink null: 7 received" in capsys.readouterr().out
+
+
+def test_sink_options():
+    assert amq.get_options([]).sink == "broker"
+    assert pv.get_options([]).sink == "database"
+    with pytest.raises(SystemExit):
+        amq.get_options(["--sink", "null", "--broker", "a:1,b:2"])
+    with pytest.raises(SystemExit):
+        pv.get_options(["--sink", "ndjson", "--workers", "2"])
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,63 @@
+# standard imports
+import time
+
+# third-party imports
+import pytest
+
+# webmonchow imports
+from webmonchow.metrics import Metrics
+from webmonchow.scheduler import MonotonicClock, Scheduler
+from webmonchow.workers import partition_destinations, partition_pvs, run_workers
+
+
+def _send(part, origin, metrics):
+    scheduler = Scheduler(MonotonicClock(origin), metrics)
+    for name in part:
+        scheduler.add(name, 0.0)
+    for _ in scheduler:
+        metrics.messages.inc()
+        metrics.send.observe(0.001)
+
+
+def _fail(part, origin, metrics):  # noqa: ARG001 signature of the targets of run_workers
+    raise ValueError(f"cannot send {part}")
+
+
+def test_partition_destinations():
+    data = {f"/topic/T{i}": [{"frequency": 1, "message": {}}] for i in range(5)}
+    parts = partition_destinations(data, 2)
+    assert [list(part) for part in parts] == [["/topic/T0", "/topic/T2", "/topic/T4"], ["/topic/T1", "/topic/T3"]]
+
+
+def test_partition_pvs():
+    data = {
+        "pvUpdate": [{"instrument": instrument, "name": f"pv{i}"} for i in range(3) for instrument in ("A", "B", "C")],
+        "pvStringUpdate": [{"instrument": "A", "name": "state"}],
+    }
+    parts = partition_pvs(data, 2)
+    assert sum(len(pvs) for part in parts for pvs in part.values()) == 10
+    for part in parts:  # all the PVs of an instrument in the same part
+        instruments = {pv["instrument"] for pvs in part.values() for pv in pvs}
+        others = {pv["instrument"] for other in parts if other is not part for pvs in other.values() for pv in pvs}
+        assert not instruments & others
+
+
+def test_run_workers(capsys):
+    metrics = Metrics()
+    start = time.monotonic()
+    sent = run_workers(_send, [["a", "b"], ["c"], []], metrics, start_delay=0.2)
+    assert time.monotonic() - start >= 0.2  # no worker sends before the shared start time
+    assert sent == [2, 1, 0]
+    assert metrics.messages.value == 3
+    assert metrics.send.count == 3
+    assert metrics.lag.count == 3
+    assert capsys.readouterr().out.splitlines()[-1] == "3 workers sent 3 messages"
+
+
+def test_run_workers_failure():
+    with pytest.raises(RuntimeError, match="worker-0 failed"):
+        run_workers(_fail, [["a"]], start_delay=0.0)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])